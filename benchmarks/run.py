@@ -0,0 +1,228 @@
+"""
+Micro- and macro-benchmarks for lidbox hot paths.
+
+Usage:
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --output new.json --compare results.json --tolerance 0.1
+
+In comparison mode, the exit status is 1 if any benchmark got slower than the stored baseline by more than the tolerance ratio.
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lidbox import audio_feat
+import lidbox.tf_data as tf_data
+
+from synthetic import random_signal_batch, write_corpus
+
+
+BENCHMARKS = collections.OrderedDict()
+
+def benchmark(name):
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+
+def time_repeated(fn, repeats, warmup=1):
+    for _ in range(warmup):
+        fn()
+    durations = []
+    for _ in range(repeats):
+        begin = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - begin)
+    return durations
+
+def make_wav_batch(args):
+    signals = random_signal_batch(args.batch_size, int(args.signal_sec * args.sample_rate), args.sample_rate, args.seed)
+    return audio_feat.Wav(tf.constant(signals), tf.constant(args.batch_size * [args.sample_rate], tf.int32))
+
+FEAT_CONFIG = {
+    "spectrogram": {"frame_length_ms": 25, "frame_step_ms": 10, "fft_length": 512},
+    "melspectrogram": {"num_mel_bins": 40, "fmin": 60.0, "fmax": 6000.0},
+    "mfcc": {"coef_begin": 1, "coef_end": 20},
+    "cmvn": {"window_len": 300, "normalize_variance": True},
+}
+
+
+@benchmark("audio_feat.spectrograms")
+def bench_spectrograms(args):
+    wavs = make_wav_batch(args)
+    return args.batch_size, lambda: audio_feat.spectrograms(wavs, **FEAT_CONFIG["spectrogram"]).numpy()
+
+@benchmark("audio_feat.melspectrograms")
+def bench_melspectrograms(args):
+    wavs = make_wav_batch(args)
+    S = audio_feat.spectrograms(wavs, **FEAT_CONFIG["spectrogram"])
+    sample_rate = tf.constant(args.sample_rate, tf.int32)
+    return args.batch_size, lambda: audio_feat.melspectrograms(S, sample_rate, **FEAT_CONFIG["melspectrogram"]).numpy()
+
+def make_extract_features_bench(feattype):
+    def bench(args):
+        wavs = make_wav_batch(args)
+        feat_config = dict(FEAT_CONFIG, type=feattype)
+        feat_args = tf_data.feat_extraction_args_as_list(feat_config)
+        return args.batch_size, lambda: tf_data.extract_features(wavs, *feat_args).numpy()
+    return bench
+
+for _feattype in ("spectrogram", "melspectrogram", "logmelspectrogram", "mfcc", "db_spectrogram"):
+    benchmark("tf_data.extract_features." + _feattype)(make_extract_features_bench(_feattype))
+
+def make_xla_extract_features_bench(feattype):
+    def bench(args):
+        wavs = make_wav_batch(args)
+        feat_config = dict(FEAT_CONFIG, type=feattype, xla={"sample_rate": args.sample_rate, "bucket_length_ms": 1000})
+        extract_features_xla = tf_data.make_xla_feature_extractor(feat_config)
+        return args.batch_size, lambda: extract_features_xla(wavs).numpy()
+    return bench
+
+for _feattype in ("logmelspectrogram", "mfcc"):
+    benchmark("tf_data.extract_features_xla." + _feattype)(make_xla_extract_features_bench(_feattype))
+
+def make_logmel_batch(args):
+    wavs = make_wav_batch(args)
+    return tf_data.extract_features(wavs, *tf_data.feat_extraction_args_as_list(dict(FEAT_CONFIG, type="logmelspectrogram", cmvn={})))
+
+@benchmark("tf_data.cmvn_slide")
+def bench_cmvn_slide(args):
+    X = make_logmel_batch(args)
+    return args.batch_size, lambda: tf_data.cmvn_slide(X, **FEAT_CONFIG["cmvn"]).numpy()
+
+@benchmark("tf_data.cmvn_nopad_slide_numpy")
+def bench_cmvn_numpy(args):
+    X = make_logmel_batch(args).numpy()
+    return args.batch_size, lambda: tf_data.cmvn_nopad_slide_numpy(X, FEAT_CONFIG["cmvn"]["window_len"], True)
+
+@benchmark("audio_feat.framewise_webrtcvad_decisions")
+def bench_webrtcvad(args):
+    signal = random_signal_batch(1, int(args.signal_sec * args.sample_rate), args.sample_rate, args.seed)[0]
+    wav_bytes = (signal * (2**15 - 1)).astype(np.int16).tobytes()
+    ms = lambda t: int(args.sample_rate * 1e-3 * t)
+    return 1, lambda: audio_feat.framewise_webrtcvad_decisions(signal.size, wav_bytes, args.sample_rate, ms(10), ms(10), ms(25), ms(10), 0)
+
+@benchmark("tf_data.get_chunk_loader.augmented")
+def bench_chunk_loader(args):
+    paths, meta = zip(*write_corpus(args.corpus_dir, args.num_utterances, seed=args.seed))
+    wav_config = {
+        "target_sample_rate": args.sample_rate,
+        "chunks": {"length_ms": 2000, "step_ms": 1500},
+        "augmentation": [{"type": "speed_modification", "range": [0.9, 1.0, 1.1]}],
+    }
+    loader = tf_data.get_chunk_loader(list(paths), [m[:3] for m in meta], wav_config, 0, "train")
+    return len(paths), lambda: sum(1 for _ in loader())
+
+@benchmark("tf_data.serialize_sequence_features")
+def bench_serialize(args):
+    X = make_logmel_batch(args)
+    meta = (tf.constant("utt"), tf.constant("label"))
+    return args.batch_size, lambda: [tf_data.serialize_sequence_features(x, meta) for x in X]
+
+@benchmark("tf_data.prepare_dataset_for_training")
+def bench_prepare_dataset(args):
+    paths, meta = zip(*write_corpus(args.corpus_dir, args.num_utterances, seed=args.seed))
+    labels = sorted(set(m[1] for m in meta))
+    table = tf.lookup.StaticHashTable(tf.lookup.KeyValueTensorInitializer(tf.constant(labels), tf.range(len(labels))), -1)
+    label2onehot = lambda label: tf.one_hot(table.lookup(label), len(labels))
+    feat_config = dict(FEAT_CONFIG, type="logmelspectrogram", batch_size=1)
+    training_config = {"batch_size": args.batch_size, "shuffle_buffer": {"before_cache": 100}}
+    def run():
+        extractor_ds = tf_data.extract_features_from_paths(feat_config, paths, meta, "train")
+        ds = tf_data.prepare_dataset_for_training(extractor_ds, training_config, feat_config, label2onehot, "benchmark")
+        for _ in ds:
+            pass
+    return len(paths), run
+
+
+def run_benchmarks(args):
+    results = []
+    for name, make_bench in BENCHMARKS.items():
+        if args.filter and not any(f in name for f in args.filter):
+            continue
+        num_items, fn = make_bench(args)
+        traces_before = sum(audio_feat.TRACE_COUNTS.values())
+        durations = time_repeated(fn, args.repeats)
+        median = float(np.median(durations))
+        result = collections.OrderedDict([
+            ("name", name),
+            ("repeats", args.repeats),
+            ("items", num_items),
+            ("seconds_median", median),
+            ("seconds_min", float(np.min(durations))),
+            ("items_per_sec", num_items / median),
+            # Feature extraction functions traced during the warmup and timed calls, should not grow with repeats
+            ("traces", sum(audio_feat.TRACE_COUNTS.values()) - traces_before),
+        ])
+        print("{:50s}{:12.6f} s{:14.1f} items/s".format(name, median, result["items_per_sec"]), file=sys.stderr)
+        results.append(result)
+    return results
+
+def compare(results, baseline, tolerance):
+    """Return names of benchmarks where the median time regressed by more than tolerance compared to the baseline."""
+    baseline = {r["name"]: r for r in baseline["results"]}
+    regressions = []
+    print("{:50s}{:>12s}{:>12s}{:>10s}".format("benchmark", "baseline s", "current s", "ratio"), file=sys.stderr)
+    for r in results:
+        if r["name"] not in baseline:
+            continue
+        ratio = r["seconds_median"] / baseline[r["name"]]["seconds_median"]
+        regressed = ratio > 1.0 + tolerance
+        print("{:50s}{:12.6f}{:12.6f}{:10.3f}{}".format(r["name"], baseline[r["name"]]["seconds_median"], r["seconds_median"], ratio, "  REGRESSION" if regressed else ''), file=sys.stderr)
+        if regressed:
+            regressions.append(r["name"])
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", type=str, help="Write results as JSON to this path instead of stdout.")
+    parser.add_argument("--compare", type=str, metavar="BASELINE_JSON", help="Compare results to a previously written results file.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Maximum allowed slowdown ratio before a benchmark is flagged as a regression.")
+    parser.add_argument("--filter", type=str, nargs="*", help="Run only benchmarks with names containing one of these substrings.")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--signal-sec", type=float, default=4.0)
+    parser.add_argument("--sample-rate", type=int, default=16000)
+    parser.add_argument("--num-utterances", type=int, default=64)
+    parser.add_argument("--corpus-dir", type=str, default=os.path.join(tempfile.gettempdir(), "lidbox-benchmark-corpus"))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    output = {
+        "environment": {
+            "python": platform.python_version(),
+            "tensorflow": tf.__version__,
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+        },
+        "args": vars(args),
+        "results": run_benchmarks(args),
+    }
+    output_json = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            print(output_json, file=f)
+    else:
+        print(output_json)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(output["results"], baseline, args.tolerance)
+        if regressions:
+            print("{} benchmarks regressed: {}".format(len(regressions), ', '.join(regressions)), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
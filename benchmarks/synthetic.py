@@ -0,0 +1,45 @@
+"""
+Synthetic audio and corpus generation for benchmarks.
+"""
+import os
+
+import numpy as np
+import soundfile
+
+
+def random_signal(num_samples, sample_rate=16000, seed=0):
+    """Mixture of a few random harmonic tones and white noise, scaled to [-0.5, 0.5]."""
+    rng = np.random.RandomState(seed)
+    t = np.arange(num_samples, dtype=np.float32) / sample_rate
+    signal = np.zeros(num_samples, dtype=np.float32)
+    for f0 in rng.uniform(80, 400, size=3):
+        for harmonic in range(1, 6):
+            signal += rng.uniform(0.1, 1.0) / harmonic * np.sin(2 * np.pi * harmonic * f0 * t)
+    signal += 0.1 * rng.normal(size=num_samples).astype(np.float32)
+    return (0.5 * signal / np.abs(signal).max()).astype(np.float32)
+
+def random_signal_batch(batch_size, num_samples, sample_rate=16000, seed=0):
+    return np.stack([random_signal(num_samples, sample_rate, seed + i) for i in range(batch_size)])
+
+def write_corpus(root, num_utterances, labels=("a", "b", "c"), min_duration_sec=2.0, max_duration_sec=8.0, sample_rate=16000, seed=0):
+    """
+    Write num_utterances 16-bit PCM wavfiles with random durations into root/wav and Kaldi-style utt2path, utt2label and utt2dur files into root.
+    Returns list of (path, (uttid, label, dataset, duration)) tuples in the same format as the e2e feature extractor.
+    """
+    rng = np.random.RandomState(seed)
+    wav_dir = os.path.join(root, "wav")
+    os.makedirs(wav_dir, exist_ok=True)
+    corpus = []
+    for i in range(num_utterances):
+        uttid = "utt{:06d}".format(i)
+        label = labels[i % len(labels)]
+        duration = float(rng.uniform(min_duration_sec, max_duration_sec))
+        path = os.path.join(wav_dir, uttid + ".wav")
+        if not os.path.exists(path):
+            soundfile.write(path, random_signal(int(duration * sample_rate), sample_rate, seed + i), sample_rate, subtype="PCM_16")
+        corpus.append((path, (uttid, label, "synthetic", str(duration))))
+    for filename, column in (("utt2path", lambda p, m: p), ("utt2label", lambda p, m: m[1]), ("utt2dur", lambda p, m: m[3])):
+        with open(os.path.join(root, filename), "w") as f:
+            for path, meta in corpus:
+                print(meta[0], column(path, meta), file=f)
+    return corpus
@@ -0,0 +1,97 @@
+"""
+Sharded on-disk store of activations computed by a frozen model backbone.
+Every batch of a dataset is passed once through the backbone and the outputs are written with the batch targets into TFRecord shards,
+so that the layers after the backbone can be trained for any amount of epochs without running the backbone again.
+"""
+import json
+import os
+
+import tensorflow as tf
+
+from lidbox.tf_data import TF_AUTOTUNE
+
+
+INDEX = "index.json"
+
+def index_path(path):
+    return os.path.join(path, INDEX)
+
+def is_complete(path):
+    """The index is written only after all shards have been written."""
+    return os.path.exists(index_path(path))
+
+def load_index(path):
+    with open(index_path(path)) as f:
+        return json.load(f)
+
+def serialize_batch(activations, targets):
+    feature_definition = {
+        "activations": tf.train.Feature(bytes_list=tf.train.BytesList(value=[tf.io.serialize_tensor(activations).numpy()])),
+        "targets": tf.train.Feature(bytes_list=tf.train.BytesList(value=[tf.io.serialize_tensor(targets).numpy()])),
+    }
+    example = tf.train.Example(features=tf.train.Features(feature=feature_definition))
+    return example.SerializeToString()
+
+def write(backbone, ds, path, batches_per_shard=100, verbosity=0):
+    """
+    Compute backbone outputs in inference mode for all (inputs, targets) batches of ds and write them into TFRecord shards in directory path.
+    ds must be finite, e.g. limited with take if the training set repeats.
+    """
+    os.makedirs(path, exist_ok=True)
+    shards = []
+    writer = None
+    num_batches = 0
+    activation_shape = target_shape = None
+    for num_batches, (inputs, targets) in enumerate(ds, start=1):
+        if (num_batches - 1) % batches_per_shard == 0:
+            if writer is not None:
+                writer.close()
+            shards.append("shard-{:05d}.tfrecord".format(len(shards)))
+            writer = tf.io.TFRecordWriter(os.path.join(path, shards[-1] + ".tmp"))
+        activations = backbone(inputs, training=False)
+        if activation_shape is None:
+            activation_shape = [None] + activations.shape.as_list()[1:]
+            target_shape = [None] + targets.shape.as_list()[1:]
+        writer.write(serialize_batch(activations, targets))
+        if verbosity > 1 and num_batches % 100 == 0:
+            print(num_batches, "batches of backbone activations written")
+    assert writer is not None, "cannot write activations of an empty dataset"
+    writer.close()
+    for shard in shards:
+        os.replace(os.path.join(path, shard + ".tmp"), os.path.join(path, shard))
+    index = {
+        "shards": shards,
+        "num_batches": num_batches,
+        "activation_shape": activation_shape,
+        "target_shape": target_shape,
+        "dtype": activations.dtype.name,
+        "target_dtype": targets.dtype.name,
+    }
+    with open(index_path(path), "w") as f:
+        json.dump(index, f)
+    if verbosity:
+        print("Wrote {} batches of backbone activations with shape {} into {} shards at '{}'".format(num_batches, activation_shape, len(shards), path))
+    return index
+
+def load(path, shuffle_buffer=0):
+    """Load all cached (activations, targets) batches from path as a tf.data.Dataset, optionally shuffling the order of batches."""
+    index = load_index(path)
+    activation_dtype = tf.as_dtype(index["dtype"])
+    target_dtype = tf.as_dtype(index["target_dtype"])
+    feature_definition = {
+        "activations": tf.io.FixedLenFeature(shape=[], dtype=tf.string),
+        "targets": tf.io.FixedLenFeature(shape=[], dtype=tf.string),
+    }
+    def parse(example_str):
+        example = tf.io.parse_single_example(example_str, feature_definition)
+        activations = tf.io.parse_tensor(example["activations"], activation_dtype)
+        activations.set_shape(index["activation_shape"])
+        targets = tf.io.parse_tensor(example["targets"], target_dtype)
+        targets.set_shape(index["target_shape"])
+        return activations, targets
+    shard_paths = [os.path.join(path, shard) for shard in index["shards"]]
+    ds = tf.data.TFRecordDataset(shard_paths, num_parallel_reads=TF_AUTOTUNE)
+    ds = ds.map(parse, num_parallel_calls=TF_AUTOTUNE)
+    if shuffle_buffer:
+        ds = ds.shuffle(shuffle_buffer, reshuffle_each_iteration=True)
+    return ds.prefetch(TF_AUTOTUNE)
@@ -3,6 +3,7 @@ Audio feature extraction.
 Some functions are simply one-to-one TensorFlow math conversions from https://github.com/librosa.
 """
 import collections
+import functools
 
 import tensorflow as tf
 import numpy as np
@@ -10,6 +11,22 @@ import webrtcvad
 
 
 Wav = collections.namedtuple("Wav", ["audio", "sample_rate"])
+# Batch of signals with any batch size and any amount of samples
+WAV_BATCH_SIGNATURE = Wav(tf.TensorSpec([None, None], tf.float32), tf.TensorSpec([None], tf.int32))
+
+# Amount of times each function decorated with count_traces has been traced by tf.function
+TRACE_COUNTS = collections.Counter()
+
+def count_traces(fn):
+    """
+    Decorator for the Python function of a tf.function, increments TRACE_COUNTS[fn.__name__] every time the function is traced.
+    Python side effects are executed only during tracing, so this does not add anything to the traced graph.
+    """
+    @functools.wraps(fn)
+    def traced_fn(*args, **kwargs):
+        TRACE_COUNTS[fn.__name__] += 1
+        return fn(*args, **kwargs)
+    return traced_fn
 
 @tf.function
 def fft_frequencies(sample_rate, n_fft):
@@ -32,7 +49,15 @@ def power_to_db(S, ref=tf.math.reduce_max, amin=1e-10, top_db=80.0):
 def ms_to_frames(sample_rate, ms):
     return tf.cast(tf.cast(sample_rate, tf.float32) * 1e-3 * tf.cast(ms, tf.float32), tf.int32)
 
-@tf.function
+@tf.function(input_signature=[
+    WAV_BATCH_SIGNATURE,
+    tf.TensorSpec([], tf.float32),
+    tf.TensorSpec([], tf.float32),
+    tf.TensorSpec([], tf.float32),
+    tf.TensorSpec([], tf.float32),
+    tf.TensorSpec([], tf.float32),
+    tf.TensorSpec([], tf.int32)])
+@count_traces
 def spectrograms(signals, frame_length_ms=25, frame_step_ms=10, power=2.0, fmin=0.0, fmax=8000.0, fft_length=512):
     tf.debugging.assert_rank(signals.audio, 2, "Expected input signals from which to compute spectrograms to be of shape (batch_size, signal_frames)")
     # Assume all signals in this batch have the same sample rate
@@ -47,7 +72,9 @@ def spectrograms(signals, frame_length_ms=25, frame_step_ms=10, power=2.0, fmin=
     bins_in_band = tf.math.logical_and(fmin <= fft_freqs, fft_freqs <= fmax)
     return tf.boolean_mask(S, bins_in_band, axis=2)
 
-@tf.function
+# linear_to_mel_weight_matrix validates the mel parameters in Python, so they cannot be tensors and only the shapes are relaxed
+@tf.function(experimental_relax_shapes=True)
+@count_traces
 def melspectrograms(S, sample_rate, num_mel_bins=40, fmin=60.0, fmax=6000.0):
     tf.debugging.assert_rank(S, 3, "Input to melspectrograms must be a batch of 2-dimensional spectrograms with shape (batch, frames, freq_bins)")
     mel_weights = tf.signal.linear_to_mel_weight_matrix(
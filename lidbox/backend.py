@@ -0,0 +1,147 @@
+"""
+Back-end classifiers for fixed size embeddings, e.g. x-vectors, implemented with NumPy matrix operations only.
+All training statistics are accumulated and all scores are computed in chunks of rows, so the embeddings can be memory mapped arrays from lidbox.embedding_store that do not fit into memory.
+"""
+import numpy as np
+
+
+CLASSIFIERS = ("gaussian", "cosine")
+
+def chunks(num_rows, chunk_size):
+    for begin in range(0, num_rows, chunk_size):
+        yield begin, min(num_rows, begin + chunk_size)
+
+def length_normalize(X):
+    return X / np.maximum(1e-12, np.linalg.norm(X, axis=1, keepdims=True))
+
+def class_statistics(X, y, num_classes, transform=None, chunk_size=65536):
+    """
+    Amount of rows, sum of rows and the sum of outer products of rows of X for each class index in y, in one pass over X.
+    If transform is given, it is applied on each chunk of rows of X before accumulating.
+    Returns (counts, sums, scatter) with shapes (num_classes,), (num_classes, dim) and (dim, dim), where scatter is summed over all classes.
+    """
+    counts = np.bincount(y, minlength=num_classes).astype(np.float64)
+    sums = None
+    scatter = None
+    for begin, end in chunks(X.shape[0], chunk_size):
+        x = np.asarray(X[begin:end], dtype=np.float64)
+        if transform is not None:
+            x = transform(x)
+        if sums is None:
+            sums = np.zeros((num_classes, x.shape[1]))
+            scatter = np.zeros((x.shape[1], x.shape[1]))
+        onehot = np.zeros((end - begin, num_classes))
+        onehot[np.arange(end - begin), y[begin:end]] = 1.0
+        sums += onehot.T @ x
+        scatter += x.T @ x
+    return counts, sums, scatter
+
+def within_between_covariances(counts, sums, scatter):
+    """Within-class and between-class covariance matrices from class_statistics."""
+    num_total = counts.sum()
+    means = sums / np.maximum(1.0, counts[:, np.newaxis])
+    global_mean = sums.sum(axis=0) / num_total
+    within = (scatter - (counts[:, np.newaxis] * means).T @ means) / num_total
+    centered_means = means - global_mean
+    between = (counts[:, np.newaxis] * centered_means).T @ centered_means / num_total
+    return within, between, means, global_mean
+
+
+class LDA:
+    """Linear discriminant analysis projection to at most num_classes - 1 dimensions that maximize between-class variance relative to within-class variance."""
+
+    def __init__(self, dim=None, regularization=1e-6):
+        self.dim = dim
+        self.regularization = regularization
+        self.mean = None
+        self.projection = None
+
+    def fit_statistics(self, counts, sums, scatter):
+        within, between, _, self.mean = within_between_covariances(counts, sums, scatter)
+        within += self.regularization * np.trace(within) / within.shape[0] * np.eye(within.shape[0])
+        # Whiten the within-class covariance, then diagonalize the whitened between-class covariance
+        w_eigvals, w_eigvecs = np.linalg.eigh(within)
+        whitening = w_eigvecs / np.sqrt(np.maximum(1e-12, w_eigvals))
+        b_eigvals, b_eigvecs = np.linalg.eigh(whitening.T @ between @ whitening)
+        order = np.argsort(b_eigvals)[::-1]
+        dim = self.dim or (np.count_nonzero(counts) - 1)
+        self.projection = whitening @ b_eigvecs[:, order[:dim]]
+        return self
+
+    def transform(self, X):
+        return (np.asarray(X, dtype=np.float64) - self.mean) @ self.projection
+
+
+class GaussianLinearClassifier:
+    """Gaussian classifier with one mean per class and a shared within-class covariance matrix, which gives linear scores (log-likelihoods up to a constant)."""
+
+    def __init__(self, regularization=1e-6):
+        self.regularization = regularization
+        self.weights = None
+        self.biases = None
+
+    def fit_statistics(self, counts, sums, scatter):
+        within, _, means, _ = within_between_covariances(counts, sums, scatter)
+        within += self.regularization * np.trace(within) / within.shape[0] * np.eye(within.shape[0])
+        precision_means = np.linalg.solve(within, means.T)
+        self.weights = precision_means
+        self.biases = -0.5 * np.einsum("ij,ji->i", means, precision_means)
+        return self
+
+    def score(self, X):
+        return X @ self.weights + self.biases
+
+
+class CosineClassifier:
+    """Cosine similarity between length normalized embeddings and the length normalized class means."""
+
+    def __init__(self):
+        self.class_means = None
+
+    def fit_statistics(self, counts, sums, scatter):
+        self.class_means = length_normalize(sums / np.maximum(1.0, counts[:, np.newaxis]))
+        return self
+
+    def score(self, X):
+        return length_normalize(X) @ self.class_means.T
+
+
+class Backend:
+    """
+    Optional LDA projection, optional length normalization and a classifier, trained from embeddings with string labels.
+    Config keys: lda_dim (0 or null to disable LDA), length_norm (bool), classifier (one of CLASSIFIERS), regularization.
+    """
+
+    def __init__(self, lda_dim=None, length_norm=True, classifier="gaussian", regularization=1e-6, chunk_size=65536):
+        assert classifier in CLASSIFIERS, "unknown classifier '{}', valid classifiers are {}".format(classifier, ', '.join(CLASSIFIERS))
+        self.lda = LDA(lda_dim, regularization) if lda_dim else None
+        self.length_norm = length_norm
+        if classifier == "gaussian":
+            self.classifier = GaussianLinearClassifier(regularization)
+        else:
+            self.classifier = CosineClassifier()
+        self.chunk_size = chunk_size
+        self.labels = None
+
+    def transform(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if self.lda is not None:
+            x = self.lda.transform(x)
+        if self.length_norm:
+            x = length_normalize(x)
+        return x
+
+    def fit(self, X, labels):
+        """Train the LDA and the classifier with one pass over X for each."""
+        self.labels, y = np.unique(labels, return_inverse=True)
+        if self.lda is not None:
+            self.lda.fit_statistics(*class_statistics(X, y, len(self.labels), chunk_size=self.chunk_size))
+        self.classifier.fit_statistics(*class_statistics(X, y, len(self.labels), transform=self.transform, chunk_size=self.chunk_size))
+        return self
+
+    def score(self, X):
+        """Scores of all rows of X for all labels, as a float32 array of shape (num_rows, num_labels) with columns in the order of self.labels."""
+        scores = np.empty((X.shape[0], len(self.labels)), dtype=np.float32)
+        for begin, end in chunks(X.shape[0], self.chunk_size):
+            scores[begin:end] = self.classifier.score(self.transform(X[begin:end]))
+        return scores
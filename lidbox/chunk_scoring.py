@@ -0,0 +1,58 @@
+"""
+Aggregation of chunk level model outputs into utterance level scores.
+All chunks of one utterance are consecutive, so every aggregation is a segment reduction over rows with NumPy ufunc.reduceat, without looping over utterances.
+"""
+import numpy as np
+
+
+AGGREGATIONS = ("mean_log_likelihood", "max", "attention")
+
+def log_softmax(x):
+    x = x - x.max(axis=1, keepdims=True)
+    return x - np.log(np.exp(x).sum(axis=1, keepdims=True))
+
+def to_log_posteriors(outputs, convert_scores="softmax"):
+    """
+    Log posteriors from model outputs, using the same conversions as the evaluate command.
+    'softmax' for logits or log_softmax outputs, 'exp' for log posteriors and 'none' for posteriors.
+    """
+    outputs = np.asarray(outputs, dtype=np.float64)
+    if convert_scores == "softmax":
+        return log_softmax(outputs)
+    if convert_scores == "exp":
+        return outputs
+    return np.log(np.maximum(1e-30, outputs))
+
+def segment_starts(segment_ids):
+    """Indexes of the first row of every segment in a sorted array of segment ids, and the segment id of each segment."""
+    starts = np.flatnonzero(np.r_[True, segment_ids[1:] != segment_ids[:-1]])
+    return starts, segment_ids[starts]
+
+def segment_softmax(x, starts, lengths):
+    """Softmax of the 1-D array x within each segment."""
+    exp = np.exp(x - np.repeat(np.maximum.reduceat(x, starts), lengths))
+    return exp / np.repeat(np.add.reduceat(exp, starts), lengths)
+
+def aggregate(log_posteriors, segment_ids, aggregation="mean_log_likelihood", attention_temperature=1.0):
+    """
+    Reduce chunk log posteriors of shape (num_chunks, num_langs) into utterance level log scores of shape (num_segments, num_langs),
+    where segment_ids contains the sorted utterance index of every chunk.
+    mean_log_likelihood: mean of chunk log posteriors.
+    max: maximum chunk log posterior of every language.
+    attention: log of the mean of chunk posteriors weighted by the softmax of chunk confidences over the chunks of the utterance,
+    where the confidence of a chunk is its negative posterior entropy divided by attention_temperature.
+    Returns the utterance level scores and the segment id of each row.
+    """
+    assert aggregation in AGGREGATIONS, "unknown aggregation '{}', valid aggregations are {}".format(aggregation, ', '.join(AGGREGATIONS))
+    starts, ids = segment_starts(np.asarray(segment_ids))
+    lengths = np.diff(np.r_[starts, log_posteriors.shape[0]])
+    if aggregation == "mean_log_likelihood":
+        scores = np.add.reduceat(log_posteriors, starts, axis=0) / lengths[:, np.newaxis]
+    elif aggregation == "max":
+        scores = np.maximum.reduceat(log_posteriors, starts, axis=0)
+    else:
+        posteriors = np.exp(log_posteriors)
+        confidence = (posteriors * log_posteriors).sum(axis=1) / attention_temperature
+        weights = segment_softmax(confidence, starts, lengths)
+        scores = np.log(np.maximum(1e-30, np.add.reduceat(weights[:, np.newaxis] * posteriors, starts, axis=0)))
+    return scores, ids
@@ -16,11 +16,13 @@ class ExpandAbspath(argparse.Action):
 class BaseCommand:
 
     tasks = tuple()
+    # Subcommand name on the command line, defaults to lowercase class name
+    command_name = None
 
     @classmethod
     def create_argparser(cls, subparsers):
         parser = subparsers.add_parser(
-            cls.__name__.lower(),
+            cls.command_name or cls.__name__.lower(),
             description=cls.__doc__,
             add_help=False
         )
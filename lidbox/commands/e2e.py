@@ -7,18 +7,29 @@ import json
 import os
 import random
 import sys
+import threading
 import time
 
 import kaldiio
 import numpy as np
 import tensorflow as tf
+import yaml
 
 from lidbox import yaml_pprint
 from lidbox.commands.base import BaseCommand, Command, ExpandAbspath
-# from lidbox.metrics import AverageDetectionCost, AverageEqualErrorRate, AveragePrecision, AverageRecall
+import lidbox.backend as backend
+import lidbox.chunk_scoring as chunk_scoring
+import lidbox.embedding_store as embedding_store
+import lidbox.evaluation as evaluation
+import lidbox.feature_store as feature_store
 import lidbox.models as models
+from lidbox.models.xvector import SlidingWindowScorer
+import lidbox.score_store as score_store
+import lidbox.serving as serving
 import lidbox.tf_data as tf_data
+import lidbox.tflite as tflite
 import lidbox.system as system
+from lidbox.tiered_cache import TieredCache, is_cache_complete
 
 
 class E2E(BaseCommand):
@@ -82,6 +93,59 @@ def count_dim_sizes(ds, ds_element_index, ndims):
 def now_str(date=False):
     return str(datetime.datetime.now() if date else int(time.time()))
 
+def set_dotted_key(config, dotted_key, value):
+    """Set value for a nested key such as 'features.batch_size' in a dict of dicts, or delete the key if value is None."""
+    *parents, key = dotted_key.split('.')
+    for parent in parents:
+        config = config.setdefault(parent, {})
+    if value is None:
+        config.pop(key, None)
+    else:
+        config[key] = value
+
+def read_rss_bytes():
+    """Current resident set size of this process, read from /proc on Linux, or the peak RSS on other platforms."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return 1024 * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class PeakMemorySampler:
+    """
+    Context manager that samples the resident set size of this process in a background thread and keeps the maximum.
+    growth_bytes is the growth of the peak over the resident set size when entering the context, so earlier allocations of the process are not counted.
+    """
+    def __init__(self, interval_sec=0.05):
+        self.interval_sec = interval_sec
+        self.baseline_bytes = 0
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak_bytes = max(self.peak_bytes, read_rss_bytes())
+            self._stop.wait(self.interval_sec)
+
+    @property
+    def growth_bytes(self):
+        return max(0, self.peak_bytes - self.baseline_bytes)
+
+    def __enter__(self):
+        self.baseline_bytes = self.peak_bytes = read_rss_bytes()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_bytes = max(self.peak_bytes, read_rss_bytes())
+
 
 class E2EBase(Command):
 
@@ -131,8 +195,112 @@ class E2EBase(Command):
             print()
         return models.KerasWrapper(self.model_id, config["model_definition"], **callbacks_kwargs)
 
-    def extract_features(self, datasets, config, datagroup_key, trim_audio, debug_squeeze_last_dim):
+    def resolve_labels(self):
+        """
+        Replace the dataset keys of the experiment config with their definitions from the datasets yaml given with --dataset-config, if it was given.
+        Returns the labels in the order of the model outputs, like the train command.
+        """
+        args = self.args
+        if args.dataset_config:
+            assert "dataset" not in self.experiment_config, "config file should not contain a 'dataset' key if a separate datasets yaml is supplied"
+            dataset_config = system.load_yaml(args.dataset_config)
+            self.experiment_config["datasets"] = [d for d in dataset_config if d["key"] in self.experiment_config["datasets"]]
+            return sorted(set(l for d in self.experiment_config["datasets"] for l in d["labels"]))
+        else:
+            return self.experiment_config["dataset"]["labels"]
+
+    def export_text(self, scores, text_scores=None, text_trials=None):
+        """Export the score store at path scores as text scores and text trials for external evaluation tools."""
         args = self.args
+        if text_scores:
+            score_store.export_text_scores(scores, text_scores, precision=args.score_precision, separator=args.score_separator)
+            if args.verbosity:
+                print("Exported text scores to '{}'".format(text_scores))
+        if text_trials:
+            score_store.export_text_trials(scores, text_trials)
+            if args.verbosity:
+                print("Exported text trials to '{}'".format(text_trials))
+
+    def load_best_checkpoint(self, model, training_config, checkpoint=None):
+        """Load model weights from the given checkpoint file name or the best checkpoint according to the checkpoint monitor value, returns the checkpoint path or None if there are no checkpoints."""
+        checkpoint_dir = self.get_checkpoint_dir()
+        if checkpoint:
+            checkpoint_path = os.path.join(checkpoint_dir, checkpoint)
+        else:
+            checkpoints = [c.name for c in os.scandir(checkpoint_dir) if c.is_file()] if os.path.isdir(checkpoint_dir) else []
+            if not checkpoints:
+                return None
+            if "checkpoints" in training_config:
+                monitor_value = training_config["checkpoints"]["monitor"]
+                monitor_mode = training_config["checkpoints"].get("mode")
+            else:
+                monitor_value = "epoch"
+                monitor_mode = None
+            checkpoint_path = os.path.join(checkpoint_dir, models.get_best_checkpoint(checkpoints, key=monitor_value, mode=monitor_mode))
+        if self.args.verbosity:
+            print("Loading model weights from checkpoint file '{}'".format(checkpoint_path))
+        model.load_weights(checkpoint_path)
+        return checkpoint_path
+
+    def features_cache_dir(self, ds_config):
+        if ds_config.get("persistent_features_cache", True):
+            return os.path.join(self.cache_dir, "features")
+        else:
+            return "/tmp/tensorflow-cache"
+
+    def read_features_cache(self, extractor_ds, ds_config, datagroup_key):
+        """
+        Read features from the feature store or the complete features cache written by the train command for datagroup_key, if one exists.
+        Otherwise extractor_ds is returned unchanged and the features are extracted from audio without writing a cache.
+        """
+        feat_config = self.experiment_config["features"]
+        _, conf_checksum = config_checksum(self.experiment_config, datagroup_key)
+        features_cache_path = os.path.join(
+            self.features_cache_dir(ds_config),
+            datagroup_key,
+            tf_data.feature_type_name(feat_config),
+            conf_checksum,
+        )
+        cache_encoding = tf_data.get_cache_encoding(feat_config)
+        if feature_store.exists(features_cache_path + ".store"):
+            if self.args.verbosity:
+                print("Reading features from feature store '{}'".format(features_cache_path + ".store"))
+            return feature_store.load(features_cache_path + ".store", shuffle=False)
+        # The train command caches features without signals
+        extractor_ds = tf_data.without_wavs(extractor_ds)
+        if not is_cache_complete(features_cache_path):
+            if self.args.verbosity:
+                print("No complete features cache at '{}', extracting features from audio".format(features_cache_path))
+            return extractor_ds
+        if self.args.verbosity:
+            print("Loading features from existing cache: '{}'".format(features_cache_path))
+        if cache_encoding == "float32":
+            return extractor_ds.cache(filename=features_cache_path)
+        extractor_ds = tf_data.encode_cached_features(extractor_ds, cache_encoding)
+        extractor_ds = extractor_ds.cache(filename=features_cache_path)
+        return tf_data.decode_cached_features(extractor_ds)
+
+    def create_tiered_cache(self, ds_config):
+        """
+        Cache manager for prepared datasets if 'copy_cache_to_tmp' is enabled in ds_config.
+        The value can be a dict with keys 'local_dir', 'canonical_dir' (null to disable the canonical tier) and 'max_local_size_gb'.
+        """
+        cache_config = ds_config.get("copy_cache_to_tmp")
+        if not cache_config:
+            return None
+        if not isinstance(cache_config, dict):
+            cache_config = {}
+        return TieredCache(
+            local_dir=cache_config.get("local_dir", "/tmp/tensorflow-cache/tiered"),
+            canonical_dir=cache_config.get("canonical_dir", os.path.join(self.cache_dir, "prepared")),
+            max_local_size_gb=cache_config.get("max_local_size_gb"),
+            verbosity=self.args.verbosity)
+
+    def extract_features(self, datasets, config, datagroup_key, trim_audio, debug_squeeze_last_dim, stats=None, stage_cache_dir=None, rejected=None):
+        args = self.args
+        if stage_cache_dir is None:
+            # Same directory as the train command uses, so all commands share the cached stages
+            stage_cache_dir = os.path.join(self.features_cache_dir(self.experiment_config.get("experiment", {})), "stages", datagroup_key)
         utt2path = collections.OrderedDict()
         utt2meta = collections.OrderedDict()
         if args.verbosity > 1:
@@ -209,7 +377,7 @@ class E2EBase(Command):
                 print("All utterances:")
                 for path, (utt, label, dataset, *rest) in zip(paths, paths_meta):
                     print(utt, label, dataset, sep='\t')
-        if config["type"] == "sparsespeech":
+        if config.get("type") == "sparsespeech":
             seg2utt_path = os.path.join(datagroup["path"], "segmented", datagroup.get("seg2utt", "seg2utt"))
             if args.verbosity:
                 print("Parsing SparseSpeech features")
@@ -222,7 +390,7 @@ class E2EBase(Command):
             if args.verbosity:
                 print("SparseSpeech input: '{}' and encoding: '{}'".format(feat_path, enc_path))
             feat = tf_data.parse_sparsespeech_features(config, enc_path, feat_path, seg2utt, utt2label)
-        elif config["type"] == "kaldi":
+        elif config.get("type") == "kaldi":
             feat_conf = dict(config["datagroups"][datagroup_key])
             kaldi_feats_scp = feat_conf.pop("features_path")
             expected_shape = feat_conf.pop("shape")
@@ -238,6 +406,9 @@ class E2EBase(Command):
                 trim_audio=trim_audio,
                 debug_squeeze_last_dim=debug_squeeze_last_dim,
                 verbosity=args.verbosity,
+                stats=stats,
+                stage_cache_dir=stage_cache_dir,
+                rejected=rejected,
             )
         return feat
 
@@ -266,8 +437,28 @@ class Train(E2EBase):
             type=str,
             action=ExpandAbspath,
             help="Path to a yaml-file containing a list of datasets.")
+        optional.add_argument("--instrument-pipeline",
+            action="store_true",
+            default=False,
+            help="Record throughput and latency between all named stages of the feature extraction and training dataset pipelines. Results are written as TensorBoard scalars and printed as a table after --exhaust-dataset-iterator and after training.")
         return parser
 
+    def write_pipeline_stats(self, model, pipeline_stats, step):
+        for ds, stats in pipeline_stats.items():
+            stats.print_table()
+            logdir = os.path.join(os.path.dirname(model.tensorboard.log_dir), "pipeline", ds)
+            self.make_named_dir(logdir, "pipeline stats")
+            with tf.summary.create_file_writer(logdir).as_default():
+                stats.write_summaries(step)
+
+    def write_rejected_reports(self, rejected_utterances):
+        for ds, (rejected, report_path) in rejected_utterances.items():
+            if not len(rejected):
+                continue
+            if self.args.verbosity:
+                print("Validation policy 'filter' dropped {} utterances with non-finite features from dataset '{}', writing their ids to '{}'".format(len(rejected), ds, report_path))
+            rejected.write_report(report_path)
+
     def train(self):
         args = self.args
         if args.verbosity:
@@ -282,13 +473,7 @@ class Train(E2EBase):
             print("Using feature extraction parameters:")
             yaml_pprint(feat_config)
             print()
-        if args.dataset_config:
-            assert "dataset" not in self.experiment_config, "config file should not contain a 'dataset' key if a separate datasets yaml is supplied"
-            dataset_config = system.load_yaml(args.dataset_config)
-            self.experiment_config["datasets"] = [d for d in dataset_config if d["key"] in self.experiment_config["datasets"]]
-            labels = sorted(set(l for d in self.experiment_config["datasets"] for l in d["labels"]))
-        else:
-            labels = self.experiment_config["dataset"]["labels"]
+        labels = self.resolve_labels()
         label2int, OH = make_label2onehot(labels)
         onehot_dims = self.experiment_config["experiment"].get("onehot_dims")
         if onehot_dims:
@@ -312,6 +497,10 @@ class Train(E2EBase):
         if args.verbosity:
             print("Using model:\n{}".format(str(model)))
         dataset = {}
+        dataset_checksums = {}
+        pipeline_stats = {}
+        tiered_caches = []
+        rejected_utterances = {}
         for ds in ("train", "validation"):
             if args.verbosity > 2:
                 print("Dataset config for '{}'".format(ds))
@@ -322,23 +511,39 @@ class Train(E2EBase):
             debug_squeeze_last_dim = ds_config["input_shape"][-1] == 1
             datagroup_key = ds_config.pop("datagroup")
             conf_json, conf_checksum = config_checksum(self.experiment_config, datagroup_key)
+            # Checksum of the feature config, the datagroup and the options that affect the contents of the prepared dataset
+            dataset_checksums[ds] = tf_data.prepared_dataset_checksum(ds_config, conf_checksum)
+            if args.instrument_pipeline:
+                pipeline_stats[ds] = tf_data.PipelineStats(ds)
+            rejected = None
+            if tf_data.get_validation_policy(feat_config)[0] == "filter":
+                rejected = tf_data.RejectedUtterances(ds)
+            # Only the audio summaries of the dataset logger need the signals, otherwise they are not cached with the features
+            keep_wavs = summary_kwargs and "reservoir_size" not in summary_kwargs and not summary_kwargs.get("histogram_only", False)
+            # Stage caches contain the signals only in the audio stage
+            assert not (keep_wavs and "stage_caching" in feat_config), "features extracted with 'stage_caching' have no signals for the audio summaries of the dataset logger of '{}', use 'dataset_logger.histogram_only' or 'dataset_logger.reservoir_size'".format(ds)
+            features_cache_dir = self.features_cache_dir(ds_config)
             extractor_ds = self.extract_features(
                 self.experiment_config["datasets"],
                 json.loads(json.dumps(feat_config)),
                 datagroup_key,
                 summary_kwargs.pop("trim_audio", False),
                 debug_squeeze_last_dim,
+                stats=pipeline_stats.get(ds),
+                stage_cache_dir=os.path.join(features_cache_dir, "stages", datagroup_key),
+                rejected=rejected,
             )
-            if ds_config.get("persistent_features_cache", True):
-                features_cache_dir = os.path.join(self.cache_dir, "features")
-            else:
-                features_cache_dir = "/tmp/tensorflow-cache"
             features_cache_path = os.path.join(
                 features_cache_dir,
                 datagroup_key,
-                feat_config["type"],
+                tf_data.feature_type_name(feat_config),
                 conf_checksum,
             )
+            if keep_wavs:
+                # Elements with signals have a different structure, so they are cached separately
+                features_cache_path += "-wavs"
+            else:
+                extractor_ds = tf_data.without_wavs(extractor_ds)
             self.make_named_dir(os.path.dirname(features_cache_path), "features cache")
             if not os.path.exists(features_cache_path + ".md5sum-input"):
                 with open(features_cache_path + ".md5sum-input", "w") as f:
@@ -348,8 +553,41 @@ class Train(E2EBase):
             else:
                 if args.verbosity:
                     print("Loading features from existing cache: '{}'".format(features_cache_path))
-            extractor_ds = extractor_ds.cache(filename=features_cache_path)
-            if args.exhaust_dataset_iterator:
+            if rejected is not None:
+                rejected_utterances[ds] = (rejected, features_cache_path + ".rejected")
+            cache_encoding = tf_data.get_cache_encoding(feat_config)
+            if ds_config.get("feature_store"):
+                store_kwargs = ds_config["feature_store"] if isinstance(ds_config["feature_store"], dict) else {}
+                store_path = features_cache_path + ".store"
+                if not feature_store.exists(store_path):
+                    if args.verbosity:
+                        print("Writing features into new feature store '{}' with encoding '{}'".format(store_path, cache_encoding))
+                    feature_store.write(extractor_ds, store_path, encoding=cache_encoding, verbosity=args.verbosity)
+                if args.verbosity:
+                    print("Reading features by offset from feature store '{}' with options:".format(store_path))
+                    yaml_pprint(store_kwargs)
+                if store_kwargs.get("balance_labels", False):
+                    steps_key = "steps_per_epoch" if ds == "train" else "validation_steps"
+                    assert ds_config.get(steps_key), "feature_store.balance_labels produces an infinite '{}' dataset, the amount of batches per epoch must be given with key '{}'".format(ds, steps_key)
+                extractor_ds = feature_store.load(store_path, **store_kwargs)
+            elif "stage_caching" in feat_config:
+                if args.verbosity:
+                    print("Features are cached by stages, not caching them again into '{}'".format(features_cache_path))
+            elif cache_encoding == "float32":
+                extractor_ds = extractor_ds.cache(filename=features_cache_path)
+            else:
+                if args.verbosity:
+                    print("Encoding cached features as '{}'".format(cache_encoding))
+                extractor_ds = tf_data.encode_cached_features(extractor_ds, cache_encoding)
+                extractor_ds = extractor_ds.cache(filename=features_cache_path)
+                extractor_ds = tf_data.decode_cached_features(extractor_ds)
+            if args.exhaust_dataset_iterator and ds_config.get("feature_store"):
+                # The feature store was written completely above and it can be infinite if labels are balanced
+                if args.verbosity:
+                    print("--exhaust-dataset-iterator given, but features are read from a complete feature store, not iterating over the dataset")
+                if ds in rejected_utterances:
+                    self.write_rejected_reports({ds: rejected_utterances[ds]})
+            elif args.exhaust_dataset_iterator:
                 if args.verbosity:
                     print("--exhaust-dataset-iterator given, now iterating once over the dataset iterator to fill the features cache.")
                 # This forces the extractor_ds pipeline to be evaluated, and the features being serialized into the cache
@@ -363,6 +601,13 @@ class Train(E2EBase):
                         tf_data.tf_print("sample:", i, "features shape:", tf.shape(feats), "metadata:", *meta)
                 if args.verbosity > 1:
                     print(now_str(date=True), "- all", i, "samples done")
+                if ds in pipeline_stats:
+                    self.write_pipeline_stats(model, {ds: pipeline_stats[ds]}, 0)
+                if ds in rejected_utterances:
+                    self.write_rejected_reports({ds: rejected_utterances[ds]})
+            tiered_cache = self.create_tiered_cache(ds_config)
+            if tiered_cache:
+                tiered_caches.append(tiered_cache)
             dataset[ds] = tf_data.prepare_dataset_for_training(
                 extractor_ds,
                 ds_config,
@@ -371,6 +616,8 @@ class Train(E2EBase):
                 self.model_id,
                 conf_checksum=conf_checksum,
                 verbosity=args.verbosity,
+                stats=pipeline_stats.get(ds),
+                tiered_cache=tiered_cache,
             )
             if args.debug_dataset:
                 if args.verbosity:
@@ -392,7 +639,12 @@ class Train(E2EBase):
                         writer = tf.summary.create_file_writer(logdir)
                         summary_kwargs["debug_squeeze_last_dim"] = debug_squeeze_last_dim
                         with writer.as_default():
-                            logged_dataset = tf_data.attach_dataset_logger(dataset[ds], feat_config["type"], **summary_kwargs)
+                            reservoir = None
+                            if "reservoir_size" in summary_kwargs:
+                                reservoir = tf_data.BatchReservoir(summary_kwargs["reservoir_size"])
+                                logged_dataset = tf_data.attach_reservoir_logger(dataset[ds], reservoir, summary_kwargs.get("num_batches", -1))
+                            else:
+                                logged_dataset = tf_data.attach_dataset_logger(dataset[ds], tf_data.feature_type_name(feat_config), **summary_kwargs)
                             if args.verbosity:
                                 print("Dataset logger attached to '{0}' dataset iterator, now exhausting the '{0}' dataset logger iterator once to write TensorBoard summaries of model input data".format(ds))
                             i = 0
@@ -410,26 +662,32 @@ class Train(E2EBase):
                                             "wav.sample_rate[0]", meta[1].sample_rate[0])
                             if args.verbosity > 1:
                                 print(i, "batches done")
+                            if reservoir:
+                                if args.verbosity:
+                                    print("Writing histogram summaries of {} batches sampled from {} batches".format(len(reservoir.batches), reservoir.num_offered))
+                                reservoir.write_summaries(summary_kwargs.get("percentile_q", (1, 5, 25, 50, 75, 95, 99)))
                             del logged_dataset
-        checkpoint_dir = self.get_checkpoint_dir()
-        checkpoints = [c.name for c in os.scandir(checkpoint_dir) if c.is_file()] if os.path.isdir(checkpoint_dir) else []
-        if checkpoints:
-            if "checkpoints" in training_config:
-                monitor_value = training_config["checkpoints"]["monitor"]
-                monitor_mode = training_config["checkpoints"].get("mode")
-            else:
-                monitor_value = "epoch"
-                monitor_mode = None
-            checkpoint_path = os.path.join(checkpoint_dir, models.get_best_checkpoint(checkpoints, key=monitor_value, mode=monitor_mode))
-            if args.verbosity:
-                print("Loading model weights from checkpoint file '{}' according to monitor value '{}'".format(checkpoint_path, monitor_value))
-            model.load_weights(checkpoint_path)
+        # Resume training from the best checkpoint, if there are any
+        self.load_best_checkpoint(model, training_config)
         if args.verbosity:
             print("\nStarting training")
         if args.skip_training:
             print("--skip-training given, will not call model.fit")
             return
-        history = model.fit(dataset["train"], dataset["validation"], training_config)
+        if "frozen_backbone" in training_config:
+            training_config["frozen_backbone"].setdefault("cache_dir", os.path.join(self.cache_dir, "activations", self.model_id))
+            if args.verbosity:
+                print("Training only the layers after frozen backbone layer '{}' from activations cached in '{}'".format(
+                    training_config["frozen_backbone"]["layer"],
+                    training_config["frozen_backbone"]["cache_dir"]))
+        history = model.fit(dataset["train"], dataset["validation"], training_config, dataset_checksums=dataset_checksums)
+        if pipeline_stats:
+            self.write_pipeline_stats(model, pipeline_stats, len(history.epoch))
+        elif args.verbosity > 1:
+            tf_data.print_trace_counts()
+        self.write_rejected_reports(rejected_utterances)
+        for tiered_cache in tiered_caches:
+            tiered_cache.publish()
         if args.verbosity:
             print("\nTraining finished after {} epochs at epoch {}".format(len(history.epoch), history.epoch[-1] + 1))
             print("metric:\tmin (epoch),\tmax (epoch):")
@@ -462,6 +720,7 @@ class Predict(E2EBase):
     """
     Use a trained model to produce likelihoods for all target languages from all utterances in the test set.
     Writes all predictions as scores and information about the target and non-target languages into the cache dir.
+    All predictions are also written into a binary score store, with the true language of each utterance as implicit target and non-target trials.
     """
 
     @classmethod
@@ -472,6 +731,9 @@ class Predict(E2EBase):
         optional.add_argument("--score-separator", type=str, default=' ')
         optional.add_argument("--trials", type=str)
         optional.add_argument("--scores", type=str)
+        optional.add_argument("--score-store",
+            type=str,
+            help="Path of the binary score store to write, without the .npy or .index.npz suffix. Defaults to 'predictions/score_store' in the model cache directory.")
         optional.add_argument("--checkpoint",
             type=str,
             help="Specify which Keras checkpoint to load model weights from, instead of using the most recent one.")
@@ -486,8 +748,11 @@ class Predict(E2EBase):
             args.trials = os.path.join(self.cache_dir, self.model_id, "predictions", "trials")
         if not args.scores:
             args.scores = os.path.join(self.cache_dir, self.model_id, "predictions", "scores")
+        if not args.score_store:
+            args.score_store = os.path.join(self.cache_dir, self.model_id, "predictions", "score_store")
         self.make_named_dir(os.path.dirname(args.trials))
         self.make_named_dir(os.path.dirname(args.scores))
+        self.make_named_dir(os.path.dirname(args.score_store))
         training_config = self.experiment_config["experiment"]
         feat_config = self.experiment_config["features"]
         if args.verbosity > 1:
@@ -503,26 +768,10 @@ class Predict(E2EBase):
             print("Preparing model")
         labels = self.experiment_config["dataset"]["labels"]
         model.prepare(labels, training_config)
-        checkpoint_dir = self.get_checkpoint_dir()
-        if args.checkpoint:
-            checkpoint_path = os.path.join(checkpoint_dir, args.checkpoint)
-        elif "best_checkpoint" in self.experiment_config.get("prediction", {}):
-            checkpoint_path = os.path.join(checkpoint_dir, self.experiment_config["prediction"]["best_checkpoint"])
-        else:
-            checkpoints = os.listdir(checkpoint_dir) if os.path.isdir(checkpoint_dir) else []
-            if not checkpoints:
-                print("Error: Cannot evaluate with a model that has no checkpoints, i.e. is not trained.")
-                return 1
-            if "checkpoints" in training_config:
-                monitor_value = training_config["checkpoints"]["monitor"]
-                monitor_mode = training_config["checkpoints"].get("mode")
-            else:
-                monitor_value = "epoch"
-                monitor_mode = None
-            checkpoint_path = os.path.join(checkpoint_dir, models.get_best_checkpoint(checkpoints, key=monitor_value, mode=monitor_mode))
-        if args.verbosity:
-            print("Loading model weights from checkpoint file '{}'".format(checkpoint_path))
-        model.load_weights(checkpoint_path)
+        checkpoint = args.checkpoint or self.experiment_config.get("prediction", {}).get("best_checkpoint")
+        if not self.load_best_checkpoint(model, training_config, checkpoint):
+            print("Error: Cannot evaluate with a model that has no checkpoints, i.e. is not trained.", file=sys.stderr)
+            return 1
         if args.verbosity:
             print("\nEvaluating testset with model:")
             print(str(model))
@@ -598,7 +847,7 @@ class Predict(E2EBase):
             features_cache_dir,
             self.experiment_config["dataset"]["key"],
             ds,
-            feat_config["type"],
+            tf_data.feature_type_name(feat_config),
             conf_checksum,
         )
         self.make_named_dir(os.path.dirname(features_cache_path), "features cache")
@@ -626,162 +875,797 @@ class Predict(E2EBase):
                     print(now_str(date=True), "-", i, "samples done")
         if args.verbosity > 1:
             print(now_str(date=True), "- all", i, "samples done")
-        if args.verbosity:
-            print("Features extracted, writing target and non-target language information for each utterance to '{}'.".format(args.trials))
-        with open(args.trials, "w") as trials_f:
-            for utt, target in utt2label.items():
-                for lang in int2label:
-                    print(lang, utt, "target" if target == lang else "nontarget", file=trials_f)
         if args.verbosity:
             print("Starting prediction with model")
         predictions = model.predict(features.map(lambda *t: t[0]))
         if args.verbosity > 1:
-            print("Done predicting, model returned predictions of shape {}. Writing them to '{}'.".format(predictions.shape, args.scores))
-        num_predictions = 0
-        with open(args.scores, "w") as scores_f:
-            print(*int2label, file=scores_f)
-            for utt, pred in zip(utterance_ids, predictions):
-                pred_scores = [np.format_float_positional(x, precision=args.score_precision) for x in pred]
-                print(utt, *pred_scores, sep=args.score_separator, file=scores_f)
-                num_predictions += 1
-        if args.verbosity:
-            print("Wrote {} prediction scores to '{}'.".format(num_predictions, args.scores))
+            print("Done predicting, model returned predictions of shape {}. Writing them to '{}'.".format(predictions.shape, args.score_store))
+        # Chunks of utterances have no true language, the trials are implicit in the labels of the score store
+        score_store.write(
+            args.score_store,
+            predictions,
+            utterance_ids,
+            int2label,
+            labels=[utt2label.get(utt, '') for utt in utterance_ids],
+            verbosity=args.verbosity)
+        self.export_text(args.score_store, args.scores, args.trials)
 
     def run(self):
         super().run()
         return self.predict()
 
 
-#class Evaluate(E2EBase):
-#    """Evaluate predicted scores by average detection cost (C_avg)."""
-
-#    @classmethod
-#    def create_argparser(cls, parent_parser):
-#        parser = super().create_argparser(parent_parser)
-#        optional = parser.add_argument_group("evaluate options")
-#        optional.add_argument("--trials", type=str)
-#        optional.add_argument("--scores", type=str)
-#        optional.add_argument("--threshold-bins", type=int, default=40)
-#        optional.add_argument("--convert-scores", choices=("softmax", "exp", "none"), default=None)
-#        return parser
-
-#    #TODO tf is very slow in the for loop, maybe numpy would be sufficient
-#    def evaluate(self):
-#        args = self.args
-#        self.model_id = self.experiment_config["experiment"]["name"]
-#        if not args.trials:
-#            args.trials = os.path.join(self.cache_dir, self.model_id, "predictions", "trials")
-#        if not args.scores:
-#            args.scores = os.path.join(self.cache_dir, self.model_id, "predictions", "scores")
-#        if args.verbosity > 1:
-#            print("Evaluating minimum average detection cost using trials '{}' and scores '{}'".format(args.trials, args.scores))
-#        score_lines = list(parse_space_separated(args.scores))
-#        langs = score_lines[0]
-#        lang2int = {l: i for i, l in enumerate(langs)}
-#        utt2scores = {utt: tf.constant([float(s) for s in scores], dtype=tf.float32) for utt, *scores in score_lines[1:]}
-#        if args.verbosity > 1:
-#            print("Parsed scores for {} utterances".format(len(utt2scores)))
-#        if args.convert_scores == "softmax":
-#            print("Applying softmax on logit scores")
-#            utt2scores = {utt: tf.keras.activations.softmax(tf.expand_dims(scores, 0))[0] for utt, scores in utt2scores.items()}
-#        elif args.convert_scores == "exp":
-#            print("Applying exp on log likelihood scores")
-#            utt2scores = {utt: tf.math.exp(scores) for utt, scores in utt2scores.items()}
-#        if args.verbosity > 2:
-#            print("Asserting all scores sum to 1")
-#            tolerance = 1e-3
-#            for utt, scores in utt2scores.items():
-#                one = tf.constant(1.0, dtype=tf.float32)
-#                tf.debugging.assert_near(
-#                    tf.reduce_sum(scores),
-#                    one,
-#                    rtol=tolerance,
-#                    atol=tolerance,
-#                    message="failed to convert log likelihoods to probabilities, the probabilities of predictions for utterance '{}' does not sum to 1".format(utt))
-#        if args.verbosity > 1:
-#            print("Generating {} threshold bins".format(args.threshold_bins))
-#        assert args.threshold_bins > 0
-#        from_logits = False
-#        max_score = tf.constant(-float("inf"), dtype=tf.float32)
-#        min_score = tf.constant(float("inf"), dtype=tf.float32)
-#        for utt, scores in utt2scores.items():
-#            max_score = tf.math.maximum(max_score, tf.math.reduce_max(scores))
-#            min_score = tf.math.minimum(min_score, tf.math.reduce_min(scores))
-#        if args.verbosity > 2:
-#            tf_data.tf_print("Max score", max_score, "min score", min_score)
-#        thresholds = tf.linspace(min_score, max_score, args.threshold_bins)
-#        if args.verbosity > 2:
-#            print("Score thresholds for language detection decisions:")
-#            tf_data.tf_print(thresholds, summarize=5)
-#        # First do C_avg to get the best threshold
-#        cavg = AverageDetectionCost(langs, theta_det=list(thresholds.numpy()))
-#        if args.verbosity > 1:
-#            print("Sorting trials")
-#        trials_by_utt = sorted(parse_space_separated(args.trials), key=lambda t: t[1])
-#        trials_by_utt = [
-#            (utt, tf.constant([float(t == "target") for _, _, t in sorted(group, key=lambda t: lang2int[t[0]])], dtype=tf.float32))
-#            for utt, group in itertools.groupby(trials_by_utt, key=lambda t: t[1])
-#        ]
-#        if args.verbosity:
-#            print("Computing minimum C_avg using {} score thresholds".format(len(thresholds)))
-#        # Collect labels and predictions for confusion matrix
-#        cm_labels = []
-#        cm_predictions = []
-#        for utt, y_true in trials_by_utt:
-#            if utt not in utt2scores:
-#                print("Warning: correct class for utterance '{}' listed in trials but it has no predicted scores, skipping".format(utt), file=sys.stderr)
-#                continue
-#            y_pred = utt2scores[utt]
-#            # Update using singleton batches
-#            cavg.update_state(
-#                tf.expand_dims(y_true, 0),
-#                tf.expand_dims(y_pred, 0)
-#            )
-#            cm_labels.append(tf.math.argmax(y_true))
-#            cm_predictions.append(tf.math.argmax(y_pred))
-#        # Evaluating the cavg result has a side effect of generating the argmin of the minimum cavg into cavg.min_index
-#        _ = cavg.result()
-#        min_threshold = thresholds[cavg.min_index].numpy()
-#        def print_metric(m):
-#            print("{:15s}\t{:.3f}".format(m.name + ":", m.result().numpy()))
-#        print("min C_avg at threshold {:.6f}".format(min_threshold))
-#        print_metric(cavg)
-#        # Now we know the threshold that minimizes C_avg and use the same threshold to compute all other metrics
-#        metrics = [
-#            M(langs, from_logits=from_logits, thresholds=min_threshold)
-#            for M in (AverageEqualErrorRate, AveragePrecision, AverageRecall)
-#        ]
-#        if args.verbosity:
-#            print("Computing rest of the metrics using threshold {:.6f}".format(min_threshold))
-#        for utt, y_true in trials_by_utt:
-#            if utt not in utt2scores:
-#                continue
-#            y_true_batch = tf.expand_dims(y_true, 0)
-#            y_pred = tf.expand_dims(utt2scores[utt], 0)
-#            for m in metrics:
-#                m.update_state(y_true_batch, y_pred)
-#        for avg_m in metrics:
-#            print_metric(avg_m)
-#        print("\nMetrics by target, using threshold {:.6f}".format(min_threshold))
-#        for avg_m in metrics:
-#            print(avg_m.name)
-#            for m in avg_m:
-#                print_metric(m)
-#        print("\nConfusion matrix")
-#        cm_labels = tf.cast(tf.stack(cm_labels), dtype=tf.int32)
-#        cm_predictions = tf.cast(tf.stack(cm_predictions), dtype=tf.int32)
-#        confusion_matrix = tf.math.confusion_matrix(cm_labels, cm_predictions, len(langs))
-#        print(langs)
-#        print(np.array_str(confusion_matrix.numpy()))
-
-#    def run(self):
-#        super().run()
-#        return self.evaluate()
+class ExtractEmbeddings(E2EBase):
+    """
+    Use a trained model to extract embeddings from the outputs of a named layer, e.g. 'segment1' in xvector or 'embedding' in convnet_extractor.
+    Outputs of layers with a time dimension, such as 'embedding' in convnet_extractor, are averaged over time into one embedding per utterance.
+    Embeddings of all utterances in the given experiment datasets are written into memory mapped embedding stores in the cache dir, with an index of utterance ids and labels.
+    """
+    command_name = "extract-embeddings"
+
+    @classmethod
+    def create_argparser(cls, parent_parser):
+        parser = super().create_argparser(parent_parser)
+        optional = parser.add_argument_group("extract-embeddings options")
+        optional.add_argument("--embedding-layer",
+            type=str,
+            help="Name of the layer that outputs the embeddings, outputs with a time dimension are averaged over time. Defaults to the key 'embedding_layer' of the experiment config, or 'segment1'.")
+        optional.add_argument("--datasets",
+            type=str,
+            nargs="+",
+            default=["test"],
+            help="Keys of the experiment dataset configs (e.g. train, validation, test), whose datagroups will be used for extracting embeddings.")
+        optional.add_argument("--batch-size",
+            type=int,
+            help="Override the batch size of the dataset configs for inference, including the batch size of 'masked_padded_batch'.")
+        optional.add_argument("--checkpoint",
+            type=str,
+            help="Specify which Keras checkpoint to load model weights from, instead of using the best one.")
+        optional.add_argument("--dataset-config",
+            type=str,
+            action=ExpandAbspath,
+            help="Path to a yaml-file containing a list of datasets.")
+        optional.add_argument("--output-dir",
+            type=str,
+            action=ExpandAbspath,
+            help="Write embedding stores into this directory instead of the default directory 'embeddings' in the model cache directory.")
+        parser.set_defaults(shuffle_utt2path=False)
+        return parser
+
+    def extract_embeddings(self):
+        args = self.args
+        training_config = self.experiment_config["experiment"]
+        feat_config = self.experiment_config["features"]
+        self.model_id = training_config["name"]
+        labels = self.resolve_labels()
+        label2int, OH = make_label2onehot(labels)
+        label2onehot = lambda label: OH[label2int.lookup(label)]
+        model = self.create_model(dict(training_config), skip_training=True)
+        model.prepare(labels, training_config)
+        if not self.load_best_checkpoint(model, training_config, args.checkpoint):
+            print("Error: Cannot extract embeddings with a model that has no checkpoints, i.e. is not trained.", file=sys.stderr)
+            return 1
+        layer_name = args.embedding_layer or training_config.get("embedding_layer", "segment1")
+        extractor = model.embedding_extractor(layer_name)
+        assert len(extractor.output.shape) in (2, 3), "layer '{}' has output shape {}, embeddings must have shape (batch, dim) or (batch, time, dim)".format(layer_name, extractor.output.shape)
+        # Time distributed outputs, e.g. 'embedding' in convnet_extractor, are pooled into one embedding per utterance
+        pool_over_time = len(extractor.output.shape) == 3
+        if args.verbosity:
+            print("Extracting embeddings from layer '{}' with output shape {}".format(layer_name, extractor.output.shape))
+            if pool_over_time:
+                print("Averaging embeddings over the time dimension")
+        output_dir = args.output_dir or os.path.join(self.cache_dir, self.model_id, "embeddings")
+        self.make_named_dir(output_dir, "embeddings")
+        for ds in args.datasets:
+            ds_config = dict(training_config, **training_config[ds])
+            for key in ("train", "validation", "test"):
+                ds_config.pop(key, None)
+            # Every utterance must be seen exactly once
+            for key in ("shuffle_buffer", "copy_cache_to_tmp", "dataset_logger"):
+                ds_config.pop(key, None)
+            if args.batch_size:
+                ds_config["batch_size"] = args.batch_size
+                if "masked_padded_batch" in ds_config:
+                    ds_config["masked_padded_batch"] = dict(ds_config["masked_padded_batch"], batch_size=args.batch_size)
+            # padded_batch drops all metadata, so the embeddings could not be matched with utterance ids
+            assert "padded_batch" not in ds_config, "cannot extract embeddings from dataset '{}' with key 'padded_batch', which drops the utterance ids, use 'masked_padded_batch' or 'batch_size' instead".format(ds)
+            assert not (pool_over_time and "masked_padded_batch" in ds_config), "cannot average time distributed outputs of layer '{}' over padded frames, remove key 'masked_padded_batch' from dataset '{}'".format(layer_name, ds)
+            datagroup_key = ds_config.pop("datagroup")
+            conf_json, conf_checksum = config_checksum(self.experiment_config, datagroup_key)
+            extractor_ds = self.extract_features(
+                self.experiment_config["datasets"],
+                json.loads(json.dumps(feat_config)),
+                datagroup_key,
+                False,
+                ds_config["input_shape"][-1] == 1,
+            )
+            dataset = tf_data.prepare_dataset_for_training(
+                extractor_ds,
+                ds_config,
+                feat_config,
+                label2onehot,
+                self.model_id,
+                conf_checksum=conf_checksum,
+                verbosity=args.verbosity,
+            )
+            def embedding_batches():
+                for i, (feats, onehot, uttids, *_) in enumerate(dataset, start=1):
+                    embeddings = np.asarray(extractor.predict_on_batch(feats))
+                    if pool_over_time:
+                        embeddings = embeddings.mean(axis=1)
+                    yield (
+                        embeddings,
+                        [u.decode("utf-8") for u in uttids.numpy()],
+                        [labels[l] for l in np.argmax(onehot.numpy(), axis=1)])
+                    if args.verbosity > 1 and i % 100 == 0:
+                        print(now_str(date=True), "-", i, "batches done")
+            store_path = os.path.join(output_dir, "{}-{}".format(datagroup_key, layer_name))
+            if args.verbosity:
+                print("Writing embeddings of datagroup '{}' into '{}'".format(datagroup_key, store_path))
+            embedding_store.write(embedding_batches(), store_path, verbosity=args.verbosity)
+
+    def run(self):
+        super().run()
+        return self.extract_embeddings()
+
+
+class PredictChunks(E2EBase):
+    """
+    Use a trained model to score long utterances in fixed length chunks and aggregate the chunk scores into one score per utterance.
+    All chunks have the same length, so they are scored in large uniform batches without padding and the inference time grows linearly with the amount of audio.
+    Chunking parameters are read from the key 'prediction.chunked_scoring' of the experiment config, e.g.
+
+        prediction:
+          chunked_scoring:
+            length: 400
+            step: 200
+            batch_size: 256
+            aggregation: mean_log_likelihood
+            convert_scores: softmax
+            reuse_frame_activations: false
+
+    With reuse_frame_activations, x-vector style models run their frame layers once over each utterance and chunk scores are computed from overlapping windows of the shared frame activations, see lidbox.models.xvector.SlidingWindowScorer.
+    Scores are written into a binary score store, see the predict command.
+    """
+    command_name = "predict-chunks"
+
+    @classmethod
+    def create_argparser(cls, parent_parser):
+        parser = super().create_argparser(parent_parser)
+        optional = parser.add_argument_group("predict-chunks options")
+        optional.add_argument("--dataset",
+            type=str,
+            default="test",
+            help="Key of the experiment dataset config (e.g. train, validation, test), whose datagroup will be scored.")
+        optional.add_argument("--dataset-config",
+            type=str,
+            action=ExpandAbspath,
+            help="Path to a yaml-file containing a list of datasets.")
+        optional.add_argument("--aggregation",
+            choices=chunk_scoring.AGGREGATIONS,
+            help="Override the chunk score aggregation of the config.")
+        optional.add_argument("--tflite",
+            type=str,
+            action=ExpandAbspath,
+            help="Score chunks with this TFLite model from export-tflite on the CPU instead of the Keras model. The chunk length must equal the input length of the TFLite model.")
+        optional.add_argument("--tflite-threads", type=int)
+        optional.add_argument("--checkpoint",
+            type=str,
+            help="Specify which Keras checkpoint to load model weights from, instead of using the best one.")
+        optional.add_argument("--scores",
+            type=str,
+            help="Path of the binary score store to write, without the .npy or .index.npz suffix.")
+        optional.add_argument("--text-scores", type=str)
+        optional.add_argument("--text-trials", type=str)
+        optional.add_argument("--score-precision", type=int, default=6)
+        optional.add_argument("--score-separator", type=str, default=' ')
+        parser.set_defaults(shuffle_utt2path=False)
+        return parser
+
+    def predict_chunks(self):
+        args = self.args
+        training_config = self.experiment_config["experiment"]
+        feat_config = self.experiment_config["features"]
+        self.model_id = training_config["name"]
+        chunk_config = dict(self.experiment_config.get("prediction", {}).get("chunked_scoring", {}))
+        assert "length" in chunk_config, "chunked scoring requires the chunk length in frames in key 'prediction.chunked_scoring.length'"
+        if args.aggregation:
+            chunk_config["aggregation"] = args.aggregation
+        chunk_len = chunk_config["length"]
+        chunk_step = chunk_config.get("step", chunk_len)
+        aggregation = chunk_config.get("aggregation", "mean_log_likelihood")
+        if args.verbosity:
+            print("Scoring chunks with config:")
+            yaml_pprint(chunk_config)
+        if not args.scores:
+            args.scores = os.path.join(self.cache_dir, self.model_id, "predictions", "chunked_scores")
+        self.make_named_dir(os.path.dirname(args.scores))
+        labels = self.resolve_labels()
+        model = self.create_model(dict(training_config), skip_training=True)
+        model.prepare(labels, training_config)
+        if not self.load_best_checkpoint(model, training_config, args.checkpoint):
+            print("Error: Cannot score chunks with a model that has no checkpoints, i.e. is not trained.", file=sys.stderr)
+            return 1
+        ds_config = dict(training_config, **training_config[args.dataset])
+        datagroup_key = ds_config["datagroup"]
+        extractor_ds = self.extract_features(
+            self.experiment_config["datasets"],
+            json.loads(json.dumps(feat_config)),
+            datagroup_key,
+            False,
+            ds_config["input_shape"][-1] == 1,
+        )
+        if isinstance(extractor_ds.element_spec[0], dict):
+            extractor_ds = extractor_ds.map(lambda feats, meta: (feats[ds_config["feature_output"]], meta))
+        if chunk_config.get("reuse_frame_activations", False):
+            assert not args.tflite, "TFLite models cannot reuse frame activations, disable 'reuse_frame_activations' to score chunks with TFLite"
+            # Run the frame layers once per utterance and pool overlapping windows from prefix sums of frame activations
+            scorer = SlidingWindowScorer(model.model, chunk_len, chunk_step)
+            if args.verbosity:
+                print("Scoring overlapping windows from shared frame activations, receptive field {} frames, stride {} frames".format(scorer.receptive_field, scorer.stride))
+            if args.verbosity and chunk_step % scorer.stride:
+                print("Warning: window step {} is not a multiple of the frame layer stride {}, window scores will differ slightly from separately scored chunks".format(chunk_step, scorer.stride))
+            def output_batches():
+                # Skip empty features and enumerate utterances like chunks_for_scoring
+                nonempty_ds = extractor_ds.filter(lambda feats, meta: tf.shape(feats)[0] > 0)
+                for index, (feats, meta) in nonempty_ds.enumerate():
+                    _, outputs = scorer.score(feats)
+                    num_windows = outputs.shape[0]
+                    yield outputs, np.full(num_windows, index.numpy()), np.full(num_windows, meta[0].numpy()), np.full(num_windows, meta[1].numpy())
+        else:
+            chunk_ds = tf_data.chunks_for_scoring(extractor_ds, chunk_len, chunk_step, chunk_config.get("batch_size", ds_config.get("batch_size", 1)))
+            predict_on_batch = model.predict_on_batch
+            if args.tflite:
+                tflite_model = tflite.TFLiteModel(args.tflite, args.tflite_threads)
+                assert tflite_model.input_length == chunk_len, "TFLite model '{}' has input length {} but the chunk length is {}".format(args.tflite, tflite_model.input_length, chunk_len)
+                if args.verbosity:
+                    print("Scoring chunks with TFLite model '{}'".format(args.tflite))
+                predict_on_batch = lambda chunks: tflite_model.predict_on_batch(chunks.numpy())
+            def output_batches():
+                for chunks, utterance_index, uttids, utt_labels in chunk_ds:
+                    yield predict_on_batch(chunks), utterance_index.numpy(), uttids.numpy(), utt_labels.numpy()
+        begin = time.perf_counter()
+        chunk_outputs, segment_ids, chunk_uttids, chunk_labels = [], [], [], []
+        for i, (outputs, utterance_index, uttids, utt_labels) in enumerate(output_batches(), start=1):
+            chunk_outputs.append(np.asarray(outputs))
+            segment_ids.append(utterance_index)
+            chunk_uttids.append(uttids)
+            chunk_labels.append(utt_labels)
+            if args.verbosity > 1 and i % 100 == 0:
+                print(now_str(date=True), "-", i, "batches of chunks done")
+        assert chunk_outputs, "no chunks were extracted from datagroup '{}'".format(datagroup_key)
+        chunk_outputs = np.concatenate(chunk_outputs)
+        segment_ids = np.concatenate(segment_ids)
+        chunk_uttids = np.concatenate(chunk_uttids)
+        chunk_labels = np.concatenate(chunk_labels)
+        if args.verbosity:
+            print("Scored {} chunks in {:.3f} s, aggregating with '{}'".format(chunk_outputs.shape[0], time.perf_counter() - begin, aggregation))
+        log_posteriors = chunk_scoring.to_log_posteriors(chunk_outputs, chunk_config.get("convert_scores", "softmax"))
+        scores, _ = chunk_scoring.aggregate(log_posteriors, segment_ids, aggregation, chunk_config.get("attention_temperature", 1.0))
+        starts, _ = chunk_scoring.segment_starts(segment_ids)
+        uttids = np.char.decode(chunk_uttids[starts].astype(bytes), "utf-8")
+        utt_labels = np.char.decode(chunk_labels[starts].astype(bytes), "utf-8")
+        score_store.write(
+            args.scores,
+            scores,
+            uttids,
+            labels,
+            labels=utt_labels,
+            verbosity=args.verbosity)
+        self.export_text(args.scores, args.text_scores, args.text_trials)
+
+    def run(self):
+        super().run()
+        return self.predict_chunks()
+
+
+class ScoreEmbeddings(E2EBase):
+    """
+    Train a NumPy back-end classifier on an embedding store and score all embeddings of another embedding store, without TensorFlow.
+    Back-end parameters are read from the 'backend' key of the experiment config, e.g.
+
+        backend:
+          lda_dim: 100
+          length_norm: true
+          classifier: gaussian
+
+    Scores are written into a binary score store, in the same format as by the predict command.
+    """
+    command_name = "score-embeddings"
+
+    @classmethod
+    def create_argparser(cls, parent_parser):
+        parser = super().create_argparser(parent_parser)
+        required = parser.add_argument_group("score-embeddings arguments")
+        required.add_argument("train_store",
+            type=str,
+            action=ExpandAbspath,
+            help="Path of the embedding store used for training the back-end, without the .data or .index.npz suffix.")
+        required.add_argument("test_store",
+            type=str,
+            action=ExpandAbspath,
+            help="Path of the embedding store to score.")
+        optional = parser.add_argument_group("score-embeddings options")
+        optional.add_argument("--scores",
+            type=str,
+            help="Path of the binary score store to write, without the .npy or .index.npz suffix.")
+        optional.add_argument("--text-scores", type=str)
+        optional.add_argument("--text-trials", type=str)
+        optional.add_argument("--score-precision", type=int, default=6)
+        optional.add_argument("--score-separator", type=str, default=' ')
+        return parser
+
+    def score_embeddings(self):
+        args = self.args
+        self.model_id = self.experiment_config["experiment"]["name"]
+        backend_config = self.experiment_config.get("backend", {})
+        if args.verbosity:
+            print("Training back-end with config:")
+            yaml_pprint(backend_config)
+        train_embeddings, train_index = embedding_store.load(args.train_store)
+        begin = time.perf_counter()
+        scorer = backend.Backend(**backend_config).fit(train_embeddings, train_index["labels"])
+        if args.verbosity:
+            print("Trained back-end on {} embeddings with labels {} in {:.3f} s".format(train_embeddings.shape[0], ', '.join(scorer.labels), time.perf_counter() - begin))
+        test_embeddings, test_index = embedding_store.load(args.test_store)
+        begin = time.perf_counter()
+        scores = scorer.score(test_embeddings)
+        if args.verbosity:
+            print("Scored {} embeddings in {:.3f} s".format(scores.shape[0], time.perf_counter() - begin))
+        if not args.scores:
+            args.scores = os.path.join(self.cache_dir, self.model_id, "predictions", "backend_scores")
+        self.make_named_dir(os.path.dirname(args.scores))
+        score_store.write(args.scores, scores, test_index["uttids"], scorer.labels, labels=test_index["labels"], verbosity=args.verbosity)
+        self.export_text(args.scores, args.text_scores, args.text_trials)
+
+    def run(self):
+        super().run()
+        return self.score_embeddings()
+
+
+class ExportSavedModel(E2EBase):
+    """
+    Export a trained model together with wav decoding and feature extraction into a single SavedModel, which takes raw audio and returns scores for all labels.
+    The feature extraction uses the feature config of the experiment, so that the exported model computes the same features as during training.
+    """
+    command_name = "export-saved-model"
+
+    @classmethod
+    def create_argparser(cls, parent_parser):
+        parser = super().create_argparser(parent_parser)
+        optional = parser.add_argument_group("export-saved-model options")
+        optional.add_argument("--export-dir",
+            type=str,
+            action=ExpandAbspath,
+            help="Write the SavedModel into this directory instead of the directory 'saved_model' in the model cache directory.")
+        optional.add_argument("--checkpoint",
+            type=str,
+            help="Specify which Keras checkpoint to load model weights from, instead of using the best one.")
+        optional.add_argument("--dataset",
+            type=str,
+            default="test",
+            help="Key of the experiment dataset config, from which the model input options (e.g. feature_output) are read.")
+        optional.add_argument("--dataset-config",
+            type=str,
+            action=ExpandAbspath,
+            help="Path to a yaml-file containing a list of datasets.")
+        optional.add_argument("--sample-rate",
+            type=int,
+            help="Sample rate of all audio given to the exported model. Defaults to 'wav_config.target_sample_rate' of the feature config, or 16000.")
+        optional.add_argument("--benchmark",
+            action="store_true",
+            default=False,
+            help="After exporting, load the SavedModel and measure its latency and throughput on random wav files.")
+        optional.add_argument("--benchmark-batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+        optional.add_argument("--benchmark-signal-sec", type=float, default=4.0)
+        optional.add_argument("--benchmark-repeats", type=int, default=20)
+        parser.set_defaults(shuffle_utt2path=False)
+        return parser
+
+    def export_saved_model(self):
+        args = self.args
+        training_config = self.experiment_config["experiment"]
+        feat_config = self.experiment_config["features"]
+        self.model_id = training_config["name"]
+        labels = self.resolve_labels()
+        model = self.create_model(dict(training_config), skip_training=True)
+        model.prepare(labels, training_config)
+        if not self.load_best_checkpoint(model, training_config, args.checkpoint):
+            print("Error: Cannot export a model that has no checkpoints, i.e. is not trained.", file=sys.stderr)
+            return 1
+        ds_config = dict(training_config, **training_config[args.dataset])
+        sample_rate = args.sample_rate or serving.default_sample_rate(feat_config)
+        export_dir = args.export_dir or os.path.join(self.cache_dir, self.model_id, "saved_model")
+        self.make_named_dir(os.path.dirname(export_dir))
+        if args.verbosity:
+            print("Exporting model with feature extraction config:")
+            yaml_pprint(feat_config)
+        serving.export(
+            model.model,
+            json.loads(json.dumps(feat_config)),
+            labels,
+            export_dir,
+            sample_rate,
+            feature_output=ds_config.get("feature_output"),
+            verbosity=args.verbosity)
+        if args.benchmark:
+            if args.verbosity:
+                print("Benchmarking exported model with {} s random wav files".format(args.benchmark_signal_sec))
+            serving.benchmark(
+                export_dir,
+                batch_sizes=args.benchmark_batch_sizes,
+                signal_sec=args.benchmark_signal_sec,
+                repeats=args.benchmark_repeats,
+                sample_rate=sample_rate,
+                verbosity=max(1, args.verbosity))
+            if args.verbosity:
+                print("Wrote benchmark results to '{}'".format(os.path.join(export_dir, serving.BENCHMARK_RESULTS)))
+
+    def run(self):
+        super().run()
+        return self.export_saved_model()
+
+
+class ExportTFLite(E2EBase):
+    """
+    Convert a trained model into TFLite models with post-training quantization, for scoring fixed length feature chunks on CPUs with predict-chunks --tflite.
+    Activation ranges for int8 quantization are calibrated with feature chunks from the features cache of the training set, if it exists.
+    Writes one .tflite file for each quantization and a report of the output differences and inference speedups compared to the Keras model on test set chunks.
+    """
+    command_name = "export-tflite"
+
+    @classmethod
+    def create_argparser(cls, parent_parser):
+        parser = super().create_argparser(parent_parser)
+        optional = parser.add_argument_group("export-tflite options")
+        optional.add_argument("--quantizations",
+            type=str,
+            nargs="+",
+            choices=tflite.QUANTIZATIONS,
+            default=list(tflite.QUANTIZATIONS))
+        optional.add_argument("--input-length",
+            type=int,
+            help="Amount of input frames of the TFLite models. Defaults to the chunk length in key 'prediction.chunked_scoring.length' of the experiment config.")
+        optional.add_argument("--batch-size",
+            type=int,
+            help="Fixed batch size of the TFLite models, smaller batches are padded when scoring. Defaults to the batch size in key 'prediction.chunked_scoring.batch_size' of the experiment config, or 1.")
+        optional.add_argument("--checkpoint",
+            type=str,
+            help="Specify which Keras checkpoint to load model weights from, instead of using the best one.")
+        optional.add_argument("--dataset-config",
+            type=str,
+            action=ExpandAbspath,
+            help="Path to a yaml-file containing a list of datasets.")
+        optional.add_argument("--representative-dataset",
+            type=str,
+            default="train",
+            help="Key of the experiment dataset config whose features are used for calibrating int8 quantization.")
+        optional.add_argument("--representative-samples", type=int, default=500)
+        optional.add_argument("--parity-dataset",
+            type=str,
+            default="test",
+            help="Key of the experiment dataset config whose features are used for comparing the TFLite models to the Keras model.")
+        optional.add_argument("--parity-batches", type=int, default=20)
+        optional.add_argument("--parity-batch-size", type=int, default=32)
+        optional.add_argument("--output-dir",
+            type=str,
+            action=ExpandAbspath,
+            help="Write the TFLite models into this directory instead of the directory 'tflite' in the model cache directory.")
+        parser.set_defaults(shuffle_utt2path=False)
+        return parser
+
+    def feature_chunks(self, dataset_key, input_length, batch_size):
+        training_config = self.experiment_config["experiment"]
+        feat_config = self.experiment_config["features"]
+        ds_config = dict(training_config, **training_config[dataset_key])
+        datagroup_key = ds_config["datagroup"]
+        extractor_ds = self.extract_features(
+            self.experiment_config["datasets"],
+            json.loads(json.dumps(feat_config)),
+            datagroup_key,
+            False,
+            ds_config["input_shape"][-1] == 1,
+        )
+        extractor_ds = self.read_features_cache(extractor_ds, ds_config, datagroup_key)
+        if isinstance(extractor_ds.element_spec[0], dict):
+            extractor_ds = extractor_ds.map(lambda feats, meta: (feats[ds_config["feature_output"]], meta))
+        return tf_data.chunks_for_scoring(extractor_ds, input_length, input_length, batch_size)
+
+    def export_tflite(self):
+        args = self.args
+        training_config = self.experiment_config["experiment"]
+        self.model_id = training_config["name"]
+        input_length = args.input_length or self.experiment_config.get("prediction", {}).get("chunked_scoring", {}).get("length")
+        assert input_length, "TFLite models have a fixed amount of input frames, specify it with --input-length or the key 'prediction.chunked_scoring.length'"
+        batch_size = args.batch_size or self.experiment_config.get("prediction", {}).get("chunked_scoring", {}).get("batch_size", 1)
+        labels = self.resolve_labels()
+        model = self.create_model(dict(training_config), skip_training=True)
+        model.prepare(labels, training_config)
+        if not self.load_best_checkpoint(model, training_config, args.checkpoint):
+            print("Error: Cannot export a model that has no checkpoints, i.e. is not trained.", file=sys.stderr)
+            return 1
+        output_dir = args.output_dir or os.path.join(self.cache_dir, self.model_id, "tflite")
+        self.make_named_dir(output_dir, "TFLite models")
+        representative_dataset = None
+        if "int8" in args.quantizations:
+            if args.verbosity:
+                print("Calibrating int8 quantization with {} chunks of {} frames from dataset '{}'".format(args.representative_samples, input_length, args.representative_dataset))
+            representative_dataset = tflite.representative_dataset(
+                self.feature_chunks(args.representative_dataset, input_length, batch_size),
+                args.representative_samples,
+                batch_size)
+        parity_batches = [chunks.numpy() for chunks, *_ in self.feature_chunks(args.parity_dataset, input_length, args.parity_batch_size).take(args.parity_batches)]
+        assert parity_batches, "no feature chunks of length {} in dataset '{}'".format(input_length, args.parity_dataset)
+        report = collections.OrderedDict()
+        for quantization in args.quantizations:
+            tflite_path = os.path.join(output_dir, "{}-{}.tflite".format(self.model_id, quantization))
+            if args.verbosity:
+                print("Converting model to TFLite with quantization '{}' for batches of {} chunks".format(quantization, batch_size))
+            with open(tflite_path, "wb") as f:
+                f.write(tflite.convert(model.model, input_length, batch_size, quantization, representative_dataset))
+            report[quantization] = dict(
+                tflite.parity_report(model, tflite.TFLiteModel(tflite_path), parity_batches),
+                path=tflite_path,
+                size_bytes=os.path.getsize(tflite_path))
+            if args.verbosity:
+                print("Wrote '{}'".format(tflite_path))
+        report_path = os.path.join(output_dir, "report.json")
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print("{:15s}{:>12s}{:>14s}{:>14s}{:>10s}{:>10s}".format("quantization", "size MB", "max abs diff", "argmax agree", "speedup", "ms/chunk"))
+        for quantization, r in report.items():
+            print("{:15s}{:12.2f}{:14.6f}{:14.4f}{:10.2f}{:10.3f}".format(
+                quantization,
+                r["size_bytes"] * 1e-6,
+                r["max_abs_diff"],
+                r["argmax_agreement"],
+                r["speedup"],
+                1e3 * r["tflite_sec"] / r["num_inputs"]))
+        if args.verbosity:
+            print("Wrote parity and speed report to '{}'".format(report_path))
+
+    def run(self):
+        super().run()
+        return self.export_tflite()
+
+
+class TunePipeline(E2EBase):
+    """
+    Run short, timed trials of the training dataset pipeline over a search space of feature extraction and batching settings on a subset of the training data.
+    The search space is read from the 'pipeline_tuning' key of the experiment config, e.g.
+
+        pipeline_tuning:
+          max_batches: 100
+          warmup_batches: 5
+          max_trials: 20
+          seed: 0
+          search_space:
+            features.batch_size: [1, 16, 64]
+            features.cmvn_numpy: [null, {window_len: 300}]
+            experiment.train.shuffle_buffer.before_cache: [0, 1000]
+            experiment.train.prefetch: [null, 1, 8]
+
+    All keys are dotted paths into the experiment config and a null value removes the key.
+    If there are more than max_trials trials, a random subset of them is chosen with the given seed.
+    Every trial draws warmup_batches batches before it is timed, so that tracing and cold file caches are not measured, and memory usage is reported as the growth of the peak resident set size during the trial.
+    The overrides of the fastest trial are written as yaml into the cache directory.
+    """
+    command_name = "tune-pipeline"
+
+    @classmethod
+    def create_argparser(cls, parent_parser):
+        parser = super().create_argparser(parent_parser)
+        optional = parser.add_argument_group("tune-pipeline options")
+        optional.add_argument("--max-batches",
+            type=int,
+            help="Override pipeline_tuning.max_batches, the amount of batches drawn from the training dataset in each trial.")
+        optional.add_argument("--dataset-config",
+            type=str,
+            action=ExpandAbspath,
+            help="Path to a yaml-file containing a list of datasets.")
+        optional.add_argument("--output",
+            type=str,
+            action=ExpandAbspath,
+            help="Write the best overrides as yaml into this file instead of the default path in the model cache directory.")
+        parser.set_defaults(shuffle_utt2path=False)
+        return parser
+
+    def make_trials(self, tuning_config):
+        search_space = tuning_config["search_space"]
+        keys = sorted(search_space)
+        trials = [dict(zip(keys, values)) for values in itertools.product(*(search_space[k] for k in keys))]
+        max_trials = tuning_config.get("max_trials")
+        if max_trials and len(trials) > max_trials:
+            random.Random(tuning_config.get("seed", 0)).shuffle(trials)
+            trials = trials[:max_trials]
+        return trials
+
+    def run_trial(self, overrides, labels, max_batches, warmup_batches):
+        args = self.args
+        config = json.loads(json.dumps(self.experiment_config))
+        for key, value in overrides.items():
+            set_dotted_key(config, key, value)
+        feat_config = config["features"]
+        training_config = config["experiment"]
+        ds_config = dict(training_config, **training_config["train"])
+        del ds_config["train"], ds_config["validation"]
+        datagroup_key = ds_config.pop("datagroup")
+        # Trials measure throughput of the extraction pipeline, so nothing is read from or written to the feature caches or the stage caches
+        ds_config.pop("copy_cache_to_tmp", None)
+        feat_config.pop("stage_caching", None)
+        label2int, OH = make_label2onehot(labels)
+        label2onehot = lambda label: OH[label2int.lookup(label)]
+        extractor_ds = self.extract_features(
+            config["datasets"],
+            feat_config,
+            datagroup_key,
+            False,
+            ds_config["input_shape"][-1] == 1,
+        )
+        dataset = tf_data.prepare_dataset_for_training(
+            extractor_ds,
+            ds_config,
+            feat_config,
+            label2onehot,
+            self.model_id,
+            verbosity=max(0, args.verbosity - 2),
+        )
+        for _ in dataset.take(warmup_batches):
+            pass
+        num_batches = num_samples = 0
+        with PeakMemorySampler() as memory:
+            begin = time.perf_counter()
+            for batch, *rest in dataset.take(max_batches):
+                num_batches += 1
+                num_samples += int(tf.shape(batch)[0])
+            duration = max(1e-9, time.perf_counter() - begin)
+        return {
+            "batches": num_batches,
+            "samples": num_samples,
+            "seconds": duration,
+            "samples_per_sec": num_samples / duration,
+            "batches_per_sec": num_batches / duration,
+            "memory_growth_mb": memory.growth_bytes * 1e-6,
+        }
+
+    def tune_pipeline(self):
+        args = self.args
+        self.model_id = self.experiment_config["experiment"]["name"]
+        tuning_config = self.experiment_config.get("pipeline_tuning")
+        if not tuning_config or not tuning_config.get("search_space"):
+            print("Error: experiment config has no 'pipeline_tuning.search_space', nothing to tune", file=sys.stderr)
+            return 1
+        max_batches = args.max_batches or tuning_config.get("max_batches", 100)
+        warmup_batches = tuning_config.get("warmup_batches", 5)
+        labels = self.resolve_labels()
+        trials = self.make_trials(tuning_config)
+        if args.verbosity:
+            print("Running {} pipeline trials with at most {} batches each".format(len(trials), max_batches))
+        results = []
+        for trial_num, overrides in enumerate(trials, start=1):
+            if args.verbosity > 1:
+                print("Trial {}/{} with overrides:".format(trial_num, len(trials)))
+                yaml_pprint(overrides)
+            result = self.run_trial(overrides, labels, max_batches, warmup_batches)
+            results.append((result, overrides))
+            print("trial {:3d}: {:10.1f} samples/s {:10.2f} batches/s {:10.1f} MB memory growth\t{}".format(
+                trial_num,
+                result["samples_per_sec"],
+                result["batches_per_sec"],
+                result["memory_growth_mb"],
+                json.dumps(overrides, sort_keys=True)))
+        best_result, best_overrides = max(results, key=lambda r: r[0]["samples_per_sec"])
+        best_config = {}
+        for key, value in best_overrides.items():
+            if value is not None:
+                set_dotted_key(best_config, key, value)
+        output_path = args.output or os.path.join(self.cache_dir, self.model_id, "pipeline_tuning", now_str() + ".yaml")
+        self.make_named_dir(os.path.dirname(output_path), "pipeline tuning")
+        with open(output_path, "w") as f:
+            yaml.dump({"overrides": best_config, "removed_keys": sorted(k for k, v in best_overrides.items() if v is None), "result": best_result}, f, indent=2)
+        print("Best trial: {:.1f} samples/s, {:.1f} MB memory growth, overrides:".format(best_result["samples_per_sec"], best_result["memory_growth_mb"]))
+        yaml_pprint(best_config)
+        print("Wrote best overrides to '{}'".format(output_path))
+
+    def run(self):
+        super().run()
+        return self.tune_pipeline()
+
+
+class Evaluate(E2EBase):
+    """
+    Evaluate predicted scores by minimum average detection cost (C_avg), equal error rate, precision, recall and a confusion matrix.
+    All metrics are computed with NumPy by sorting all scores once, see lidbox.evaluation.
+    """
+
+    @classmethod
+    def create_argparser(cls, parent_parser):
+        parser = super().create_argparser(parent_parser)
+        optional = parser.add_argument_group("evaluate options")
+        optional.add_argument("--scores",
+            type=str,
+            help="Path of a binary score store written by predict or score-embeddings, or a text scores file. Defaults to the score store of the predict command, or its text scores if there is no score store.")
+        optional.add_argument("--trials",
+            type=str,
+            help="Text trials file, required only with text scores. Binary score stores contain the trials implicitly.")
+        optional.add_argument("--score-separator", type=str, default=None)
+        optional.add_argument("--convert-scores", choices=("softmax", "exp", "none"), default=None)
+        optional.add_argument("--p-target", type=float, default=0.5)
+        return parser
+
+    def evaluate(self):
+        args = self.args
+        self.model_id = self.experiment_config["experiment"]["name"]
+        if not args.scores:
+            # The score store of the predict command, or the text scores from older versions of it
+            args.scores = os.path.join(self.cache_dir, self.model_id, "predictions", "score_store")
+            if not score_store.exists(args.scores):
+                args.scores = os.path.join(self.cache_dir, self.model_id, "predictions", "scores")
+        begin = time.perf_counter()
+        if score_store.exists(args.scores):
+            if args.verbosity > 1:
+                print("Evaluating minimum average detection cost using score store '{}'".format(args.scores))
+            scores, index = score_store.load(args.scores, mmap=False)
+            langs, uttids, utt_labels = list(index["langs"]), index["uttids"], index["labels"]
+        else:
+            if not args.trials:
+                args.trials = os.path.join(self.cache_dir, self.model_id, "predictions", "trials")
+            if args.verbosity > 1:
+                print("Evaluating minimum average detection cost using trials '{}' and text scores '{}'".format(args.trials, args.scores))
+            langs, uttids, scores = evaluation.read_text_scores(args.scores, args.score_separator)
+            utt2label = evaluation.read_text_trials(args.trials)
+            utt_labels = np.array([utt2label.get(utt, '') for utt in uttids])
+        scores = scores.astype(np.float64)
+        if args.verbosity > 1:
+            print("Loaded scores for {} utterances in {:.3f} s".format(len(uttids), time.perf_counter() - begin))
+        labels = evaluation.label_indexes(utt_labels, langs)
+        missing = labels < 0
+        if missing.any():
+            print("Warning: {} utterances have predicted scores but no target trial with a known language, skipping".format(np.count_nonzero(missing)), file=sys.stderr)
+            if args.verbosity > 2:
+                for utt in uttids[missing]:
+                    print(utt, file=sys.stderr)
+            scores, labels = scores[~missing], labels[~missing]
+        if args.convert_scores in ("softmax", "exp"):
+            print("Applying {} on scores".format(args.convert_scores))
+            scores = evaluation.convert_scores(scores, args.convert_scores)
+        if args.verbosity > 2 and args.convert_scores:
+            print("Asserting all scores sum to 1")
+            tolerance = 1e-3
+            not_one = np.abs(scores.sum(axis=1) - 1.0) > tolerance
+            assert not not_one.any(), "failed to convert log likelihoods to probabilities, the probabilities of predictions for {} utterances do not sum to 1".format(np.count_nonzero(not_one))
+        begin = time.perf_counter()
+        min_cavg, min_threshold = evaluation.min_average_detection_cost(scores, labels, p_target=args.p_target)
+        eers = evaluation.equal_error_rates(scores, labels)
+        # Now we know the threshold that minimizes C_avg and use the same threshold to compute all other metrics
+        precision, recall = evaluation.precision_recall(scores, labels, min_threshold)
+        confusion_matrix = evaluation.confusion_matrix(labels, scores.argmax(axis=1), len(langs))
+        if args.verbosity:
+            print("Computed all metrics for {} trials in {:.3f} s".format(scores.size, time.perf_counter() - begin))
+        def print_metric(name, value):
+            print("{:15s}\t{:.3f}".format(name + ":", value))
+        print("min C_avg at threshold {:.6f}".format(min_threshold))
+        print_metric("avg_C_avg", min_cavg)
+        for name, values in (("avg_EER", eers), ("avg_precision", precision), ("avg_recall", recall)):
+            print_metric(name, np.nanmean(values))
+        print("\nMetrics by target, using threshold {:.6f}".format(min_threshold))
+        for name, values in (("EER", eers), ("precision", precision), ("recall", recall)):
+            print(name)
+            for lang, value in zip(langs, values):
+                print_metric("{}_{}".format(name, lang), value)
+        print("\nConfusion matrix")
+        print(langs)
+        print(np.array_str(confusion_matrix))
+
+    def run(self):
+        super().run()
+        return self.evaluate()
 
 
 class Util(E2EBase):
     tasks = (
         "get_cache_checksum",
+        "cache_encoding_report",
     )
 
     @classmethod
@@ -792,6 +1676,11 @@ class Util(E2EBase):
             type=str,
             metavar="datagroup_key",
             help="For a given datagroup key, compute md5sum of config file in the same way as it would be computed when generating the filename for the features cache. E.g. for checking if the pipeline will be using the cache or start the feature extraction from scratch.")
+        optional.add_argument("--cache-encoding-report",
+            type=str,
+            metavar="datagroup_key",
+            help="Extract features from a given datagroup (use --file-limit for a subset), encode and decode them with every reduced precision cache encoding and print the reconstruction error and storage size compared to float32.")
+        parser.set_defaults(shuffle_utt2path=False)
         return parser
 
     def get_cache_checksum(self):
@@ -804,11 +1693,50 @@ class Util(E2EBase):
         print("cache md5 checksum for datagroup key '{}' is:".format(datagroup_key))
         print(conf_checksum)
 
+    def cache_encoding_report(self):
+        args = self.args
+        datagroup_key = args.cache_encoding_report
+        feat_config = self.experiment_config["features"]
+        extractor_ds = self.extract_features(self.experiment_config["datasets"], json.loads(json.dumps(feat_config)), datagroup_key, False, False)
+        encodings = [e for e in tf_data.CACHE_ENCODINGS if e != "float32"]
+        num_values = 0
+        sum_squares = 0.0
+        sum_squared_errors = collections.Counter()
+        max_abs_errors = collections.Counter()
+        encoded_bytes = collections.Counter()
+        for i, (feats, meta) in enumerate(extractor_ds, start=1):
+            num_values += int(tf.size(feats))
+            sum_squares += float(tf.math.reduce_sum(tf.math.square(feats)))
+            for encoding in encodings:
+                encoded, scale, offset = tf_data.encode_features(feats, encoding)
+                error = tf_data.decode_features(encoded, scale, offset) - feats
+                sum_squared_errors[encoding] += float(tf.math.reduce_sum(tf.math.square(error)))
+                max_abs_errors[encoding] = max(max_abs_errors[encoding], float(tf.math.reduce_max(tf.math.abs(error))))
+                encoded_bytes[encoding] += int(tf.size(encoded)) * encoded.dtype.size
+                if encoding in tf_data.AFFINE_CACHE_ENCODINGS:
+                    # Scale and offset as float32
+                    encoded_bytes[encoding] += 8
+            if args.verbosity > 1 and i % 1000 == 0:
+                print(i, "utterances done")
+        if not num_values:
+            print("Error: no features extracted from datagroup '{}'".format(datagroup_key), file=sys.stderr)
+            return 1
+        print("{:10s}{:>14s}{:>14s}{:>12s}{:>14s}".format("encoding", "max abs err", "rmse", "snr dB", "size ratio"))
+        for encoding in encodings:
+            rmse = np.sqrt(sum_squared_errors[encoding] / num_values)
+            snr_db = 10 * np.log10(max(1e-30, sum_squares) / max(1e-30, sum_squared_errors[encoding]))
+            print("{:10s}{:14.6f}{:14.6f}{:12.2f}{:14.3f}".format(
+                encoding,
+                max_abs_errors[encoding],
+                rmse,
+                snr_db,
+                encoded_bytes[encoding] / (4 * num_values)))
+
     def run(self):
         super().run()
         return self.run_tasks()
 
 
 command_tree = [
-    (E2E, [Train, Predict, Util]),
+    (E2E, [Train, Predict, PredictChunks, ExtractEmbeddings, ScoreEmbeddings, ExportSavedModel, ExportTFLite, TunePipeline, Evaluate, Util]),
 ]
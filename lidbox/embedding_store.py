@@ -0,0 +1,62 @@
+"""
+Memory mapped store of fixed size embeddings.
+All embeddings are stored as rows of one flat float32 file and the utterance ids and labels of the rows are stored in an index next to it,
+so that back-ends can read any subset of embeddings without parsing.
+"""
+import os
+
+import numpy as np
+
+
+def data_path(path):
+    return path + ".data"
+
+def index_path(path):
+    return path + ".index.npz"
+
+def exists(path):
+    return os.path.exists(data_path(path)) and os.path.exists(index_path(path))
+
+def write(batches, path, verbosity=0):
+    """
+    Write all (embeddings, uttids, labels) batches into an embedding store at path, where embeddings has shape (batch_size, embedding_dim).
+    The data and index files are written into temporary files and renamed when complete.
+    """
+    uttids, labels = [], []
+    dim = None
+    tmp_data_path = data_path(path) + ".tmp"
+    with open(tmp_data_path, "wb") as data_f:
+        for embeddings, batch_uttids, batch_labels in batches:
+            embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+            assert embeddings.ndim == 2, "embeddings must have shape (batch_size, embedding_dim), not {}".format(embeddings.shape)
+            if dim is None:
+                dim = embeddings.shape[1]
+            assert embeddings.shape[1] == dim, "all embeddings must have dimension {}, got {}".format(dim, embeddings.shape[1])
+            data_f.write(embeddings.tobytes())
+            uttids.extend(batch_uttids)
+            labels.extend(batch_labels)
+            if verbosity > 1 and len(uttids) % 10000 < len(batch_uttids):
+                print(len(uttids), "embeddings written")
+    assert dim is not None, "cannot write an empty embedding store"
+    tmp_index_path = index_path(path) + ".tmp.npz"
+    np.savez(
+        tmp_index_path,
+        uttids=np.array(uttids),
+        labels=np.array(labels),
+        dim=np.array(dim, dtype=np.int64))
+    os.replace(tmp_data_path, data_path(path))
+    os.replace(tmp_index_path, index_path(path))
+    if verbosity:
+        print("Wrote {} embeddings of dimension {} into embedding store '{}'".format(len(uttids), dim, path))
+
+def load_index(path):
+    with np.load(index_path(path)) as index:
+        return {k: index[k] for k in index.files}
+
+def load(path):
+    """Returns a read-only memory mapped array of all embeddings with shape (num_embeddings, embedding_dim) and the index as a dict of arrays."""
+    index = load_index(path)
+    dim = int(index["dim"])
+    embeddings = np.memmap(data_path(path), dtype=np.float32, mode="r").reshape((-1, dim))
+    assert embeddings.shape[0] == index["uttids"].size, "embedding store '{}' has {} embeddings but {} utterance ids".format(path, embeddings.shape[0], index["uttids"].size)
+    return embeddings, index
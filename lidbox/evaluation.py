@@ -0,0 +1,111 @@
+"""
+Language detection metrics computed with NumPy from score matrices of shape (num_utterances, num_languages) and true language indexes of shape (num_utterances,).
+Metrics at all score thresholds are computed by sorting the scores once and accumulating counts, so evaluation is O(N log N) in the amount of trials.
+"""
+import numpy as np
+
+
+def convert_scores(scores, conversion):
+    if conversion == "softmax":
+        exp = np.exp(scores - scores.max(axis=1, keepdims=True))
+        return exp / exp.sum(axis=1, keepdims=True)
+    if conversion == "exp":
+        return np.exp(scores)
+    return scores
+
+def threshold_boundaries(sorted_scores):
+    """
+    Indexes k of all distinct thresholds, where threshold k rejects all trials with scores sorted_scores[:k] and accepts the rest.
+    Trials with equal scores are always on the same side of a threshold.
+    """
+    return np.flatnonzero(np.r_[True, sorted_scores[1:] != sorted_scores[:-1], True])
+
+def detection_costs(scores, labels, p_target=0.5, c_miss=1.0, c_fa=1.0):
+    """
+    Average detection cost C_avg as defined in the NIST language recognition evaluations, at every distinct threshold of all scores.
+    Languages without any target trials are not used as target or non-target languages.
+    Returns the thresholds and the C_avg values at those thresholds, where a trial is accepted if its score is at least the threshold.
+    """
+    num_utts, num_langs = scores.shape
+    counts = np.bincount(labels, minlength=num_langs).astype(np.float64)
+    langs = np.flatnonzero(counts)
+    assert langs.size > 1, "C_avg requires target trials for at least 2 languages"
+    is_target = labels[:, np.newaxis] == langs[np.newaxis, :]
+    # Weight of each trial in C_avg, if it is a miss (targets) or a false alarm (non-targets)
+    miss_weights = np.where(is_target, c_miss * p_target / counts[langs][np.newaxis, :], 0.0)
+    fa_weights = np.where(is_target, 0.0, c_fa * (1.0 - p_target) / ((langs.size - 1) * counts[labels][:, np.newaxis]))
+    flat_scores = scores[:, langs].ravel()
+    order = np.argsort(flat_scores, kind="mergesort")
+    sorted_scores = flat_scores[order]
+    cum_miss = np.r_[0.0, np.cumsum(miss_weights.ravel()[order])]
+    cum_fa = np.r_[0.0, np.cumsum(fa_weights.ravel()[order])]
+    costs = (cum_miss + cum_fa[-1] - cum_fa) / langs.size
+    k = threshold_boundaries(sorted_scores)
+    thresholds = np.r_[sorted_scores, np.inf][k]
+    return thresholds, costs[k]
+
+def min_average_detection_cost(scores, labels, **cost_kwargs):
+    """Minimum C_avg over all thresholds and the threshold that gives it."""
+    thresholds, costs = detection_costs(scores, labels, **cost_kwargs)
+    i = np.argmin(costs)
+    return costs[i], thresholds[i]
+
+def equal_error_rates(scores, labels):
+    """Equal error rate of each language, using all trials of that language as targets and all other trials as non-targets, NaN for languages without targets or non-targets."""
+    num_utts, num_langs = scores.shape
+    eers = np.full(num_langs, np.nan)
+    for lang in range(num_langs):
+        is_target = labels == lang
+        num_targets = np.count_nonzero(is_target)
+        num_nontargets = num_utts - num_targets
+        if not num_targets or not num_nontargets:
+            continue
+        order = np.argsort(scores[:, lang], kind="mergesort")
+        sorted_targets = is_target[order]
+        k = threshold_boundaries(scores[order, lang])
+        p_miss = np.r_[0, np.cumsum(sorted_targets)][k] / num_targets
+        p_fa = 1.0 - np.r_[0, np.cumsum(~sorted_targets)][k] / num_nontargets
+        i = np.argmin(np.abs(p_miss - p_fa))
+        eers[lang] = (p_miss[i] + p_fa[i]) / 2
+    return eers
+
+def precision_recall(scores, labels, threshold):
+    """Precision and recall of each language when all trials with a score of at least threshold are accepted."""
+    num_langs = scores.shape[1]
+    is_target = labels[:, np.newaxis] == np.arange(num_langs)[np.newaxis, :]
+    accepted = scores >= threshold
+    true_positives = np.count_nonzero(accepted & is_target, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = true_positives / np.count_nonzero(accepted, axis=0)
+        recall = true_positives / np.count_nonzero(is_target, axis=0)
+    return precision, recall
+
+def confusion_matrix(labels, predictions, num_labels):
+    """Confusion matrix with true labels as rows and predicted labels as columns."""
+    return np.bincount(labels * num_labels + predictions, minlength=num_labels * num_labels).reshape((num_labels, num_labels))
+
+def read_text_scores(path, separator=None):
+    """Read scores written by the predict command, returns (languages, utterance ids, scores)."""
+    with open(path) as f:
+        langs = f.readline().split()
+        text = f.read()
+    if separator and not separator.isspace():
+        text = text.replace(separator, ' ')
+    tokens = np.array(text.split()).reshape((-1, len(langs) + 1))
+    return langs, tokens[:, 0], tokens[:, 1:].astype(np.float64)
+
+def read_text_trials(path):
+    """Read a trials file with lines 'language utterance_id target|nontarget', returns a dict of utterance ids to their target languages."""
+    with open(path) as f:
+        tokens = np.array(f.read().split()).reshape((-1, 3))
+    targets = tokens[:, 2] == "target"
+    return dict(zip(tokens[targets, 1], tokens[targets, 0]))
+
+def label_indexes(labels, langs):
+    """Index of each string in labels in the list langs, or -1 if it is not in langs."""
+    langs = np.asarray(langs, dtype=str)
+    labels = np.asarray(labels, dtype=str)
+    order = np.argsort(langs)
+    pos = np.minimum(np.searchsorted(langs, labels, sorter=order), langs.size - 1)
+    indexes = order[pos]
+    return np.where(langs[indexes] == labels, indexes, -1)
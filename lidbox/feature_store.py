@@ -0,0 +1,108 @@
+"""
+Random access feature store for extracted features.
+All features are appended into one flat binary file and an index of per-utterance element offsets and frame counts is stored next to it.
+Reads are done by offset from a memory mapped data file, so a dataset can shuffle the tiny index globally every epoch instead of buffering feature tensors.
+"""
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from lidbox.tf_data import TF_AUTOTUNE, decode_features, encode_cached_features
+
+
+def data_path(path):
+    return path + ".data"
+
+def index_path(path):
+    return path + ".index.npz"
+
+def exists(path):
+    return os.path.exists(data_path(path)) and os.path.exists(index_path(path))
+
+def write(ds, path, encoding="float32", verbosity=0):
+    """
+    Write all (features, meta) elements of ds into a feature store at path, where meta[0] is the utterance id and meta[1] the label.
+    Features are stored with the given lidbox.tf_data cache encoding and the per-utterance scales and offsets are stored in the index.
+    The data and index files are written into temporary files and renamed when complete, so an interrupted write never leaves a partial store behind.
+    """
+    offsets, num_frames, scales, feat_offsets, uttids, labels = [], [], [], [], [], []
+    offset = 0
+    feature_shape = None
+    dtype = None
+    assert not isinstance(ds.element_spec[0], dict), "feature store supports only one feature type per store"
+    tmp_data_path = data_path(path) + ".tmp"
+    with open(tmp_data_path, "wb") as data_f:
+        for i, ((feats, scale, feat_offset), meta) in enumerate(encode_cached_features(ds, encoding).as_numpy_iterator(), start=1):
+            if feature_shape is None:
+                feature_shape = feats.shape[1:]
+                dtype = feats.dtype
+            assert feats.shape[1:] == feature_shape, "all features in a feature store must have equal shapes after the time dimension, expected {} but got {}".format(feature_shape, feats.shape[1:])
+            data_f.write(np.ascontiguousarray(feats, dtype=dtype).tobytes())
+            offsets.append(offset)
+            num_frames.append(feats.shape[0])
+            scales.append(scale)
+            feat_offsets.append(feat_offset)
+            uttids.append(meta[0].decode("utf-8"))
+            labels.append(meta[1].decode("utf-8"))
+            offset += feats.size
+            if verbosity > 1 and i % 10000 == 0:
+                print(i, "utterances written to feature store")
+    assert feature_shape is not None, "cannot write an empty feature store"
+    tmp_index_path = index_path(path) + ".tmp.npz"
+    np.savez(
+        tmp_index_path,
+        offsets=np.array(offsets, dtype=np.int64),
+        num_frames=np.array(num_frames, dtype=np.int64),
+        scales=np.array(scales, dtype=np.float32),
+        feat_offsets=np.array(feat_offsets, dtype=np.float32),
+        uttids=np.array(uttids),
+        labels=np.array(labels),
+        feature_shape=np.array(feature_shape, dtype=np.int64),
+        dtype=np.array(np.dtype(dtype).str))
+    os.replace(tmp_data_path, data_path(path))
+    os.replace(tmp_index_path, index_path(path))
+    if verbosity:
+        print("Wrote {} utterances with {} frames of shape {} into feature store '{}'".format(len(offsets), sum(num_frames), feature_shape, path))
+
+def load_index(path):
+    with np.load(index_path(path)) as index:
+        return {k: index[k] for k in index.files}
+
+def load(path, shuffle=True, balance_labels=False, seed=None, num_parallel_calls=TF_AUTOTUNE):
+    """
+    Load a feature store as a tf.data.Dataset of (features, (uttid, label)) elements.
+    If shuffle is True, the utterance index is shuffled globally every epoch.
+    If balance_labels is True, utterances are drawn from all labels with equal probability, which produces an infinite dataset.
+    """
+    index = load_index(path)
+    offsets, num_frames = index["offsets"], index["num_frames"]
+    feature_shape = tuple(int(d) for d in index["feature_shape"])
+    dtype = np.dtype(str(index["dtype"]))
+    frame_size = int(np.prod(feature_shape))
+    data = np.memmap(data_path(path), dtype=dtype, mode="r")
+    def read_features(i):
+        begin = offsets[i]
+        return np.array(data[begin:begin + num_frames[i] * frame_size]).reshape((num_frames[i], *feature_shape))
+    num_utts = offsets.size
+    if balance_labels:
+        label_indices = [
+            tf.data.Dataset.from_tensor_slices(np.flatnonzero(index["labels"] == label).astype(np.int64))
+                .shuffle(num_utts, seed=seed, reshuffle_each_iteration=True)
+                .repeat()
+            for label in np.unique(index["labels"])]
+        indices = tf.data.experimental.sample_from_datasets(label_indices, seed=seed)
+    else:
+        indices = tf.data.Dataset.range(num_utts)
+        if shuffle:
+            indices = indices.shuffle(num_utts, seed=seed, reshuffle_each_iteration=True)
+    scales = tf.constant(index["scales"], tf.float32)
+    feat_offsets = tf.constant(index["feat_offsets"], tf.float32)
+    uttids = tf.constant(index["uttids"], tf.string)
+    labels = tf.constant(index["labels"], tf.string)
+    def read(i):
+        encoded = tf.numpy_function(read_features, [i], tf.as_dtype(dtype))
+        encoded.set_shape([None, *feature_shape])
+        feats = decode_features(encoded, tf.gather(scales, i), tf.gather(feat_offsets, i))
+        return feats, (tf.gather(uttids, i), tf.gather(labels, i))
+    return indices.map(read, num_parallel_calls=num_parallel_calls)
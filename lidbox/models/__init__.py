@@ -1,14 +1,21 @@
 import datetime
 import functools
+import hashlib
 import importlib
 import io
 import os
+import queue
+import shutil
 import sys
+import tempfile
+import threading
 
+import h5py
 import numpy as np
 import tensorflow as tf
 
 from lidbox.tf_data import without_metadata
+import lidbox.activation_cache as activation_cache
 
 # Check if the KerasWrapper instance has a tf.device string argument and use that when running the method, else let tf decide
 def with_device(method):
@@ -36,6 +43,30 @@ def get_best_checkpoint(checkpoints, key="epoch", mode=None):
         elif mode == "max":
             return max(checkpoints, key=lambda p: float(key_fn(p)))
 
+def split_model(model, layer_name):
+    """
+    Split a functional model into a backbone that outputs the activations of layer layer_name and a head that contains all layers after it.
+    The layers after layer_name must form a single chain.
+    The head shares its layers with model, so training the head also trains those layers in model.
+    """
+    split_layer = model.get_layer(layer_name)
+    backbone = tf.keras.Model(inputs=model.input, outputs=split_layer.output, name=model.name + "_backbone")
+    head_inputs = tf.keras.Input(shape=split_layer.output.shape[1:], name=layer_name + "_activations")
+    x = head_inputs
+    previous = split_layer
+    for layer in model.layers[model.layers.index(split_layer) + 1:]:
+        assert layer.input.name == previous.output.name, "cannot split model '{}' at layer '{}', layer '{}' does not take the output of '{}' as input".format(model.name, layer_name, layer.name, previous.name)
+        x = layer(x)
+        previous = layer
+    head = tf.keras.Model(inputs=head_inputs, outputs=x, name=model.name + "_head")
+    return backbone, head
+
+def weights_checksum(model):
+    md5 = hashlib.md5()
+    for w in model.get_weights():
+        md5.update(np.ascontiguousarray(w).tobytes())
+    return md5.hexdigest()
+
 def parse_metrics(metrics, target_names):
     keras_metrics = []
     for m in metrics:
@@ -57,6 +88,164 @@ class EpochModelCheckpoint(tf.keras.callbacks.Callback):
             self.model.save(self.checkpoint_path.format(epoch=epoch, **logs))
 
 
+class AsyncModelCheckpoint(tf.keras.callbacks.Callback):
+    """
+    Checkpoint callback that never blocks training on file I/O.
+    At the end of each epoch, the weights are copied into host memory and a background thread writes them as a Keras HDF5 weights file into local_dir,
+    then copies the file into the checkpoint directory through a temporary file and an atomic rename, so the checkpoint directory never contains partial files.
+    At most max_queue_size snapshots wait for the writer, if the queue is full the oldest waiting snapshot that is not the best checkpoint according to monitor is dropped.
+    The best checkpoint is never dropped, if no other snapshot is waiting, training blocks until the writer has room for the new snapshot.
+    If max_to_keep is given, only the max_to_keep most recent checkpoints written by this callback and the best checkpoint according to monitor are kept.
+    The files can be loaded with load_weights like checkpoints written by ModelCheckpoint.
+    If local_dir is not given, a temporary staging directory is used and removed at the end of training.
+    """
+    def __init__(self, filepath, monitor="val_loss", mode="auto", save_best_only=False, local_dir=None, max_queue_size=2, max_to_keep=None, verbose=0, **kwargs):
+        super().__init__()
+        assert not kwargs, "unsupported AsyncModelCheckpoint options: {}, weights are always written as HDF5 files at the end of every epoch".format(', '.join(sorted(kwargs)))
+        assert os.path.splitext(filepath)[1] in (".h5", ".hdf5"), "AsyncModelCheckpoint writes HDF5 files, the checkpoint filepath must end with .h5 or .hdf5, not '{}'".format(filepath)
+        self.filepath = filepath
+        self.monitor = monitor
+        if mode == "auto":
+            mode = "max" if "acc" in monitor else "min"
+        assert mode in ("min", "max"), "unknown mode '{}'".format(mode)
+        self.is_better = (lambda a, b: a < b) if mode == "min" else (lambda a, b: a > b)
+        self.save_best_only = save_best_only
+        self.owns_local_dir = local_dir is None
+        self.local_dir = local_dir or os.path.join(tempfile.gettempdir(), "lidbox-checkpoints-{}".format(os.getpid()))
+        self.max_to_keep = max_to_keep
+        self.verbose = verbose
+        self.best_value = None
+        self.best_path = None
+        # best_path is written by the training thread and read by the writer thread
+        self.best_path_lock = threading.Lock()
+        self.written = []
+        self.num_dropped = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.writer = None
+
+    def snapshot(self):
+        """Names and host memory copies of all weights, in the order expected by load_weights for Keras HDF5 files."""
+        layers = []
+        for layer in self.model.layers:
+            weights = layer.trainable_weights + layer.non_trainable_weights
+            layers.append((layer.name, [w.name for w in weights], tf.keras.backend.batch_get_value(weights)))
+        return layers
+
+    @staticmethod
+    def write_weights(path, layers):
+        with h5py.File(path, "w") as f:
+            f.attrs["layer_names"] = [name.encode("utf-8") for name, _, _ in layers]
+            f.attrs["backend"] = b"tensorflow"
+            f.attrs["keras_version"] = str(tf.keras.__version__).encode("utf-8")
+            for layer_name, weight_names, values in layers:
+                group = f.create_group(layer_name)
+                group.attrs["weight_names"] = [name.encode("utf-8") for name in weight_names]
+                for name, value in zip(weight_names, values):
+                    group.create_dataset(name, data=value)
+
+    def write(self, path, layers):
+        local_path = os.path.join(self.local_dir, os.path.basename(path))
+        try:
+            self.write_weights(local_path, layers)
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            tmp_path = "{}.tmp-{}".format(path, os.getpid())
+            shutil.copyfile(local_path, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(local_path):
+                os.remove(local_path)
+        if self.verbose:
+            print("Wrote checkpoint '{}'".format(path))
+
+    def apply_retention(self, path):
+        if path not in self.written:
+            self.written.append(path)
+        if not self.max_to_keep:
+            return
+        with self.best_path_lock:
+            best_path = self.best_path
+        removable = [p for p in self.written[:-self.max_to_keep] if p != best_path]
+        for p in removable:
+            self.written.remove(p)
+            if os.path.exists(p):
+                os.remove(p)
+                if self.verbose:
+                    print("Removed old checkpoint '{}'".format(p))
+
+    def write_queued(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                path, layers = item
+                self.write(path, layers)
+                self.apply_retention(path)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def drop_oldest_waiting(self):
+        """Remove the oldest waiting snapshot that is not the best checkpoint from the queue and return its path, or None if there is no such snapshot."""
+        with self.best_path_lock:
+            best_path = self.best_path
+        with self.queue.mutex:
+            for item in self.queue.queue:
+                if item[0] != best_path:
+                    self.queue.queue.remove(item)
+                    self.queue.unfinished_tasks -= 1
+                    self.queue.not_full.notify()
+                    return item[0]
+        return None
+
+    def raise_writer_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("background checkpoint writer failed") from error
+
+    def on_train_begin(self, logs=None):
+        os.makedirs(self.local_dir, exist_ok=True)
+        if self.writer is None or not self.writer.is_alive():
+            self.writer = threading.Thread(target=self.write_queued, name="AsyncModelCheckpoint", daemon=True)
+            self.writer.start()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.raise_writer_error()
+        logs = logs or {}
+        value = logs.get(self.monitor)
+        is_best = value is not None and (self.best_value is None or self.is_better(value, self.best_value))
+        if self.save_best_only and not is_best:
+            return
+        path = self.filepath.format(epoch=epoch + 1, **logs)
+        if is_best:
+            self.best_value = value
+            with self.best_path_lock:
+                self.best_path = path
+        item = path, self.snapshot()
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                break
+            except queue.Full:
+                dropped_path = self.drop_oldest_waiting()
+                if dropped_path is None:
+                    # Only the best checkpoint is waiting, wait for the writer instead of dropping it
+                    self.queue.put(item)
+                    break
+                self.num_dropped += 1
+                print("Warning: checkpoint writer is falling behind, dropped checkpoint '{}'".format(dropped_path), file=sys.stderr)
+
+    def on_train_end(self, logs=None):
+        """Wait until all queued checkpoints have been written and remove the temporary staging directory."""
+        self.queue.put(None)
+        self.writer.join()
+        if self.owns_local_dir:
+            shutil.rmtree(self.local_dir, ignore_errors=True)
+        self.raise_writer_error()
+
+
 class LearningRateDateLogger(tf.keras.callbacks.Callback):
     def __init__(self, output_stream=sys.stdout, **kwargs):
         self.output_stream = output_stream
@@ -72,6 +261,39 @@ class LearningRateDateLogger(tf.keras.callbacks.Callback):
             output_stream=self.output_stream)
 
 
+class FullModelCallback(tf.keras.callbacks.Callback):
+    """
+    Forwards all hooks to callback, but gives it full_model instead of the model being fit.
+    E.g. checkpoint callbacks save all weights of full_model while only a head that shares its layers with full_model is being trained.
+    """
+    def __init__(self, callback, full_model):
+        super().__init__()
+        self.callback = callback
+        self.full_model = full_model
+
+    def set_params(self, params):
+        super().set_params(params)
+        self.callback.set_params(params)
+
+    def set_model(self, model):
+        super().set_model(model)
+        self.callback.set_model(self.full_model)
+
+for _hook in (
+        "on_batch_begin", "on_batch_end",
+        "on_epoch_begin", "on_epoch_end",
+        "on_train_batch_begin", "on_train_batch_end",
+        "on_test_batch_begin", "on_test_batch_end",
+        "on_predict_batch_begin", "on_predict_batch_end",
+        "on_train_begin", "on_train_end",
+        "on_test_begin", "on_test_end",
+        "on_predict_begin", "on_predict_end"):
+    setattr(FullModelCallback, _hook, lambda self, *args, _hook=_hook, **kwargs: getattr(self.callback, _hook)(*args, **kwargs))
+
+
+CHECKPOINT_CALLBACKS = (tf.keras.callbacks.ModelCheckpoint, EpochModelCheckpoint, AsyncModelCheckpoint)
+
+
 class KerasWrapper:
 
     @classmethod
@@ -96,7 +318,11 @@ class KerasWrapper:
             if "epoch_interval" in checkpoints:
                 # This is for saving checkpoints at regular epoch intervals, regardless of the values that ModelCheckpoint is monitoring
                 self.callbacks.append(EpochModelCheckpoint(checkpoints.pop("epoch_interval"), checkpoints["filepath"]))
-            self.callbacks.append(tf.keras.callbacks.ModelCheckpoint(**checkpoints))
+            if checkpoints.pop("async", False):
+                # Write checkpoints from a background thread, see AsyncModelCheckpoint for the extra options
+                self.callbacks.append(AsyncModelCheckpoint(**checkpoints))
+            else:
+                self.callbacks.append(tf.keras.callbacks.ModelCheckpoint(**checkpoints))
         for cb in other_callbacks:
             if hasattr(sys.modules[__name__], cb["cls"]):
                 cb_class = getattr(sys.modules[__name__], cb["cls"])
@@ -131,11 +357,12 @@ class KerasWrapper:
             metrics = parse_metrics(training_config["metrics"], target_names)
         else:
             metrics = None
-        self.model.compile(
-            loss=loss,
-            optimizer=optimizer,
-            metrics=metrics,
-        )
+        self.compile_kwargs = {
+            "loss": loss,
+            "optimizer": optimizer,
+            "metrics": metrics,
+        }
+        self.model.compile(**self.compile_kwargs)
 
     @with_device
     def load_weights(self, path):
@@ -143,7 +370,9 @@ class KerasWrapper:
         self.model.load_weights(path)
 
     @with_device
-    def fit(self, training_set, validation_set, model_config):
+    def fit(self, training_set, validation_set, model_config, dataset_checksums=None):
+        if "frozen_backbone" in model_config:
+            return self.fit_head(training_set, validation_set, model_config, dataset_checksums)
         return self.model.fit(
             without_metadata(training_set),
             callbacks=self.callbacks,
@@ -158,10 +387,63 @@ class KerasWrapper:
             verbose=model_config.get("verbose", 2),
         )
 
+    @with_device
+    def fit_head(self, training_set, validation_set, model_config, dataset_checksums):
+        """
+        Train only the layers after the frozen backbone layer frozen_backbone.layer.
+        The backbone is run once over both datasets and its outputs are cached into frozen_backbone.cache_dir,
+        under a checksum of the backbone weights and the checksums of the feature and dataset configs in dataset_checksums, with keys 'train' and 'validation',
+        and all epochs are trained from the cached activations.
+        Training sets that repeat infinitely must be limited with frozen_backbone.num_batches.
+        """
+        assert dataset_checksums and set(dataset_checksums) >= {"train", "validation"}, "training from cached backbone activations requires the dataset checksums of the training and validation sets"
+        conf = model_config["frozen_backbone"]
+        backbone, head = split_model(self.model, conf["layer"])
+        backbone.trainable = False
+        head.compile(**self.compile_kwargs)
+        cache_dir = os.path.join(conf["cache_dir"], weights_checksum(backbone))
+        cached = {}
+        for key, ds in (("train", training_set), ("validation", validation_set)):
+            path = os.path.join(cache_dir, key, dataset_checksums[key])
+            if key == "train" and "num_batches" in conf:
+                path += "-{}batches".format(conf["num_batches"])
+            if not activation_cache.is_complete(path):
+                ds = without_metadata(ds)
+                if key == "train" and "num_batches" in conf:
+                    ds = ds.take(conf["num_batches"])
+                activation_cache.write(backbone, ds, path, batches_per_shard=conf.get("batches_per_shard", 100))
+            cached[key] = activation_cache.load(path, shuffle_buffer=conf.get("shuffle_buffer", 0) if key == "train" else 0)
+        if model_config.get("steps_per_epoch"):
+            cached["train"] = cached["train"].repeat()
+        # Checkpoint callbacks are given the full model, so checkpoints contain the backbone weights too and can be loaded into self.model
+        callbacks = [FullModelCallback(cb, self.model) if isinstance(cb, CHECKPOINT_CALLBACKS) else cb for cb in self.callbacks]
+        return head.fit(
+            cached["train"],
+            callbacks=callbacks,
+            class_weight=model_config.get("class_weight"),
+            epochs=model_config["epochs"],
+            initial_epoch=self.initial_epoch,
+            shuffle=False,
+            steps_per_epoch=model_config.get("steps_per_epoch"),
+            validation_data=cached["validation"],
+            validation_freq=model_config.get("validation_freq", 1),
+            validation_steps=model_config.get("validation_steps"),
+            verbose=model_config.get("verbose", 2),
+        )
+
+    @with_device
+    def embedding_extractor(self, layer_name):
+        """Model from the inputs of the wrapped model to the outputs of its layer layer_name, e.g. 'segment1' in xvector or 'embedding' in convnet_extractor."""
+        return tf.keras.Model(inputs=self.model.input, outputs=self.model.get_layer(layer_name).output, name="{}_{}".format(self.model.name, layer_name))
+
     @with_device
     def predict(self, testset):
         return self.predict_fn(self.model, testset)
 
+    @with_device
+    def predict_on_batch(self, batch):
+        return self.model.predict_on_batch(batch)
+
     @with_device
     def count_params(self):
         return sum(layer.count_params() for layer in self.model.layers)
@@ -16,6 +16,7 @@ from tensorflow.keras.layers import (
     Input,
     Layer,
     LSTM,
+    Masking,
     Multiply,
     Reshape,
 )
@@ -43,9 +44,12 @@ def frequency_attention(H, d_a=64, d_f=16):
     return H_weighted
 
 
-def loader(input_shape, num_outputs, output_activation="log_softmax", use_attention=False, use_conv2d=False, use_lstm=False):
+def loader(input_shape, num_outputs, output_activation="log_softmax", use_attention=False, use_conv2d=False, use_lstm=False, masked=False, mask_value=0.0):
     inputs = Input(shape=input_shape, name="input")
     x = inputs
+    if masked:
+        assert not (use_attention or use_conv2d), "masked inputs are not supported with the reshaping layers of use_attention or use_conv2d"
+        x = Masking(mask_value=mask_value, name="input_mask")(x)
     x = GaussianNoise(stddev=0.01, name="input_noise")(x)
     x = Dropout(rate=0.4, noise_shape=(None, 1, input_shape[1]), name="channel_dropout")(x)
     if use_conv2d:
@@ -7,10 +7,13 @@ See also https://github.com/ChangsongYu/Eusipco2018_Google_AudioSet.git
 """
 from tensorflow.keras.layers import (
     Activation,
+    BatchNormalization,
     Concatenate,
     Dense,
+    Dropout,
     Input,
     Layer,
+    Masking,
 )
 from tensorflow.keras.models import Model
 import tensorflow as tf
@@ -20,16 +23,23 @@ class Attention(Layer):
     def __init__(self, num_units, name="attention"):
         super().__init__(name=name)
         self.fc = Dense(num_units, name=name + "_input")
+        self.supports_masking = True
 
-    def call(self, inputs):
+    def call(self, inputs, mask=None):
         x = self.fc(inputs)
         query = tf.nn.softmax(x)
         query = tf.clip_by_value(query, 1e-7, 1.0 - 1e-7)
+        if mask is not None:
+            # Masked steps get zero attention weight
+            query *= tf.expand_dims(tf.cast(mask, query.dtype), -1)
         query /= tf.math.reduce_sum(query, axis=1, keepdims=True)
         value = tf.nn.sigmoid(x)
         attention = tf.math.reduce_sum(query * value, axis=1)
         return attention
 
+    def compute_mask(self, inputs, mask=None):
+        return None
+
     def get_config(self):
         config = [("num_units", self.fc.units)]
         return dict(list(super().get_config()) + config)
@@ -46,6 +56,7 @@ class DenseBlock(Layer):
         self.bn = BatchNormalization(name=name + "_bn")
         self.relu = Activation("relu", name=name + "_relu")
         self.dropout = Dropout(dropout_rate, name=name + "_dropout")
+        self.supports_masking = True
 
     def call(self, inputs, training=None):
         x = self.fc(inputs)
@@ -62,9 +73,11 @@ class DenseBlock(Layer):
         return cls(**config)
 
 
-def loader(input_shape, num_outputs, output_activation="softmax", L=2, H=512):
+def loader(input_shape, num_outputs, output_activation="softmax", L=2, H=512, masked=False, mask_value=0.0):
     inputs = Input(shape=input_shape, name="input")
     x = inputs
+    if masked:
+        x = Masking(mask_value=mask_value, name="input_mask")(x)
     attention_outputs = []
     for level in range(1, L + 1):
         # Each DenseBlock here corresponds to "embedded mapping" in Yu's paper
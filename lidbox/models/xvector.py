@@ -12,22 +12,64 @@ from tensorflow.keras.layers import (
     Dropout,
     Input,
     Layer,
+    Masking,
 )
 from tensorflow.keras.models import Model
 import tensorflow as tf
 
+from lidbox.models import split_model
+
+
+def masked_batch_normalization(batch_norm, x, weights, training=None):
+    """
+    Apply the BatchNormalization layer batch_norm on x, but compute the batch statistics and update the moving statistics only over frames where weights is 1.
+    weights must be broadcastable to x, e.g. shape (batch, steps, 1) for inputs of shape (batch, steps, channels).
+    """
+    if not batch_norm.built:
+        batch_norm.build(x.shape)
+    if training is None:
+        training = tf.keras.backend.learning_phase()
+    def normalize_with_batch_stats():
+        mean, variance = tf.nn.weighted_moments(x, axes=[0, 1], frequency_weights=weights)
+        momentum = batch_norm.momentum
+        batch_norm.moving_mean.assign(momentum * batch_norm.moving_mean + (1.0 - momentum) * mean)
+        batch_norm.moving_variance.assign(momentum * batch_norm.moving_variance + (1.0 - momentum) * variance)
+        return tf.nn.batch_normalization(x, mean, variance, batch_norm.beta, batch_norm.gamma, batch_norm.epsilon)
+    def normalize_with_moving_stats():
+        return batch_norm(x, training=False)
+    if isinstance(training, (bool, int)):
+        return normalize_with_batch_stats() if training else normalize_with_moving_stats()
+    return tf.cond(tf.cast(training, tf.bool), normalize_with_batch_stats, normalize_with_moving_stats)
+
 
 class GlobalMeanStddevPooling1D(Layer):
-    """Compute arithmetic mean and standard deviation of the inputs along the time steps dimension, then output the concatenation of the computed stats."""
-    def call(self, inputs):
+    """
+    Compute arithmetic mean and standard deviation of the inputs along the time steps dimension, then output the concatenation of the computed stats.
+    If the inputs have a mask, the stats are computed only over unmasked time steps.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.supports_masking = True
+
+    def call(self, inputs, mask=None):
         # assuming always channels_last
         steps_axis = 1
-        means = tf.math.reduce_mean(inputs, axis=steps_axis, keepdims=True)
-        variances = tf.math.reduce_mean(tf.math.square(inputs - means), axis=steps_axis)
+        if mask is None:
+            means = tf.math.reduce_mean(inputs, axis=steps_axis, keepdims=True)
+            variances = tf.math.reduce_mean(tf.math.square(inputs - means), axis=steps_axis)
+        else:
+            weights = tf.expand_dims(tf.cast(mask, inputs.dtype), -1)
+            num_steps = tf.math.maximum(1.0, tf.math.reduce_sum(weights, axis=steps_axis, keepdims=True))
+            means = tf.math.reduce_sum(weights * inputs, axis=steps_axis, keepdims=True) / num_steps
+            variances = tf.math.reduce_sum(weights * tf.math.square(inputs - means), axis=steps_axis) / tf.squeeze(num_steps, steps_axis)
         means = tf.squeeze(means, steps_axis)
-        stddevs = tf.math.sqrt(tf.math.maximum(0.0, variances))
+        stddevs = tf.math.sqrt(tf.math.maximum(tf.zeros_like(variances), variances))
         return tf.concat((means, stddevs), axis=steps_axis)
 
+    def compute_mask(self, inputs, mask=None):
+        # Time steps are pooled, nothing left to mask
+        return None
+
 
 class FrameLayer(Layer):
     def __init__(self, filters, kernel_size, strides, name="frame", activation="relu", padding="valid", dropout_rate=None):
@@ -43,14 +85,30 @@ class FrameLayer(Layer):
         self.dropout = None
         if dropout_rate:
             self.dropout = Dropout(rate=dropout_rate, name="{}_dropout".format(name))
+        self.supports_masking = True
 
-    def call(self, inputs, training=None):
+    def call(self, inputs, training=None, mask=None):
         x = self.conv(inputs)
-        x = self.batch_norm(x, training=training)
+        if mask is None:
+            x = self.batch_norm(x, training=training)
+        else:
+            weights = tf.expand_dims(tf.cast(self.compute_mask(inputs, mask), x.dtype), -1)
+            x = masked_batch_normalization(self.batch_norm, x, weights, training=training)
+            # Zero all padded steps, so they do not leak into the convolutions of the next frame layer
+            x = weights * x
         if self.dropout:
             x = self.dropout(x, training=training)
         return x
 
+    def compute_mask(self, inputs, mask=None):
+        """Output step t is unmasked if all input steps in its receptive field are unmasked, assuming the unmasked steps are a prefix of each sequence."""
+        if mask is None:
+            return None
+        kernel_size, strides = self.conv.kernel_size[0], self.conv.strides[0]
+        if self.conv.padding == "valid":
+            return mask[:, kernel_size-1::strides]
+        return mask[:, ::strides]
+
     def get_config(self):
         config = {
             "filters": self.conv.filters,
@@ -99,9 +157,84 @@ class SegmentLayer(Layer):
         return cls(**config)
 
 
-def loader(input_shape, num_outputs, output_activation="log_softmax"):
+def frame_receptive_field(model, layer_name):
+    """
+    Receptive field length and total stride in input frames of the outputs of layer layer_name, computed from all FrameLayers before it.
+    Output step j of layer_name depends only on the input frames [j*stride, j*stride + receptive_field), if all layers between FrameLayers are frame-wise.
+    """
+    receptive_field, stride = 1, 1
+    for layer in model.layers[:model.layers.index(model.get_layer(layer_name)) + 1]:
+        assert not isinstance(layer, tf.keras.layers.RNN), "outputs of layer '{}' depend on all previous frames, recurrent layer '{}' has no finite receptive field".format(layer_name, layer.name)
+        if isinstance(layer, FrameLayer):
+            receptive_field += (layer.conv.kernel_size[0] - 1) * stride
+            stride *= layer.conv.strides[0]
+    return receptive_field, stride
+
+
+class SlidingWindowScorer:
+    """
+    Score overlapping windows of long utterances with a model that has FrameLayers followed by GlobalMeanStddevPooling1D, e.g. xvector or clstm without LSTM.
+    The frame layers are run once over the whole utterance and the pooling statistics of every window are computed from prefix sums of the frame level activations,
+    then only the layers after the pooling layer are run for each window.
+    Window lengths and steps are in input frames.
+    If window_step is a multiple of the total stride of the frame layers, every window gets the same outputs as when scoring it separately with valid padding,
+    except the window aligned with the end of the features, whose begin frame is not necessarily a multiple of the stride.
+    """
+    def __init__(self, model, window_len, window_step, pooling_layer="stats_pooling", output_layer=None):
+        pooling = model.get_layer(pooling_layer)
+        self.frame_model = tf.keras.Model(inputs=model.input, outputs=pooling.input, name=model.name + "_frames")
+        _, self.head = split_model(model, pooling_layer)
+        if output_layer:
+            # E.g. 'segment1' for window embeddings instead of window scores
+            self.head = tf.keras.Model(inputs=self.head.input, outputs=self.head.get_layer(output_layer).output, name=model.name + "_" + output_layer)
+        last_frame_layer = model.layers[model.layers.index(pooling) - 1].name
+        self.receptive_field, self.stride = frame_receptive_field(model, last_frame_layer)
+        self.window_len = window_len
+        self.window_step = window_step
+        assert window_len >= self.receptive_field, "window length {} is shorter than the receptive field {} of the frame layers".format(window_len, self.receptive_field)
+
+    @tf.function(experimental_relax_shapes=True)
+    def score(self, feats):
+        """
+        Score all windows of feats with shape (num_frames, feat_dim), beginning every window_step frames, like the chunks of tf_data.chunks_for_scoring.
+        If the last step does not reach the end of the features, one more window is aligned with the end.
+        Features shorter than one window are repeated until they fill one window.
+        Returns the begin frame of each window and the outputs of shape (num_windows, num_outputs).
+        """
+        num_frames = tf.shape(feats)[0]
+        num_repeats = (self.window_len + num_frames - 1) // num_frames
+        feats = tf.tile(feats, tf.concat(([num_repeats], tf.ones([tf.rank(feats) - 1], tf.int32)), axis=0))
+        feats = feats[:tf.math.maximum(num_frames, self.window_len)]
+        last_begin = tf.shape(feats)[0] - self.window_len
+        begin = tf.range(0, last_begin + 1, self.window_step)
+        begin = tf.cond(
+            begin[-1] < last_begin,
+            lambda: tf.concat((begin, [last_begin]), axis=0),
+            lambda: begin)
+        activations = tf.cast(self.frame_model(tf.expand_dims(feats, 0), training=False)[0], tf.float64)
+        num_steps = tf.shape(activations)[0]
+        # Prefix sums with a leading zero row, the sum over steps [a, b) is prefix[b] - prefix[a]
+        zeros = tf.zeros([1, tf.shape(activations)[1]], tf.float64)
+        prefix_sums = tf.concat((zeros, tf.math.cumsum(activations, axis=0)), axis=0)
+        prefix_square_sums = tf.concat((zeros, tf.math.cumsum(tf.math.square(activations), axis=0)), axis=0)
+        # Activation steps whose receptive field is within the window
+        first = (begin + self.stride - 1) // self.stride
+        end = tf.math.minimum(num_steps, (begin + self.window_len - self.receptive_field) // self.stride + 1)
+        num_window_steps = tf.cast(tf.math.maximum(1, end - first), tf.float64)[:, tf.newaxis]
+        means = (tf.gather(prefix_sums, end) - tf.gather(prefix_sums, first)) / num_window_steps
+        variances = (tf.gather(prefix_square_sums, end) - tf.gather(prefix_square_sums, first)) / num_window_steps - tf.math.square(means)
+        stddevs = tf.math.sqrt(tf.math.maximum(tf.zeros_like(variances), variances))
+        stats = tf.cast(tf.concat((means, stddevs), axis=1), self.head.input.dtype)
+        return begin, self.head(stats, training=False)
+
+
+def loader(input_shape, num_outputs, output_activation="log_softmax", masked=False, mask_value=0.0):
     inputs = Input(shape=input_shape, name="input")
-    x = FrameLayer(512, 5, 1, name="frame1")(inputs)
+    x = inputs
+    if masked:
+        # Padded steps of variable length batches are all mask_value, see tf_data.prepare_dataset_for_training key 'masked_padded_batch'
+        x = Masking(mask_value=mask_value, name="input_mask")(x)
+    x = FrameLayer(512, 5, 1, name="frame1")(x)
     x = FrameLayer(512, 3, 2, name="frame2")(x)
     x = FrameLayer(512, 3, 3, name="frame3")(x)
     x = FrameLayer(512, 1, 1, name="frame4")(x)
@@ -0,0 +1,85 @@
+"""
+Binary store of prediction scores.
+Scores are stored as one npy matrix of shape (num_utterances, num_languages) and the utterance ids, the language of each score column and the true language of each utterance are stored in an index next to it.
+Trials are implicit: every utterance is a trial for every language and it is a target trial only for its true language.
+"""
+import os
+
+import numpy as np
+
+
+def scores_path(path):
+    return path + ".npy"
+
+def index_path(path):
+    return path + ".index.npz"
+
+def exists(path):
+    return os.path.exists(scores_path(path)) and os.path.exists(index_path(path))
+
+def write(path, scores, uttids, langs, labels=None, verbosity=0):
+    """
+    Write scores of shape (len(uttids), len(langs)) into a score store at path.
+    labels contains the true language of each utterance or an empty string if it is not known, e.g. for chunks of utterances.
+    The scores and index files are written into temporary files and renamed when complete.
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    uttids = np.asarray(uttids, dtype=str)
+    langs = np.asarray(langs, dtype=str)
+    labels = np.full(uttids.shape, '') if labels is None else np.asarray(labels, dtype=str)
+    assert scores.shape == (uttids.size, langs.size), "expected scores of shape {}, not {}".format((uttids.size, langs.size), scores.shape)
+    assert labels.shape == uttids.shape, "expected {} labels, not {}".format(uttids.size, labels.size)
+    tmp_scores_path = scores_path(path) + ".tmp.npy"
+    np.save(tmp_scores_path, scores)
+    tmp_index_path = index_path(path) + ".tmp.npz"
+    np.savez(tmp_index_path, uttids=uttids, langs=langs, labels=labels)
+    os.replace(tmp_scores_path, scores_path(path))
+    os.replace(tmp_index_path, index_path(path))
+    if verbosity:
+        print("Wrote scores of {} utterances for {} languages into score store '{}'".format(uttids.size, langs.size, path))
+
+def load_index(path):
+    with np.load(index_path(path)) as index:
+        return {k: index[k] for k in index.files}
+
+def load(path, mmap=True):
+    """Returns the scores, optionally as a read-only memory mapped array, and the index as a dict of arrays."""
+    index = load_index(path)
+    scores = np.load(scores_path(path), mmap_mode="r" if mmap else None)
+    assert scores.shape == (index["uttids"].size, index["langs"].size), "score store '{}' has scores of shape {} but {} utterance ids and {} languages".format(path, scores.shape, index["uttids"].size, index["langs"].size)
+    return scores, index
+
+def join_columns(columns, separator):
+    """Join equal length string arrays element-wise, looping only over the columns."""
+    joined = columns[0]
+    for column in columns[1:]:
+        joined = np.char.add(np.char.add(joined, separator), column)
+    return joined
+
+def export_text_scores(path, text_path, precision=6, separator=' ', chunk_size=65536):
+    """Write the scores of a score store as text, with the languages on the first line and then one line of scores for each utterance, as previously written by the predict command."""
+    scores, index = load(path)
+    float_format = "%.{:d}f".format(precision)
+    with open(text_path, "w") as f:
+        print(*index["langs"], file=f)
+        for begin in range(0, scores.shape[0], chunk_size):
+            end = min(scores.shape[0], begin + chunk_size)
+            score_strings = np.char.mod(float_format, scores[begin:end])
+            lines = join_columns([index["uttids"][begin:end]] + list(score_strings.T), separator)
+            f.write('\n'.join(lines))
+            f.write('\n')
+
+def export_text_trials(path, text_path, chunk_size=65536):
+    """Write the implicit trials of a score store as text lines 'language utterance_id target|nontarget', for every utterance with a known true language."""
+    index = load_index(path)
+    known = index["labels"] != ''
+    uttids, labels, langs = index["uttids"][known], index["labels"][known], index["langs"]
+    with open(text_path, "w") as f:
+        for begin in range(0, uttids.size, chunk_size):
+            end = min(uttids.size, begin + chunk_size)
+            trial_langs = np.tile(langs, end - begin)
+            trial_uttids = np.repeat(uttids[begin:end], langs.size)
+            is_target = np.repeat(labels[begin:end], langs.size) == trial_langs
+            lines = join_columns([trial_langs, trial_uttids, np.where(is_target, "target", "nontarget")], ' ')
+            f.write('\n'.join(lines))
+            f.write('\n')
@@ -0,0 +1,163 @@
+"""
+Export of a trained model together with wav decoding and feature extraction into one SavedModel, so that inference hosts need only TensorFlow.
+The feature extraction parameters are fixed at export time from the same feature config that was used for training.
+"""
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from lidbox import audio_feat
+import lidbox.tf_data as tf_data
+
+
+# Feature config keys that run Python code with tf.numpy_function or generators, which cannot be serialized into a SavedModel
+UNSUPPORTED_FEATURE_CONFIG_KEYS = ("cmvn_numpy",)
+# Keys of feature config key 'wav_config' that are applied to signals by Python generators, i.e. chunking, random chunking and webrtcvad trimming
+UNSUPPORTED_WAV_CONFIG_KEYS = ("chunks", "random_chunks", "webrtcvad_trim")
+
+BENCHMARK_RESULTS = "benchmark.json"
+
+
+class ServingModule(tf.Module):
+    """
+    Scores of a Keras model for raw audio.
+    All signatures take batches of utterances of any length and return a dict with the scores of shape (batch_size, num_labels) and the labels of the score columns.
+    Utterances in a batch are scored separately unless they all have the same length, so padding never changes the features.
+    Signals are not resampled, so they must have the sample rate that was used in training, see default_sample_rate.
+    """
+    def __init__(self, model, feat_config, labels, sample_rate, feature_output=None):
+        super().__init__(name="lidbox_serving")
+        for key in UNSUPPORTED_FEATURE_CONFIG_KEYS:
+            assert key not in feat_config, "feature config key '{}' cannot be exported into a SavedModel".format(key)
+        wav_config = feat_config.get("wav_config", {})
+        for key in UNSUPPORTED_WAV_CONFIG_KEYS:
+            assert key not in wav_config, "wav_config key '{}' cannot be exported into a SavedModel, the exported model would not process signals like in training".format(key)
+        if "target_sample_rate" in wav_config:
+            assert sample_rate == wav_config["target_sample_rate"], "sample rate {} of the exported model does not match wav_config.target_sample_rate {}, signals are not resampled in the exported model".format(sample_rate, wav_config["target_sample_rate"])
+        assert ("types" in feat_config) == (feature_output is not None), "feature_output must be given if and only if the feature config has multiple feature types"
+        self.model = model
+        self.extract_features = tf_data.make_feature_extractor(feat_config, validate=False)
+        self.feature_output = feature_output
+        self.labels = tf.constant(labels, tf.string)
+        self.sample_rate = sample_rate
+        self.expand_channel_dim = len(model.input.shape) == 4
+
+    def features(self, signals):
+        sample_rates = tf.fill([tf.shape(signals)[0]], tf.constant(self.sample_rate, tf.int32))
+        feats = self.extract_features(audio_feat.Wav(signals, sample_rates))
+        if self.feature_output:
+            feats = feats[self.feature_output]
+        if self.expand_channel_dim:
+            feats = tf.expand_dims(feats, -1)
+        return feats
+
+    def score_padded(self, signals, lengths):
+        def score_one(signal_and_length):
+            signal, length = signal_and_length
+            return self.model(self.features(tf.expand_dims(signal[:length], 0)), training=False)[0]
+        def score_equal_length():
+            return self.model(self.features(signals), training=False)
+        def score_separately():
+            return tf.map_fn(score_one, (signals, lengths), dtype=self.model.output.dtype)
+        equal_length = tf.math.reduce_all(tf.math.equal(lengths, tf.shape(signals)[1]))
+        scores = tf.cond(equal_length, score_equal_length, score_separately)
+        return {"scores": scores, "labels": self.labels}
+
+    @tf.function(input_signature=[tf.TensorSpec([None, None], tf.float32), tf.TensorSpec([None], tf.int32)])
+    def predict_signals(self, signals, lengths):
+        """Float signals in range [-1, 1], padded to the length of the longest signal, and the length of each signal in samples."""
+        return self.score_padded(signals, lengths)
+
+    def score_encoded(self, contents, decode):
+        """Decode every string in contents into a 1-D signal with decode and score the signals."""
+        num_utterances = tf.size(contents)
+        samples = tf.TensorArray(tf.float32, size=num_utterances, infer_shape=False, element_shape=tf.TensorShape([None]))
+        lengths = tf.TensorArray(tf.int32, size=num_utterances)
+        for i in tf.range(num_utterances):
+            signal = decode(contents[i])
+            samples = samples.write(i, signal)
+            lengths = lengths.write(i, tf.size(signal))
+        lengths = lengths.stack()
+        signals = tf.RaggedTensor.from_row_lengths(samples.concat(), lengths).to_tensor()
+        return self.score_padded(signals, lengths)
+
+    @tf.function(input_signature=[tf.TensorSpec([None], tf.string)])
+    def predict_pcm16(self, pcm_bytes):
+        """Raw mono 16-bit little-endian PCM bytes of each utterance, without headers."""
+        def decode(contents):
+            return tf.cast(tf.io.decode_raw(contents, tf.int16, little_endian=True), tf.float32) / 32768.0
+        return self.score_encoded(pcm_bytes, decode)
+
+    @tf.function(input_signature=[tf.TensorSpec([None], tf.string)])
+    def predict_wav(self, wav_bytes):
+        """Contents of a wav file for each utterance, channels are merged by averaging like in tf_data.load_wav."""
+        def decode(contents):
+            wav = tf.audio.decode_wav(contents)
+            tf.debugging.assert_equal(wav.sample_rate, self.sample_rate, message="wav sample rate does not match the sample rate of the exported model")
+            return tf.math.reduce_mean(wav.audio, axis=1)
+        return self.score_encoded(wav_bytes, decode)
+
+
+def default_sample_rate(feat_config):
+    """Sample rate of the signals that were used in training, i.e. wav_config.target_sample_rate or 16 kHz."""
+    return feat_config.get("wav_config", {}).get("target_sample_rate", 16000)
+
+def export(model, feat_config, labels, export_dir, sample_rate, feature_output=None, verbosity=0):
+    """Write a SavedModel with the signatures 'serving_default' (wav bytes), 'pcm16' (raw PCM bytes) and 'signals' (padded float signals with lengths)."""
+    module = ServingModule(model, feat_config, labels, sample_rate, feature_output)
+    signatures = {
+        "serving_default": module.predict_wav,
+        "pcm16": module.predict_pcm16,
+        "signals": module.predict_signals,
+    }
+    tf.saved_model.save(module, export_dir, signatures=signatures)
+    if verbosity:
+        print("Exported SavedModel with signatures {} to '{}'".format(', '.join(signatures), export_dir))
+    return export_dir
+
+def random_wav_bytes(num_utterances, signal_sec, sample_rate, seed=0):
+    """Random noise signals encoded as wav files, for benchmarking exported models."""
+    rng = np.random.RandomState(seed)
+    signals = 0.1 * rng.randn(num_utterances, int(signal_sec * sample_rate)).astype(np.float32)
+    return tf.stack([tf.audio.encode_wav(tf.expand_dims(s, -1), sample_rate) for s in signals])
+
+def benchmark(export_dir, batch_sizes=(1, 8, 32), signal_sec=4.0, repeats=20, warmup=2, sample_rate=16000, verbosity=0):
+    """
+    Load an exported SavedModel and measure the latency and throughput of its serving_default signature for batches of random wav files.
+    Returns a list of results for each batch size and writes them as JSON into the export directory.
+    """
+    predict_wav = tf.saved_model.load(export_dir).signatures["serving_default"]
+    results = []
+    for batch_size in batch_sizes:
+        wav_bytes = random_wav_bytes(batch_size, signal_sec, sample_rate)
+        for _ in range(warmup):
+            predict_wav(wav_bytes)["scores"].numpy()
+        durations = []
+        for _ in range(repeats):
+            begin = time.perf_counter()
+            predict_wav(wav_bytes)["scores"].numpy()
+            durations.append(time.perf_counter() - begin)
+        median = float(np.median(durations))
+        result = {
+            "batch_size": batch_size,
+            "signal_sec": signal_sec,
+            "repeats": repeats,
+            "latency_median_sec": median,
+            "latency_p90_sec": float(np.percentile(durations, 90)),
+            "utterances_per_sec": batch_size / median,
+            "audio_sec_per_sec": batch_size * signal_sec / median,
+        }
+        if verbosity:
+            print("batch size {:4d}: {:.4f} s median latency, {:.4f} s p90 latency, {:.1f} utterances/s, {:.1f}x real time".format(
+                batch_size,
+                result["latency_median_sec"],
+                result["latency_p90_sec"],
+                result["utterances_per_sec"],
+                result["audio_sec_per_sec"]))
+        results.append(result)
+    with open(os.path.join(export_dir, BENCHMARK_RESULTS), "w") as f:
+        json.dump(results, f, indent=2)
+    return results
@@ -1,13 +1,17 @@
 import contextlib
 import collections
+import hashlib
 import io
+import json
 import os
 import random
 import sys
+import threading
 import time
 import wave
 
 from . import audio_feat
+from .tiered_cache import TieredCache, is_cache_complete
 from lidbox import yaml_pprint
 import kaldiio
 import librosa.core
@@ -39,7 +43,11 @@ def feature_scaling(X, min, max, axis=None):
     X_max = tf.math.reduce_max(X, axis=axis, keepdims=True)
     return min + (max - min) * tf.math.divide_no_nan(X - X_min, X_max - X_min)
 
-@tf.function
+@tf.function(input_signature=[
+    tf.TensorSpec([None, None, None], tf.float32),
+    tf.TensorSpec([], tf.int32),
+    tf.TensorSpec([], tf.bool)])
+@audio_feat.count_traces
 def cmvn_slide(X, window_len=300, normalize_variance=True):
     """Apply cepstral mean and variance normalization on batches of features matrices X with a given cmvn window length."""
     tf.debugging.assert_rank(X, 3, message="Input to cmvn_slide should be of shape (Batch, Timedim, Coefs)")
@@ -52,7 +60,7 @@ def cmvn_slide(X, window_len=300, normalize_variance=True):
             return centered
     else:
         # Padding by reflecting the coefs along the time dimension should not dilute the means and variances as much as zeros would
-        padding = tf.constant([[0, 0], [window_len//2, window_len//2 - 1 + (window_len&1)], [0, 0]])
+        padding = [[0, 0], [window_len//2, window_len//2 - 1 + window_len%2], [0, 0]]
         X_padded = tf.pad(X, padding, mode="REFLECT")
         cmvn_windows = tf.signal.frame(X_padded, window_len, 1, axis=1)
         tf.debugging.assert_equal(tf.shape(cmvn_windows)[1], tf.shape(X)[1], message="Mismatching amount of CMVN output windows and time steps in the input")
@@ -99,37 +107,200 @@ def cmvn_nopad_slide_numpy(X, window_len, normalize_variance):
         result[:,i] = centered
     return result
 
-@tf.function
-def extract_features(signals, feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs, db_spec_kwargs, feat_scale_kwargs, cmvn_kwargs):
+FEATURE_TYPES = ("spectrogram", "melspectrogram", "logmelspectrogram", "mfcc", "db_spectrogram")
+
+def feature_types(feat_config):
+    """List of all feature types to extract, from either the key 'types' (list) or 'type' (single type)."""
+    feattypes = list(feat_config["types"]) if "types" in feat_config else [feat_config["type"]]
+    assert all(t in FEATURE_TYPES for t in feattypes), "unknown feature types {}, valid types are {}".format(feattypes, ', '.join(FEATURE_TYPES))
+    return feattypes
+
+def feature_type_name(feat_config):
+    return '+'.join(feature_types(feat_config))
+
+@tf.function(experimental_relax_shapes=True)
+@audio_feat.count_traces
+def extract_multiple_features(signals, feattypes, spec_kwargs, melspec_kwargs, mfcc_kwargs, db_spec_kwargs, feat_scale_kwargs, cmvn_kwargs, validate=True):
+    """
+    Extract all features with types in feattypes from the same power spectrogram and return them as a dict of feature type to features.
+    Intermediate results (spectrogram, melspectrogram, logmelspectrogram) are computed only once.
+    If validate is False, the outputs of the extraction stages are not checked for non-finite values.
+    """
+    assert_all_finite = tf.debugging.assert_all_finite if validate else lambda x, message: x
     sample_rate = signals.sample_rate[0]
     tf.debugging.assert_equal(signals.sample_rate, [sample_rate], message="All signals in the feature extraction batch must have equal sample rates")
-    feat = audio_feat.spectrograms(signals, **spec_kwargs)
-    tf.debugging.assert_all_finite(feat, "spectrogram failed")
-    if feattype in ("melspectrogram", "logmelspectrogram", "mfcc"):
-        feat = audio_feat.melspectrograms(feat, sample_rate=sample_rate, **melspec_kwargs)
-        tf.debugging.assert_all_finite(feat, "melspectrogram failed")
-        if feattype in ("logmelspectrogram", "mfcc"):
-            feat = tf.math.log(feat + 1e-6)
-            tf.debugging.assert_all_finite(feat, "logmelspectrogram failed")
-            if feattype == "mfcc":
+    outputs = {}
+    S = audio_feat.spectrograms(signals, **spec_kwargs)
+    assert_all_finite(S, "spectrogram failed")
+    if "spectrogram" in feattypes:
+        outputs["spectrogram"] = S
+    if any(t in feattypes for t in ("melspectrogram", "logmelspectrogram", "mfcc")):
+        melspec = audio_feat.melspectrograms(S, sample_rate=sample_rate, **melspec_kwargs)
+        assert_all_finite(melspec, "melspectrogram failed")
+        if "melspectrogram" in feattypes:
+            outputs["melspectrogram"] = melspec
+        if any(t in feattypes for t in ("logmelspectrogram", "mfcc")):
+            logmelspec = tf.math.log(melspec + 1e-6)
+            assert_all_finite(logmelspec, "logmelspectrogram failed")
+            if "logmelspectrogram" in feattypes:
+                outputs["logmelspectrogram"] = logmelspec
+            if "mfcc" in feattypes:
                 coef_begin = mfcc_kwargs.get("coef_begin", 1)
                 coef_end = mfcc_kwargs.get("coef_end", 13)
-                mfccs = tf.signal.mfccs_from_log_mel_spectrograms(feat)
-                feat = mfccs[..., coef_begin:coef_end]
-                tf.debugging.assert_all_finite(feat, "mfcc failed")
-    elif feattype in ("db_spectrogram",):
-        feat = audio_feat.power_to_db(feat, **db_spec_kwargs)
-        tf.debugging.assert_all_finite(feat, "db_spectrogram failed")
-    if feat_scale_kwargs:
-        feat = feature_scaling(feat, **feat_scale_kwargs)
-        tf.debugging.assert_all_finite(feat, "feature scaling failed")
-    if cmvn_kwargs:
-        feat = cmvn_slide(feat, **cmvn_kwargs)
-        tf.debugging.assert_all_finite(feat, "cmvn failed")
-    return feat
+                mfccs = tf.signal.mfccs_from_log_mel_spectrograms(logmelspec)
+                outputs["mfcc"] = mfccs[..., coef_begin:coef_end]
+                assert_all_finite(outputs["mfcc"], "mfcc failed")
+    if "db_spectrogram" in feattypes:
+        outputs["db_spectrogram"] = audio_feat.power_to_db(S, **db_spec_kwargs)
+        assert_all_finite(outputs["db_spectrogram"], "db_spectrogram failed")
+    for feattype in feattypes:
+        feat = outputs[feattype]
+        if feat_scale_kwargs:
+            feat = feature_scaling(feat, **feat_scale_kwargs)
+            assert_all_finite(feat, "feature scaling failed")
+        if cmvn_kwargs:
+            feat = cmvn_slide(feat, **cmvn_kwargs)
+            assert_all_finite(feat, "cmvn failed")
+        outputs[feattype] = feat
+    return outputs
+
+@tf.function(experimental_relax_shapes=True)
+@audio_feat.count_traces
+def extract_features(signals, feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs, db_spec_kwargs, feat_scale_kwargs, cmvn_kwargs, validate=True):
+    return extract_multiple_features(signals, (feattype,), spec_kwargs, melspec_kwargs, mfcc_kwargs, db_spec_kwargs, feat_scale_kwargs, cmvn_kwargs, validate)[feattype]
+
+def make_feature_extractor(feat_config, validate=True):
+    """
+    Returns a tf.function that extracts features from a batch of signals like extract_features or extract_multiple_features, depending on the feature config.
+    All parameters are fixed when the function is created and the input signature accepts any batch size and signal length,
+    so the function is traced only once regardless of the input shapes.
+    """
+    feat_extract_args = feat_extraction_args_as_list(feat_config)
+    if "types" in feat_config:
+        extract_fn = lambda signals: extract_multiple_features(signals, *feat_extract_args, validate)
+    else:
+        extract_fn = lambda signals: extract_features(signals, *feat_extract_args, validate)
+    @tf.function(input_signature=[audio_feat.WAV_BATCH_SIGNATURE])
+    @audio_feat.count_traces
+    def extract_features_from_signals(signals):
+        return extract_fn(signals)
+    return extract_features_from_signals
+
+RETRACE_WARNING_THRESHOLD = 5
+
+def trace_counts():
+    return sorted(audio_feat.TRACE_COUNTS.items())
+
+def print_trace_counts(file=sys.stdout):
+    """Print the amount of traces of all functions in the feature extraction pipeline, with a warning for functions that seem to be retraced repeatedly."""
+    print("Feature extraction function traces:", file=file)
+    for name, count in trace_counts():
+        warning = "  (retraced more than {} times, check input shapes and argument types)".format(RETRACE_WARNING_THRESHOLD) if count > RETRACE_WARNING_THRESHOLD else ''
+        print("{:40s}{:8d}{}".format(name, count, warning), file=file)
+
+def xla_function(fn):
+    """tf.function compiled with XLA, using the argument name of the installed TensorFlow version."""
+    try:
+        return tf.function(fn, jit_compile=True)
+    except TypeError:
+        return tf.function(fn, experimental_compile=True)
+
+def masked_feature_scaling(X, mask, min, max, axis=None):
+    """Same as feature_scaling but ignores all values where mask is False."""
+    X_min = tf.math.reduce_min(tf.where(mask, X, np.inf), axis=axis, keepdims=True)
+    X_max = tf.math.reduce_max(tf.where(mask, X, -np.inf), axis=axis, keepdims=True)
+    return min + (max - min) * tf.math.divide_no_nan(X - X_min, X_max - X_min)
+
+def masked_cmvn_slide(X, num_frames, window_len=300, normalize_variance=True):
+    """
+    Same as cmvn_slide for the first num_frames frames of X, such that the result does not depend on the frames after num_frames.
+    The reflection padding of cmvn_slide is done with gathers whose sizes depend only on the padded shape of X, which allows compiling this function with XLA.
+    """
+    # The static shape is unknown inside dataset maps, but XLA compiles with the concrete bucket shape
+    num_padded_frames = tf.shape(X)[1]
+    # Global normalization, used when all frames fit inside one window
+    mask = tf.reshape(tf.range(num_padded_frames) < num_frames, [1, -1, 1])
+    n = tf.cast(num_frames, X.dtype)
+    mean = tf.math.reduce_sum(tf.where(mask, X, 0.0), axis=1, keepdims=True) / n
+    global_centered = X - mean
+    if normalize_variance:
+        std = tf.math.sqrt(tf.math.reduce_sum(tf.where(mask, tf.math.square(global_centered), 0.0), axis=1, keepdims=True) / n)
+        global_centered = tf.math.divide_no_nan(global_centered, std)
+    # Sliding window normalization with reflection at both ends of the first num_frames frames
+    positions = tf.range(num_padded_frames + window_len - 1) - window_len // 2
+    positions = tf.math.abs(positions)
+    last = num_frames - 1
+    positions = tf.where(positions > last, 2 * last - positions, positions)
+    positions = tf.clip_by_value(positions, 0, num_padded_frames - 1)
+    cmvn_windows = tf.signal.frame(tf.gather(X, positions, axis=1), window_len, 1, axis=1)
+    centered = X - tf.math.reduce_mean(cmvn_windows, axis=2)
+    if normalize_variance:
+        centered = tf.math.divide_no_nan(centered, tf.math.reduce_std(cmvn_windows, axis=2))
+    return tf.where(num_frames <= window_len, global_centered, centered)
+
+def make_xla_feature_extractor(feat_config, validate=True):
+    """
+    Returns a function that extracts features like extract_features, but compiled with XLA.
+    All batches of signals are zero padded to a multiple of xla.bucket_length_ms, so XLA compiles the extractor at most once for every bucket length and batch size.
+    The features of the padded frames are dropped before returning, and feature scaling and CMVN ignore them.
+    All signals must have the sample rate xla.sample_rate, which is static in the compiled graph.
+    """
+    xla_config = feat_config["xla"]
+    feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs, db_spec_kwargs, feat_scale_kwargs, cmvn_kwargs = feat_extraction_args_as_list(feat_config)
+    sample_rate = int(xla_config.get("sample_rate", 16000))
+    ms_to_samples = lambda ms: int(sample_rate * 1e-3 * ms)
+    bucket_length = ms_to_samples(xla_config.get("bucket_length_ms", 1000))
+    frame_length = ms_to_samples(spec_kwargs.get("frame_length_ms", 25))
+    frame_step = ms_to_samples(spec_kwargs.get("frame_step_ms", 10))
+    fft_length = spec_kwargs.get("fft_length", 512)
+    power = spec_kwargs.get("power", 2.0)
+    # Static version of the band mask in audio_feat.spectrograms
+    fft_freqs = np.linspace(0, sample_rate // 2, 1 + fft_length // 2)
+    bins_in_band = np.flatnonzero((spec_kwargs.get("fmin", 0.0) <= fft_freqs) & (fft_freqs <= spec_kwargs.get("fmax", 8000.0)))
+    band_begin, band_end = int(bins_in_band[0]), int(bins_in_band[-1]) + 1
+    if feattype in ("melspectrogram", "logmelspectrogram", "mfcc"):
+        mel_weights = tf.signal.linear_to_mel_weight_matrix(
+            num_mel_bins=melspec_kwargs.get("num_mel_bins", 40),
+            num_spectrogram_bins=band_end - band_begin,
+            sample_rate=sample_rate,
+            lower_edge_hertz=melspec_kwargs.get("fmin", 60.0),
+            upper_edge_hertz=melspec_kwargs.get("fmax", 6000.0))
+    @xla_function
+    def extract_padded(audio, num_frames):
+        feat = tf.signal.stft(audio, frame_length, frame_step, fft_length=fft_length)
+        feat = tf.math.pow(tf.math.abs(feat), power)[..., band_begin:band_end]
+        if feattype in ("melspectrogram", "logmelspectrogram", "mfcc"):
+            feat = tf.matmul(feat, mel_weights)
+            if feattype in ("logmelspectrogram", "mfcc"):
+                feat = tf.math.log(feat + 1e-6)
+                if feattype == "mfcc":
+                    coef_begin = mfcc_kwargs.get("coef_begin", 1)
+                    coef_end = mfcc_kwargs.get("coef_end", 13)
+                    feat = tf.signal.mfccs_from_log_mel_spectrograms(feat)[..., coef_begin:coef_end]
+        elif feattype in ("db_spectrogram",):
+            # Zero padding does not change the maximum power used as reference
+            feat = audio_feat.power_to_db(feat, **db_spec_kwargs)
+        if feat_scale_kwargs:
+            mask = tf.reshape(tf.range(tf.shape(feat)[1]) < num_frames, [1, -1, 1])
+            feat = masked_feature_scaling(feat, mask, **feat_scale_kwargs)
+        if cmvn_kwargs:
+            feat = masked_cmvn_slide(feat, num_frames, **cmvn_kwargs)
+        return feat
+    def extract_features_xla(signals):
+        tf.debugging.assert_equal(signals.sample_rate, sample_rate, message="All signals must have the sample rate given in xla.sample_rate")
+        num_samples = tf.shape(signals.audio)[1]
+        num_frames = tf.math.maximum(0, 1 + (num_samples - frame_length) // frame_step)
+        num_padded = bucket_length * ((num_samples + bucket_length - 1) // bucket_length)
+        audio = tf.pad(signals.audio, [[0, 0], [0, num_padded - num_samples]])
+        feat = extract_padded(audio, num_frames)[:, :num_frames]
+        if validate:
+            tf.debugging.assert_all_finite(feat, "xla feature extraction failed")
+        return feat
+    return extract_features_xla
 
 def feat_extraction_args_as_list(feat_config):
-    args = [feat_config["type"]]
+    feattypes = feature_types(feat_config)
+    args = [tuple(feattypes) if "types" in feat_config else feattypes[0]]
     kwarg_dicts = [
         feat_config.get("spectrogram", {}),
         feat_config.get("melspectrogram", {}),
@@ -166,6 +337,103 @@ def write_wav(path, wav):
     tf.debugging.assert_rank(wav, 2, "write_wav expects signals with shape [N, c] where N is amount of samples and c channels.")
     return tf.io.write_file(path, tf.audio.encode_wav(wav.audio, wav.sample_rate))
 
+class PipelineStats:
+    """
+    Thread-safe collector of per-stage throughput and latency for tf.data pipelines instrumented with attach_stage_probe.
+    Latency of a stage is measured as the wall clock time between two consecutive elements leaving that stage.
+    """
+    def __init__(self, name='', max_latencies=100000):
+        self.name = name
+        self.max_latencies = max_latencies
+        self.lock = threading.Lock()
+        self.stages = collections.OrderedDict()
+
+    def record(self, stage, num_bytes):
+        now = time.perf_counter()
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = {
+                    "count": 0,
+                    "bytes": 0,
+                    "begin": now,
+                    "end": now,
+                    "latencies": collections.deque(maxlen=self.max_latencies),
+                }
+            s = self.stages[stage]
+            if s["count"]:
+                s["latencies"].append(now - s["end"])
+            s["count"] += 1
+            s["bytes"] += int(num_bytes)
+            s["end"] = now
+
+    def summary(self):
+        rows = []
+        with self.lock:
+            for stage, s in self.stages.items():
+                duration = max(1e-9, s["end"] - s["begin"])
+                latencies_ms = 1e3 * np.array(s["latencies"] or [0.0])
+                p50, p90, p99 = np.percentile(latencies_ms, [50, 90, 99])
+                rows.append(collections.OrderedDict([
+                    ("stage", stage),
+                    ("elements", s["count"]),
+                    ("elements_per_sec", s["count"] / duration),
+                    ("bytes_per_sec", s["bytes"] / duration),
+                    ("latency_p50_ms", p50),
+                    ("latency_p90_ms", p90),
+                    ("latency_p99_ms", p99),
+                ]))
+        return rows
+
+    def write_summaries(self, step):
+        """Write all stage stats and feature extraction function trace counts as TensorBoard scalars using the default summary writer."""
+        for row in self.summary():
+            for key, value in row.items():
+                if key != "stage":
+                    tf.summary.scalar("{}/{}".format(row["stage"], key), value, step=step)
+        for name, count in trace_counts():
+            tf.summary.scalar("traces/{}".format(name), count, step=step)
+
+    def print_table(self, file=sys.stdout):
+        header = ("stage", "elements", "elem/s", "MB/s", "p50 ms", "p90 ms", "p99 ms")
+        print("Pipeline stage stats{}:".format(" for '{}'".format(self.name) if self.name else ''), file=file)
+        print("{:20s}{:>12s}{:>12s}{:>10s}{:>10s}{:>10s}{:>10s}".format(*header), file=file)
+        for row in self.summary():
+            print("{:20s}{:12d}{:12.1f}{:10.2f}{:10.2f}{:10.2f}{:10.2f}".format(
+                row["stage"],
+                row["elements"],
+                row["elements_per_sec"],
+                row["bytes_per_sec"] * 1e-6,
+                row["latency_p50_ms"],
+                row["latency_p90_ms"],
+                row["latency_p99_ms"]), file=file)
+        print_trace_counts(file=file)
+
+def element_num_bytes(element):
+    num_bytes = tf.constant(0, tf.int64)
+    for t in tf.nest.flatten(element, expand_composites=True):
+        if t.dtype == tf.string:
+            num_bytes += tf.cast(tf.math.reduce_sum(tf.strings.length(t)), tf.int64)
+        else:
+            num_bytes += tf.cast(tf.size(t), tf.int64) * t.dtype.size
+    return num_bytes
+
+def attach_stage_probe(ds, stage, stats):
+    """
+    Pass all elements of ds through unmodified and record their arrival times and sizes into stats under the given stage name.
+    Does nothing if stats is None.
+    """
+    if stats is None:
+        return ds
+    def record(stage_bytes, num_bytes):
+        stats.record(stage_bytes.decode("utf-8"), num_bytes)
+        return True
+    stage = tf.constant(stage, tf.string)
+    def probe(*element):
+        recorded = tf.numpy_function(record, [stage, element_num_bytes(element)], tf.bool)
+        with tf.control_dependencies([recorded]):
+            return tf.nest.map_structure(tf.identity, element)
+    return ds.map(probe)
+
 def count_dataset(ds):
     return ds.reduce(tf.constant(0, tf.int64), lambda c, elem: c + 1)
 
@@ -211,6 +479,10 @@ def append_mfcc_energy_vad_decisions(ds, config):
     return ds.map(f, num_parallel_calls=TF_AUTOTUNE)
 
 def make_random_frame_chunker_fn(len_config):
+    """
+    Returns a function that takes the amount of frames in some features and returns the begin offsets and lengths of randomly placed chunks of random length.
+    Chunk lengths are drawn uniformly from 'num_bins' lengths between 'min' and 'max' and 'min_overlap' is the minimum overlap ratio of two adjacent chunks.
+    """
     float_lengths = tf.linspace(
         float(len_config["min"]),
         float(len_config["max"]),
@@ -221,8 +493,7 @@ def make_random_frame_chunker_fn(len_config):
     min_overlap = tf.constant(float(len_config.get("min_overlap", 0)), tf.float32)
     tf.debugging.assert_less(min_overlap, 1.0, message="Minimum overlap ratio of two adjacent random chunks must be less than 1.0")
     @tf.function
-    def chunk_timedim_randomly(features):
-        num_total_frames = tf.shape(features)[0]
+    def random_chunk_offsets(num_total_frames):
         max_num_chunks = 1 + tf.math.maximum(0, num_total_frames - min_chunk_length)
         rand_length_indexes = tf.random.uniform([max_num_chunks], 0, tf.size(lengths), dtype=tf.int32)
         rand_chunk_lengths = tf.gather(lengths, rand_length_indexes)
@@ -233,51 +504,175 @@ def make_random_frame_chunker_fn(len_config):
         begin = tf.boolean_mask(begin, begin < num_total_frames)
         end = begin + tf.boolean_mask(rand_chunk_lengths, begin < num_total_frames)
         end = tf.math.minimum(num_total_frames, end)
-        chunk_indices = tf.ragged.range(begin, end)
-        return tf.gather(features, chunk_indices)
-    return chunk_timedim_randomly
+        return begin, end - begin
+    return random_chunk_offsets
+
+def make_fixed_frame_chunker_fn(seq_len, seq_step, pad_zeros):
+    """
+    Returns a function that takes the amount of frames in some features and returns the begin offsets and lengths of fixed length chunks with a fixed step.
+    If pad_zeros is True, the last chunks may extend past the end of the features and should be padded.
+    """
+    seq_len = tf.constant(seq_len, tf.int32)
+    seq_step = tf.constant(seq_step, tf.int32)
+    @tf.function
+    def fixed_chunk_offsets(num_total_frames):
+        if pad_zeros:
+            last_begin = num_total_frames
+        else:
+            last_begin = num_total_frames - seq_len + 1
+        begin = tf.range(0, tf.math.maximum(0, last_begin), seq_step)
+        return begin, tf.fill(tf.shape(begin), seq_len)
+    return fixed_chunk_offsets
+
+def chunk_features_by_offsets(ds, chunk_offsets_fn, pad_zeros=False):
+    """
+    Split the time dimension of all features in ds into chunks by slicing with begin offsets and lengths from chunk_offsets_fn.
+    Each chunk becomes a separate element with the metadata of the utterance it was sliced from.
+    """
+    def slice_chunks(feats, meta):
+        begin, length = chunk_offsets_fn(tf.shape(feats)[0])
+        if pad_zeros:
+            num_padding = tf.math.maximum(0, tf.math.reduce_max(tf.concat(([0], begin + length), 0)) - tf.shape(feats)[0])
+            padding = tf.concat(([[0, num_padding]], tf.zeros([tf.rank(feats) - 1, 2], tf.int32)), axis=0)
+            feats = tf.pad(feats, padding)
+        slice_chunk = lambda b, l: (feats[b:b+l], meta)
+        return tf.data.Dataset.from_tensor_slices((begin, length)).map(slice_chunk)
+    return ds.flat_map(slice_chunks)
+
+def chunks_for_scoring(ds, seq_len, seq_step, batch_size):
+    """
+    Split the features of all (feats, meta) elements of ds into chunks of exactly seq_len frames and batch the chunks of all utterances into uniform batches.
+    Chunks begin every seq_step frames and if the last step does not reach the end of the features, one more chunk is aligned with the end, so no chunk contains padding.
+    Features shorter than seq_len are repeated until they fill exactly one chunk.
+    Returns a dataset of (chunks, utterance_index, uttid, label) batches, where utterance_index is the position of the utterance in ds.
+    """
+    def to_chunks(index, element):
+        feats, meta = element
+        num_frames = tf.shape(feats)[0]
+        num_repeats = (seq_len + num_frames - 1) // num_frames
+        feats = tf.tile(feats, tf.concat(([num_repeats], tf.ones([tf.rank(feats) - 1], tf.int32)), axis=0))
+        # Short features are repeated into exactly one chunk
+        feats = feats[:tf.math.maximum(num_frames, seq_len)]
+        last_begin = tf.shape(feats)[0] - seq_len
+        begin = tf.range(0, last_begin + 1, seq_step)
+        begin = tf.cond(
+            begin[-1] < last_begin,
+            lambda: tf.concat((begin, [last_begin]), axis=0),
+            lambda: begin)
+        chunks = tf.gather(feats, tf.expand_dims(begin, 1) + tf.range(seq_len))
+        num_chunks = tf.size(begin)
+        return tf.data.Dataset.from_tensor_slices((chunks, tf.fill([num_chunks], index), tf.fill([num_chunks], meta[0]), tf.fill([num_chunks], meta[1])))
+    ds = ds.filter(lambda feats, meta: tf.shape(feats)[0] > 0)
+    ds = ds.enumerate().flat_map(to_chunks)
+    return ds.batch(batch_size).prefetch(TF_AUTOTUNE)
+
+def padded_batch_args(element_spec, feature_padding_value):
+    """
+    Padded shapes and padding values for padded_batch of all components of element_spec, where the first component is the features.
+    Features are padded with feature_padding_value, all other components with zeros or empty strings.
+    """
+    padded_shapes = tf.nest.map_structure(lambda spec: spec.shape, element_spec)
+    padding_values = tf.nest.map_structure(lambda spec: tf.constant('' if spec.dtype == tf.string else 0, spec.dtype), element_spec)
+    padding_values = (tf.constant(feature_padding_value, element_spec[0].dtype), *padding_values[1:])
+    return padded_shapes, padding_values
 
-def prepare_dataset_for_training(ds, config, feat_config, label2onehot, model_id, conf_checksum='', verbosity=0):
+def frame_budget_batching(budget_conf, element_spec=None, verbosity=0):
+    """
+    Returns a dataset transformation that pads and batches (features, *rest) elements by sequence length buckets,
+    such that the batch size of each bucket is the amount of sequences with the bucket's maximum length that fit into max_frames.
+    Since every batch is padded only to its longest sequence, no batch has more than max_frames frames, except sequences longer than max_frames, which are batched alone.
+    Bucket boundaries are given either as an explicit list 'boundaries' or as 'bins' with keys min, max and num, like in bucket_by_sequence_length.
+    """
+    max_frames = int(budget_conf["max_frames"])
+    if "boundaries" in budget_conf:
+        bucket_boundaries = sorted(int(b) for b in budget_conf["boundaries"])
+    else:
+        bins = budget_conf["bins"]
+        bucket_boundaries = np.linspace(bins["min"], bins["max"], bins["num"], dtype=np.int32).tolist()
+    assert bucket_boundaries and bucket_boundaries[0] > 0, "frame budget bucket boundaries must be positive"
+    # Bucket i contains sequences with lengths in [boundaries[i-1], boundaries[i]), the last bucket has all sequences longer than the last boundary
+    max_bucket_lengths = [b - 1 for b in bucket_boundaries] + [max_frames]
+    bucket_batch_sizes = [max(1, max_frames // max(1, length)) for length in max_bucket_lengths]
+    if verbosity > 1:
+        print("Frame budget batch sizes for sequence lengths:")
+        for begin, end, batch_size in zip([0] + bucket_boundaries, bucket_boundaries + [None], bucket_batch_sizes):
+            print("  [{}, {}): {}".format(begin, end if end is not None else "inf", batch_size))
+    bucket_kwargs = dict(budget_conf.get("kwargs", {}))
+    if "mask_value" in budget_conf:
+        assert element_spec is not None, "element_spec is required for padding features with a mask value"
+        bucket_kwargs["padded_shapes"], bucket_kwargs["padding_values"] = padded_batch_args(element_spec, budget_conf["mask_value"])
+    return tf.data.experimental.bucket_by_sequence_length(
+        lambda feats, *rest: tf.shape(feats)[0],
+        bucket_boundaries,
+        bucket_batch_sizes,
+        **bucket_kwargs)
+
+# Keys of the training dataset config that affect the contents of a prepared dataset cache
+PREPARED_DATASET_CONFIG_KEYS = (
+    "batch_by_frame_budget",
+    "batch_size",
+    "bucket_by_sequence_length",
+    "feature_output",
+    "frames",
+    "group_by_sequence_length",
+    "masked_padded_batch",
+    "min_shape",
+    "padded_batch",
+    "shuffle_buffer",
+)
+
+def prepared_dataset_checksum(config, conf_checksum):
+    md5input = {k: config[k] for k in PREPARED_DATASET_CONFIG_KEYS if k in config}
+    json_str = json.dumps([conf_checksum, md5input], ensure_ascii=False, sort_keys=True)
+    return hashlib.md5(json_str.encode("utf-8")).hexdigest()
+
+def prepare_dataset_for_training(ds, config, feat_config, label2onehot, model_id, conf_checksum='', verbosity=0, stats=None, tiered_cache=None):
+    # Compute before the config is modified below
+    prepared_checksum = prepared_dataset_checksum(config, conf_checksum)
+    if isinstance(ds.element_spec[0], dict):
+        assert "feature_output" in config, "features contain multiple types {}, choose one with the key 'feature_output'".format(', '.join(ds.element_spec[0]))
+        if verbosity:
+            print("Using features of type '{}'".format(config["feature_output"]))
+        ds = ds.map(lambda feats, meta: (feats[config["feature_output"]], meta))
+    ds = attach_stage_probe(ds, "cached_features", stats)
     if "frames" in config:
-        raise NotImplementedError("todo")
         if verbosity:
             print("Dividing features time dimension into frames")
         assert "convert_to_images" not in config, "todo, time dim random chunks for image data"
-        # frame_axis = 1 if "convert_to_images" in config else 0
-        # if frame_axis == 1:
-            # ds = ds.map(lambda f, *meta: (tf.transpose(f, perm=(1, 0, 2, 3)), *meta))
-        if config["frames"].get("random", False):
+        frames_config = config["frames"]
+        flatten = frames_config.get("flatten", True)
+        if frames_config.get("random", False):
             if verbosity:
                 print("Dividing features time dimension randomly")
-            assert isinstance(config["frames"]["length"], dict), "key 'frames.length' must map to a dict type when doing random chunking of frames"
-            frame_chunker_fn = make_random_frame_chunker_fn(config["frames"]["length"])
-            chunk_timedim_randomly = lambda f, *meta: (frame_chunker_fn(f), *meta)
-            ds = ds.map(chunk_timedim_randomly, num_parallel_calls=TF_AUTOTUNE)
+            assert isinstance(frames_config["length"], dict), "key 'frames.length' must map to a dict type when doing random chunking of frames"
+            assert flatten, "random length chunks cannot be stacked into one tensor, 'frames.flatten' must be True"
+            if verbosity and config.get("copy_cache_to_tmp", False):
+                print("Warning: 'copy_cache_to_tmp' caches the first epoch of random chunks, the same chunks will be used for every epoch")
+            ds = chunk_features_by_offsets(ds, make_random_frame_chunker_fn(frames_config["length"]))
         else:
             if verbosity:
                 print("Dividing features time dimension into fixed length chunks")
-            # Extract frames from all features, using the same metadata for each frame of one sample of features
-            seq_len = config["frames"]["length"]
-            seq_step = config["frames"]["step"]
-            pad_zeros = config["frames"].get("pad_zeros", False)
-            to_frames = lambda feats, *meta: (
-                tf.signal.frame(feats, seq_len, seq_step, pad_end=pad_zeros, axis=0),
-                *meta)
-            ds = ds.map(to_frames)
-        if config["frames"].get("flatten", True):
-            def _unbatch_ragged_frames(frames, *meta):
-                frames_ds = tf.data.Dataset.from_tensor_slices(frames)
-                inf_repeated_meta_ds = [tf.data.Dataset.from_tensors(m).repeat() for m in meta]
-                return tf.data.Dataset.zip((frames_ds, *inf_repeated_meta_ds))
-            ds = ds.flat_map(_unbatch_ragged_frames)
-        ds = ds.filter(lambda frames, *meta: tf.shape(frames)[0] > 0)
-        if "normalize" in config["frames"]:
-            axis = config["frames"]["normalize"]["axis"]
+            seq_len = frames_config["length"]
+            seq_step = frames_config["step"]
+            pad_zeros = frames_config.get("pad_zeros", False)
+            if flatten:
+                chunk_offsets_fn = make_fixed_frame_chunker_fn(seq_len, seq_step, pad_zeros)
+                ds = chunk_features_by_offsets(ds, chunk_offsets_fn, pad_zeros=pad_zeros)
+            else:
+                # Extract frames from all features, using the same metadata for each frame of one sample of features
+                to_frames = lambda feats, meta: (
+                    tf.signal.frame(feats, seq_len, seq_step, pad_end=pad_zeros, axis=0),
+                    meta)
+                ds = ds.map(to_frames, num_parallel_calls=TF_AUTOTUNE)
+        ds = ds.filter(lambda frames, meta: tf.shape(frames)[0] > 0)
+        if "normalize" in frames_config:
+            axis = frames_config["normalize"]["axis"]
             if verbosity:
                 print("Normalizing means frame-wise over axis {}".format(axis))
-            def normalize_frames(frames, *meta):
-                return (frames - tf.math.reduce_mean(frames, axis=axis, keepdims=True), *meta)
+            def normalize_frames(frames, meta):
+                return (frames - tf.math.reduce_mean(frames, axis=axis, keepdims=True), meta)
             ds = ds.map(normalize_frames)
+        ds = attach_stage_probe(ds, "frames", stats)
     # Transform dataset such that 2 first elements will always be (sample, onehot_label) and rest will be metadata that can be safely dropped when training starts
     to_model_input = lambda feats, meta: (feats, label2onehot(meta[1]), meta[0], *meta[2:])
     ds = ds.map(to_model_input)
@@ -290,6 +685,7 @@ def prepare_dataset_for_training(ds, config, feat_config, label2onehot, model_id
         if verbosity:
             print("Shuffling features with shuffle buffer size", shuffle_buffer_size)
         ds = ds.shuffle(shuffle_buffer_size)
+        ds = attach_stage_probe(ds, "shuffle", stats)
     if "padded_batch" in config:
         pad_kwargs = config["padded_batch"]["kwargs"]
         if verbosity:
@@ -298,7 +694,14 @@ def prepare_dataset_for_training(ds, config, feat_config, label2onehot, model_id
         pad_kwargs["padded_shapes"] = tuple(pad_kwargs["padded_shapes"])
         pad_kwargs["padding_values"] = tuple(tf.constant(float(val), dtype=tf.float32) for val in pad_kwargs["padding_values"])
         ds = without_metadata(ds).padded_batch(**pad_kwargs)
-    elif "batch_size" in config:
+    elif "masked_padded_batch" in config:
+        masked_conf = config["masked_padded_batch"]
+        mask_value = masked_conf.get("mask_value", 0.0)
+        if verbosity:
+            print("Batching variable length features with batch size {}, padding with mask value {}".format(masked_conf["batch_size"], mask_value))
+        padded_shapes, padding_values = padded_batch_args(ds.element_spec, mask_value)
+        ds = ds.padded_batch(masked_conf["batch_size"], padded_shapes=padded_shapes, padding_values=padding_values)
+    elif "batch_size" in config and "batch_by_frame_budget" not in config:
         if verbosity:
             print("Batching features with batch size", config["batch_size"])
         ds = ds.batch(config["batch_size"])
@@ -319,6 +722,11 @@ def prepare_dataset_for_training(ds, config, feat_config, label2onehot, model_id
             bucket_batch_sizes,
             **bucket_conf.get("kwargs", {}))
         ds = ds.apply(bucketing_fn)
+    elif "batch_by_frame_budget" in config:
+        budget_conf = config["batch_by_frame_budget"]
+        if verbosity:
+            print("Batching features into sequence length buckets with at most {} padded frames per batch".format(budget_conf["max_frames"]))
+        ds = ds.apply(frame_budget_batching(budget_conf, ds.element_spec, verbosity))
     elif "group_by_sequence_length" in config:
         max_batch_size = tf.constant(config["group_by_sequence_length"]["max_batch_size"], tf.int64)
         if verbosity:
@@ -332,17 +740,20 @@ def prepare_dataset_for_training(ds, config, feat_config, label2onehot, model_id
                 print("Dropping batches smaller than min_batch_size", min_batch_size)
             min_batch_size = tf.constant(min_batch_size, tf.int32)
             ds = ds.filter(lambda batch, meta: (tf.shape(batch)[0] >= min_batch_size))
+    ds = attach_stage_probe(ds, "batch", stats)
     if config.get("copy_cache_to_tmp", False):
-        tmp_cache_path = "/tmp/tensorflow-cache/{}/training-prepared_{}_{}".format(model_id, int(time.time()), conf_checksum)
+        if tiered_cache is None:
+            tiered_cache = TieredCache(verbosity=verbosity)
+        tmp_cache_path = tiered_cache.open(prepared_checksum)
         if verbosity:
             print("Caching prepared dataset iterator to '{}'".format(tmp_cache_path))
-        os.makedirs(os.path.dirname(tmp_cache_path), exist_ok=True)
         ds = ds.cache(filename=tmp_cache_path)
         cache_shuffle_buffer_size = config.get("shuffle_buffer", {"after_cache": 0})["after_cache"]
         if cache_shuffle_buffer_size:
             if verbosity:
                 print("Shuffling cached features with shuffle buffer size", cache_shuffle_buffer_size)
             ds = ds.shuffle(cache_shuffle_buffer_size)
+        ds = attach_stage_probe(ds, "tmp_cache", stats)
     # assume autotuned prefetch (turned off when config["prefetch"] is None)
     if "prefetch" not in config:
         if verbosity:
@@ -354,10 +765,22 @@ def prepare_dataset_for_training(ds, config, feat_config, label2onehot, model_id
         ds = ds.prefetch(config["prefetch"])
     return ds
 
-#TODO histogram support (uses significantly less space than images+audio)
-def attach_dataset_logger(ds, features_name, max_outputs=10, image_resize_kwargs=None, colormap="viridis", debug_squeeze_last_dim=False, num_batches=-1):
+def percentiles(x, q):
+    """Nearest rank percentiles q (in [0, 100]) of all values in x."""
+    x = tf.sort(tf.reshape(x, [-1]))
+    ranks = tf.constant(q, tf.float32) / 100.0 * tf.cast(tf.size(x) - 1, tf.float32)
+    return tf.gather(x, tf.cast(tf.math.round(ranks), tf.int32))
+
+def write_histogram_summaries(batch_idx, samples, labels, percentile_q):
+    tf.summary.histogram("input_samples", samples, step=batch_idx)
+    tf.summary.histogram("input_labels", labels, step=batch_idx)
+    for q, value in zip(percentile_q, tf.unstack(percentiles(samples, percentile_q))):
+        tf.summary.scalar("input_samples_percentile/{:g}".format(q), value, step=batch_idx)
+
+def attach_dataset_logger(ds, features_name, max_outputs=10, image_resize_kwargs=None, colormap="viridis", debug_squeeze_last_dim=False, num_batches=-1, sample_every=1, histogram_only=False, percentile_q=(1, 5, 25, 50, 75, 95, 99)):
     """
     Write Tensorboard summary information for samples in the given tf.data.Dataset.
+    Only every sample_every'th batch is logged and if histogram_only is True, only histograms and percentiles are written, skipping all image, audio and text summaries.
     """
     # TF colormap trickery from https://gist.github.com/jimfleming/c1adfdb0f526465c99409cc143dea97b
     # The idea is to extract all RGB values from the matplotlib colormap into a tf.constant
@@ -367,11 +790,8 @@ def attach_dataset_logger(ds, features_name, max_outputs=10, image_resize_kwargs
     if image_resize_kwargs is None:
         image_resize_kwargs = {"size_multiplier": 0}
     img_size_multiplier = tf.constant(image_resize_kwargs.pop("size_multiplier", 1), dtype=tf.float32)
-    @tf.function
-    def inspect_batches(batch_idx, batch):
-        samples, labels, uttids, wavs = batch[:4]
-        if debug_squeeze_last_dim:
-            samples = tf.squeeze(samples, -1)
+    sample_every = tf.constant(sample_every, tf.int64)
+    def write_media_summaries(batch_idx, samples, uttids, wavs):
         # Scale features between 0 and 1 to produce a grayscale image
         image = feature_scaling(samples, tf.constant(0.0), tf.constant(1.0))
         # Map linear colormap over all grayscale values [0, 1] to produce an RGB image
@@ -385,8 +805,6 @@ def attach_dataset_logger(ds, features_name, max_outputs=10, image_resize_kwargs
             new_size = tf.cast(img_size_multiplier * old_size, tf.int32)
             image = tf.image.resize(image, new_size, **image_resize_kwargs)
         tf.debugging.assert_all_finite(image, message="non-finite values in image when trying to create dataset logger for tensorboard")
-        tf.summary.histogram("input_samples", samples, step=batch_idx)
-        tf.summary.histogram("input_labels", labels, step=batch_idx)
         tf.summary.image(features_name, image, step=batch_idx, max_outputs=max_outputs)
         tf.debugging.assert_equal(tf.expand_dims(wavs.sample_rate[0], 0), wavs.sample_rate, message="All utterances in a batch must have the same sample rate")
         tf.summary.audio("utterances", tf.expand_dims(wavs.audio, -1), wavs.sample_rate[0], step=batch_idx, max_outputs=max_outputs)
@@ -395,14 +813,112 @@ def attach_dataset_logger(ds, features_name, max_outputs=10, image_resize_kwargs
                 axis=0,
                 separator=": ")
         tf.summary.text("utterance_ids", enumerated_uttids, step=batch_idx)
+    @tf.function
+    def inspect_batches(batch_idx, batch):
+        if batch_idx % sample_every == 0:
+            samples, labels = batch[:2]
+            if debug_squeeze_last_dim:
+                samples = tf.squeeze(samples, -1)
+            write_histogram_summaries(batch_idx, samples, labels, percentile_q)
+            if not histogram_only:
+                uttids, wavs = batch[2:4]
+                write_media_summaries(batch_idx, samples, uttids, wavs)
         return batch
     return (ds.take(num_batches)
               .enumerate()
-              .map(inspect_batches))
+              .map(inspect_batches, num_parallel_calls=TF_AUTOTUNE))
+
+
+class BatchReservoir:
+    """
+    Uniformly random sample of at most 'size' batches from a dataset of unknown length (Vitter's algorithm R).
+    Batches are offered from a tf.data pipeline with attach_reservoir_logger and summaries are written from the reservoir after the dataset has been iterated.
+    """
+    def __init__(self, size, seed=None):
+        self.size = size
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.batches = []
+        self.num_offered = 0
+
+    def offer(self, batch_idx, samples, labels):
+        with self.lock:
+            self.num_offered += 1
+            if len(self.batches) < self.size:
+                self.batches.append((int(batch_idx), np.array(samples), np.array(labels)))
+            else:
+                i = self.rng.randrange(self.num_offered)
+                if i < self.size:
+                    self.batches[i] = (int(batch_idx), np.array(samples), np.array(labels))
+        return True
+
+    def write_summaries(self, percentile_q=(1, 5, 25, 50, 75, 95, 99)):
+        """Write histograms and percentiles of all batches in the reservoir using the default summary writer."""
+        with self.lock:
+            for batch_idx, samples, labels in sorted(self.batches, key=lambda b: b[0]):
+                write_histogram_summaries(tf.constant(batch_idx, tf.int64), tf.constant(samples), tf.constant(labels), percentile_q)
+
+def attach_reservoir_logger(ds, reservoir, num_batches=-1):
+    """Offer every batch of ds to reservoir, leaving all batches unchanged."""
+    def offer(batch_idx, batch):
+        offered = tf.numpy_function(reservoir.offer, [batch_idx, batch[0], batch[1]], tf.bool)
+        with tf.control_dependencies([offered]):
+            return tf.nest.map_structure(tf.identity, batch)
+    return (ds.take(num_batches)
+              .enumerate()
+              .map(offer))
+
+# Cached features can be stored with reduced precision.
+# Every encoding produces a tuple (encoded, scale, offset) such that the features are decoded with cast(encoded) * scale + offset.
+# For 8-bit integer encodings the scale and offset are computed separately for each utterance from the minimum and maximum values.
+CACHE_ENCODINGS = ("float32", "float16", "uint8", "int8")
+# Encodings with a per-utterance float32 scale and offset
+AFFINE_CACHE_ENCODINGS = ("uint8", "int8")
+
+def get_cache_encoding(feat_config):
+    encoding = feat_config.get("cache_encoding", "float32")
+    assert encoding in CACHE_ENCODINGS, "unknown cache_encoding '{}', must be one of {}".format(encoding, ', '.join(CACHE_ENCODINGS))
+    return encoding
+
+def encode_features(feats, encoding):
+    if encoding not in AFFINE_CACHE_ENCODINGS:
+        return tf.cast(feats, encoding), tf.constant(1.0, tf.float32), tf.constant(0.0, tf.float32)
+    q_min, q_max = (0.0, 255.0) if encoding == "uint8" else (-128.0, 127.0)
+    feats_min = tf.math.reduce_min(feats)
+    feats_max = tf.math.reduce_max(feats)
+    scale = (feats_max - feats_min) / (q_max - q_min)
+    # Constant features would give zero scale, any positive value decodes them correctly
+    scale = tf.where(scale > 0, scale, tf.constant(1.0, tf.float32))
+    offset = feats_min - q_min * scale
+    q = tf.clip_by_value(tf.math.round((feats - offset) / scale), q_min, q_max)
+    return tf.cast(q, encoding), scale, offset
+
+def decode_features(encoded, scale, offset):
+    return tf.cast(encoded, tf.float32) * scale + offset
+
+def encode_cached_features(ds, encoding):
+    def encode(feats, meta):
+        if isinstance(feats, dict):
+            return {k: encode_features(v, encoding) for k, v in feats.items()}, meta
+        return encode_features(feats, encoding), meta
+    return ds.map(encode, num_parallel_calls=TF_AUTOTUNE)
+
+def decode_cached_features(ds):
+    def decode(encoded, meta):
+        if isinstance(encoded, dict):
+            return {k: decode_features(*v) for k, v in encoded.items()}, meta
+        return decode_features(*encoded), meta
+    return ds.map(decode, num_parallel_calls=TF_AUTOTUNE)
 
 def without_metadata(dataset):
     return dataset.map(lambda feats, inputs, *meta: (feats, inputs))
 
+def without_wavs(ds):
+    """Drop the signals that extract_features_from_paths appends to the metadata of (feats, meta) elements, if ds has them."""
+    if not isinstance(ds.element_spec[1][-1], audio_feat.Wav):
+        return ds
+    return ds.map(lambda feats, meta: (feats, meta[:-1]))
+
 # Copied from
 # https://github.com/microsoft/MS-SNSD/blob/e84aba38cac499a109c0d237a00dc600dcf9b7e7/audiolib.py
 def snr_mixer(clean, noise, snr):
@@ -564,9 +1080,171 @@ def get_random_chunk_loader(paths, meta, wav_config, verbosity=0):
         tf_print("Using random wav chunk loader, drawing lengths (in frames) from", lengths, "with", overlap_ratio, "overlap ratio and", min_chunk_length, "minimum chunk length")
     return random_chunk_loader
 
+VALIDATION_POLICIES = ("strict", "sampled", "filter")
+
+def get_validation_policy(feat_config):
+    """
+    Validation policy for non-finite values in extracted features, from the key 'validation' of the feature config:
+    strict: every stage of every batch is checked and non-finite values raise an error (default),
+    sampled: only the final features of every validation.sample_every'th batch are checked,
+    filter: nothing raises an error but utterances with non-finite features are dropped and recorded as rejected.
+    """
+    validation = feat_config.get("validation", {})
+    policy = validation.get("policy", "strict")
+    assert policy in VALIDATION_POLICIES, "unknown validation policy '{}', valid policies are {}".format(policy, ', '.join(VALIDATION_POLICIES))
+    return policy, validation
+
+class RejectedUtterances:
+    """Thread-safe collector of utterance ids dropped by the 'filter' validation policy."""
+    def __init__(self, name=''):
+        self.name = name
+        self.lock = threading.Lock()
+        self.uttids = collections.OrderedDict()
+
+    def record(self, uttid):
+        with self.lock:
+            self.uttids[uttid] = self.uttids.get(uttid, 0) + 1
+
+    def __len__(self):
+        with self.lock:
+            return len(self.uttids)
+
+    def write_report(self, path):
+        """Write ids of all rejected utterances into path, one per line."""
+        with self.lock, open(path, "w") as f:
+            for uttid in self.uttids:
+                print(uttid, file=f)
+
+def all_finite(feats):
+    return tf.math.reduce_all([tf.math.reduce_all(tf.math.is_finite(f)) for f in tf.nest.flatten(feats)])
+
+def element_uttid(meta):
+    """Utterance id from the metadata of an unbatched element, which is either a scalar (chunk loaders) or the first item of a metadata vector."""
+    uttid = tf.nest.flatten(meta)[0]
+    return uttid if uttid.shape.rank == 0 else uttid[0]
+
+def check_finite_sampled(ds, sample_every):
+    """Check that the features of every sample_every'th element of ds are finite, all other elements pass through unchecked."""
+    def check(i, element):
+        def assert_finite():
+            with tf.control_dependencies([tf.debugging.assert_all_finite(f, "non-finite values in extracted features") for f in tf.nest.flatten(element[0])]):
+                return tf.nest.map_structure(tf.identity, element)
+        return tf.cond(i % sample_every == 0, assert_finite, lambda: element)
+    return ds.enumerate().map(check, num_parallel_calls=TF_AUTOTUNE)
+
+def filter_non_finite(ds, rejected=None):
+    """Drop all unbatched elements of ds that have non-finite features and record their utterance ids into rejected, if given."""
+    def record(uttid):
+        rejected.record(uttid.decode("utf-8"))
+        return False
+    def is_finite(feats, meta):
+        finite = all_finite(feats)
+        if rejected is None:
+            return finite
+        return tf.cond(finite, lambda: True, lambda: tf.numpy_function(record, [element_uttid(meta)], tf.bool))
+    return ds.filter(is_finite)
+
+def batch_wavs(wavs, feat_config, verbosity=0):
+    if "batch_wavs_by_length" in feat_config:
+        window_size = feat_config["batch_wavs_by_length"]["max_batch_size"]
+        if verbosity:
+            print("Batching all wavs by equal length into batches of max size {}".format(window_size))
+        key_fn = lambda wav, *meta: tf.cast(tf.size(wav.audio), tf.int64)
+        reduce_fn = lambda key, group_ds: group_ds.batch(window_size)
+        group_by_wav_length = tf.data.experimental.group_by_window(key_fn, reduce_fn, window_size)
+        return wavs.apply(group_by_wav_length)
+    else:
+        batch_size = feat_config.get("batch_size", 1)
+        if verbosity:
+            print("Batching wavs with batch size", batch_size)
+        return wavs.batch(batch_size)
+
+def stage_checksum(parent_checksum, stage_config):
+    """
+    Checksum of a feature extraction stage, computed from the checksum of the preceding stage and only those config keys that affect this stage.
+    Changing e.g. cmvn settings changes the checksum of the final stage but not the checksums of the spectrogram or melspectrogram stages.
+    """
+    json_str = json.dumps([parent_checksum, stage_config], ensure_ascii=False, sort_keys=True)
+    return hashlib.md5(json_str.encode("utf-8")).hexdigest()
+
+def cache_stage(ds, stage_cache_dir, stage, checksum, verbosity=0, stats=None):
+    cache_path = os.path.join(stage_cache_dir, stage, checksum, "cache")
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    if verbosity:
+        if is_cache_complete(cache_path):
+            print("Stage '{}' has a complete cache at '{}', preceding stages will not be computed".format(stage, cache_path))
+        else:
+            print("Stage '{}' will be cached to '{}'".format(stage, cache_path))
+    return attach_stage_probe(ds.cache(filename=cache_path), "stage_" + stage, stats)
+
+def extract_features_by_stages(feat_config, wavs, stage_cache_dir, audio_checksum, validate=True, verbosity=0, stats=None):
+    """
+    Extract features from a dataset of (Wav, *meta) elements through separately cached stages:
+    audio, spectrogram, melspectrogram (only for mel based types) and the final features.
+    Each stage is cached by a checksum of its parent stage and the config keys that affect it,
+    so a pipeline resumes from the deepest stage that has a complete cache with a matching checksum and only the stages after it are computed.
+    Returns an unbatched dataset of (features, meta) elements.
+    """
+    assert "types" not in feat_config and "xla" not in feat_config, "stage caching supports only one feature type without XLA"
+    feattype, spec_kwargs, melspec_kwargs, mfcc_kwargs, db_spec_kwargs, feat_scale_kwargs, cmvn_kwargs = feat_extraction_args_as_list(feat_config)
+    assert_all_finite = tf.debugging.assert_all_finite if validate else lambda x, message: x
+    if verbosity:
+        print("Extracting '{}' features by stages, caching all stages into '{}'".format(feattype, stage_cache_dir))
+    wavs = cache_stage(wavs, stage_cache_dir, "audio", audio_checksum, verbosity, stats)
+    # Spectrograms are computed in batches and cached per utterance, all following stages are computed per utterance
+    spec_checksum = stage_checksum(audio_checksum, {
+        "spectrogram": spec_kwargs,
+        "batch_size": feat_config.get("batch_size", 1),
+        "batch_wavs_by_length": feat_config.get("batch_wavs_by_length")})
+    def extract_spectrograms(wavs, *meta):
+        S = audio_feat.spectrograms(wavs, **spec_kwargs)
+        assert_all_finite(S, "spectrogram failed")
+        return S, wavs.sample_rate, meta
+    feats = (batch_wavs(wavs, feat_config, verbosity)
+                .map(extract_spectrograms, num_parallel_calls=TF_AUTOTUNE)
+                .unbatch())
+    feats = cache_stage(feats, stage_cache_dir, "spectrogram", spec_checksum, verbosity, stats)
+    parent_checksum = spec_checksum
+    if feattype in ("melspectrogram", "logmelspectrogram", "mfcc"):
+        parent_checksum = stage_checksum(spec_checksum, {"melspectrogram": melspec_kwargs})
+        def extract_melspectrogram(S, sample_rate, meta):
+            melspec = audio_feat.melspectrograms(tf.expand_dims(S, 0), sample_rate=sample_rate, **melspec_kwargs)[0]
+            assert_all_finite(melspec, "melspectrogram failed")
+            return melspec, sample_rate, meta
+        feats = feats.map(extract_melspectrogram, num_parallel_calls=TF_AUTOTUNE)
+        feats = cache_stage(feats, stage_cache_dir, "melspectrogram", parent_checksum, verbosity, stats)
+    features_checksum = stage_checksum(parent_checksum, {k: feat_config.get(k) for k in ("type", "mfcc", "db_spectrogram", "sample_minmax_scaling", "cmvn", "cmvn_numpy")})
+    def extract_final_features(feat, sample_rate, meta):
+        X = tf.expand_dims(feat, 0)
+        if feattype in ("logmelspectrogram", "mfcc"):
+            X = tf.math.log(X + 1e-6)
+            assert_all_finite(X, "logmelspectrogram failed")
+            if feattype == "mfcc":
+                X = tf.signal.mfccs_from_log_mel_spectrograms(X)[..., mfcc_kwargs.get("coef_begin", 1):mfcc_kwargs.get("coef_end", 13)]
+                assert_all_finite(X, "mfcc failed")
+        elif feattype == "db_spectrogram":
+            X = audio_feat.power_to_db(X, **db_spec_kwargs)
+            assert_all_finite(X, "db_spectrogram failed")
+        if feat_scale_kwargs:
+            X = feature_scaling(X, **feat_scale_kwargs)
+            assert_all_finite(X, "feature scaling failed")
+        if cmvn_kwargs:
+            X = cmvn_slide(X, **cmvn_kwargs)
+            assert_all_finite(X, "cmvn failed")
+        if "cmvn_numpy" in feat_config:
+            normalized = tf.numpy_function(
+                cmvn_nopad_slide_numpy,
+                [X, feat_config["cmvn_numpy"]["window_len"], feat_config["cmvn_numpy"].get("normalize_variance", True)],
+                X.dtype)
+            normalized.set_shape(X.shape.as_list())
+            X = normalized
+        return X[0], meta
+    feats = feats.map(extract_final_features, num_parallel_calls=TF_AUTOTUNE)
+    return cache_stage(feats, stage_cache_dir, "features", features_checksum, verbosity, stats)
+
 # Use batch_size > 1 iff _every_ audio file in paths has the same amount of samples
 # TODO: fix this mess
-def extract_features_from_paths(feat_config, paths, meta, datagroup_key, trim_audio=None, debug_squeeze_last_dim=False, verbosity=0):
+def extract_features_from_paths(feat_config, paths, meta, datagroup_key, trim_audio=None, debug_squeeze_last_dim=False, verbosity=0, stats=None, stage_cache_dir=None, rejected=None):
     paths, meta = list(paths), list(meta)
     assert len(paths) == len(meta), "Cannot extract features from paths when the amount of metadata {} does not match the amount of wavfile paths {}".format(len(meta), len(paths))
     wav_config = feat_config.get("wav_config")
@@ -595,42 +1273,63 @@ def extract_features_from_paths(feat_config, paths, meta, datagroup_key, trim_au
             tf.constant(meta, dtype=tf.string)))
         load_wav_with_meta = lambda path, *meta: (load_wav(path), *meta)
         wavs = wav_paths.map(load_wav_with_meta, num_parallel_calls=TF_AUTOTUNE)
-    if "batch_wavs_by_length" in feat_config:
-        window_size = feat_config["batch_wavs_by_length"]["max_batch_size"]
-        if verbosity:
-            print("Batching all wavs by equal length into batches of max size {}".format(window_size))
-        key_fn = lambda wav, *meta: tf.cast(tf.size(wav.audio), tf.int64)
-        reduce_fn = lambda key, group_ds: group_ds.batch(window_size)
-        group_by_wav_length = tf.data.experimental.group_by_window(key_fn, reduce_fn, window_size)
-        wavs_batched = wavs.apply(group_by_wav_length)
-    else:
-        batch_size = feat_config.get("batch_size", 1)
-        if verbosity:
-            print("Batching wavs with batch size", batch_size)
-        wavs_batched = wavs.batch(batch_size)
+    wavs = attach_stage_probe(wavs, "decode", stats)
+    validation_policy, validation_config = get_validation_policy(feat_config)
+    validate = validation_policy == "strict"
+    if verbosity:
+        print("Using validation policy '{}' for extracted features".format(validation_policy))
+    if "stage_caching" in feat_config:
+        assert stage_cache_dir, "stage_caching is enabled in the feature config but no stage cache directory was given"
+        audio_checksum = stage_checksum(datagroup_key, {"paths": paths, "meta": meta, "wav_config": wav_config})
+        features = extract_features_by_stages(feat_config, wavs, stage_cache_dir, audio_checksum, validate=validate, verbosity=verbosity, stats=stats)
+        if validation_policy == "sampled":
+            features = check_finite_sampled(features, validation_config.get("sample_every", 100))
+        elif validation_policy == "filter":
+            features = filter_non_finite(features, rejected)
+        return features
+    wavs_batched = batch_wavs(wavs, feat_config, verbosity)
     if verbosity:
         print("Applying feature extractor to batched wavs")
-    feat_extract_args = feat_extraction_args_as_list(feat_config)
+    if "xla" in feat_config:
+        assert "types" not in feat_config, "XLA feature extraction supports only one feature type"
+        if verbosity:
+            print("Compiling feature extractor with XLA, using shape buckets of {} ms".format(feat_config["xla"].get("bucket_length_ms", 1000)))
+        extract_features_fn = make_xla_feature_extractor(feat_config, validate)
+    else:
+        if verbosity and "types" in feat_config:
+            print("Extracting multiple feature types from one spectrogram:", ', '.join(feature_types(feat_config)))
+        extract_features_fn = make_feature_extractor(feat_config, validate)
     # This function expects batches of wavs
     extract_feats = lambda wavs, *meta: (
-        extract_features(wavs, *feat_extract_args),
+        extract_features_fn(wavs),
         (*meta, wavs)
     )
+    wavs_batched = attach_stage_probe(wavs_batched, "batch_wavs", stats)
     features = wavs_batched.map(extract_feats, num_parallel_calls=TF_AUTOTUNE)
+    features = attach_stage_probe(features, "extract_features", stats)
     if "cmvn_numpy" in feat_config:
         window_len = tf.constant(feat_config["cmvn_numpy"]["window_len"], tf.int32)
         normalize_variance = tf.constant(feat_config["cmvn_numpy"].get("normalize_variance", True), tf.bool)
         if verbosity:
             tf_print("Using numpy to apply cmvn sliding window of length", window_len, "without padding. Will also normalize variance:", normalize_variance)
-        def apply_cmvn_numpy(feats, *rest):
+        def cmvn_numpy(feats):
             normalized = tf.numpy_function(
                 cmvn_nopad_slide_numpy,
                 [feats, window_len, normalize_variance],
                 feats.dtype)
             normalized.set_shape(feats.shape.as_list())
-            return (normalized, *rest)
+            return normalized
+        def apply_cmvn_numpy(feats, *rest):
+            return (tf.nest.map_structure(cmvn_numpy, feats), *rest)
         features = features.map(apply_cmvn_numpy, num_parallel_calls=TF_AUTOTUNE)
+        features = attach_stage_probe(features, "cmvn_numpy", stats)
+    if validation_policy == "sampled":
+        features = check_finite_sampled(features, validation_config.get("sample_every", 100))
     features = features.unbatch()
+    features = attach_stage_probe(features, "unbatch", stats)
+    if validation_policy == "filter":
+        features = filter_non_finite(features, rejected)
+        features = attach_stage_probe(features, "filter_non_finite", stats)
     return features
 
 def parse_sparsespeech_features(feat_config, enc_path, feat_path, seg2utt, utt2label):
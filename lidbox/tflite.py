@@ -0,0 +1,112 @@
+"""
+Conversion of trained Keras models into TFLite models with optional post-training quantization, and a CPU runtime for scoring fixed length feature chunks with the converted models.
+TFLite models have a fixed input shape, i.e. a fixed batch size and amount of input frames, so they are used for chunked scoring, see lidbox.chunk_scoring.
+"""
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+QUANTIZATIONS = ("float32", "dynamic_range", "int8")
+
+def convert(model, input_length, batch_size=1, quantization="float32", representative_dataset=None):
+    """
+    Convert a Keras model into a TFLite flatbuffer for input batches of batch_size chunks of input_length frames.
+    The batch size is fixed in the converted model, since it is baked into the shapes of reshape ops.
+    dynamic_range quantizes weights to 8 bits, int8 quantizes both weights and activations using the calibration inputs from representative_dataset,
+    which must be a callable that returns an iterable of single input batches of shape (batch_size, input_length, *feature_shape).
+    Inputs and outputs of the converted model are float32 for all quantizations.
+    """
+    assert quantization in QUANTIZATIONS, "unknown quantization '{}', valid quantizations are {}".format(quantization, ', '.join(QUANTIZATIONS))
+    input_spec = tf.TensorSpec([batch_size, input_length] + model.input.shape.as_list()[2:], model.input.dtype)
+    inference_fn = tf.function(lambda inputs: model(inputs, training=False)).get_concrete_function(input_spec)
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([inference_fn])
+    if quantization != "float32":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "int8":
+        assert representative_dataset is not None, "int8 quantization requires a representative dataset for calibrating activation ranges"
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    return converter.convert()
+
+def pad_batch(batch, batch_size):
+    """Pad the first dimension of batch with zeros to batch_size."""
+    padding = np.zeros((batch_size - batch.shape[0],) + batch.shape[1:], dtype=batch.dtype)
+    return np.concatenate((batch, padding))
+
+def representative_dataset(chunk_ds, num_samples, batch_size):
+    """
+    Calibration inputs for int8 conversion from num_samples chunks of a dataset of (chunks, *rest) batches, e.g. from tf_data.chunks_for_scoring.
+    The chunks are batched into the fixed batch size of the converted model and the last batch is padded by repeating its chunks.
+    """
+    def generate():
+        for chunks, *_ in chunk_ds.unbatch().take(num_samples).batch(batch_size):
+            chunks = chunks.numpy().astype(np.float32)
+            yield [np.resize(chunks, (batch_size,) + chunks.shape[1:])]
+    return generate
+
+
+class TFLiteModel:
+    """
+    Scores batches of fixed length feature chunks of any size with a TFLite interpreter.
+    Batches are split into the fixed batch size of the model and the last part is padded with zeros, whose outputs are dropped.
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        try:
+            self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        except TypeError:
+            # num_threads is not supported by older TensorFlow versions
+            self.interpreter = tf.lite.Interpreter(model_path=model_path)
+        self.interpreter.allocate_tensors()
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.input_shape = list(self.interpreter.get_input_details()[0]["shape"])
+
+    @property
+    def batch_size(self):
+        return self.input_shape[0]
+
+    @property
+    def input_length(self):
+        return self.input_shape[1]
+
+    def predict_on_batch(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        outputs = []
+        for begin in range(0, batch.shape[0], self.batch_size):
+            part = batch[begin:begin+self.batch_size]
+            self.interpreter.set_tensor(self.input_index, pad_batch(part, self.batch_size))
+            self.interpreter.invoke()
+            outputs.append(self.interpreter.get_tensor(self.output_index)[:part.shape[0]])
+        return np.concatenate(outputs)
+
+
+def timed_predictions(predict_on_batch, batches):
+    outputs = []
+    begin = time.perf_counter()
+    for batch in batches:
+        outputs.append(np.asarray(predict_on_batch(batch)))
+    return np.concatenate(outputs), time.perf_counter() - begin
+
+def parity_report(keras_model, tflite_model, batches):
+    """
+    Compare the outputs and CPU inference time of a TFLite model to the Keras model it was converted from, on the same list of input batches.
+    Both models are run once on the first batch before timing.
+    """
+    keras_predict = lambda batch: keras_model.predict_on_batch(batch)
+    keras_predict(batches[0])
+    tflite_model.predict_on_batch(batches[0])
+    expected, keras_sec = timed_predictions(keras_predict, batches)
+    outputs, tflite_sec = timed_predictions(tflite_model.predict_on_batch, batches)
+    abs_diff = np.abs(outputs - expected)
+    return {
+        "num_inputs": int(expected.shape[0]),
+        "max_abs_diff": float(abs_diff.max()),
+        "mean_abs_diff": float(abs_diff.mean()),
+        "argmax_agreement": float(np.mean(outputs.argmax(axis=1) == expected.argmax(axis=1))),
+        "keras_sec": keras_sec,
+        "tflite_sec": tflite_sec,
+        "speedup": keras_sec / max(1e-12, tflite_sec),
+    }
@@ -0,0 +1,240 @@
+"""
+Two-tier cache for tf.data.Dataset.cache files.
+A canonical tier (e.g. on shared network storage) holds all completed caches and a local tier (e.g. on local SSD) holds recently used copies under a size budget.
+All cache entries are directories named by a content checksum, so the same entry is reused by every run that prepares the same data.
+Every process that uses a local entry leaves a marker file into it and the process that writes the entry claims it with an exclusive writer file,
+so entries are never removed or written while another live process is reading or writing them.
+"""
+import atexit
+import os
+import shutil
+import socket
+import time
+
+
+# Cache file prefix inside each entry directory, passed as filename to tf.data.Dataset.cache
+CACHE_PREFIX = "cache"
+# Touched every time an entry is used, its mtime is used for LRU eviction
+LAST_USED = "last_used"
+# Contains the id of the process that writes the entry, created exclusively
+WRITER = "writer"
+# Directory of marker files named by the ids of all processes that use the entry
+USERS = "users"
+# Interval for checking if an entry being written by another process is complete
+WAIT_POLL_SEC = 10
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+def is_cache_complete(filename):
+    """tf.data writes the index file of a cache only after the whole dataset has been iterated once and then removes the lockfile."""
+    return os.path.exists(filename + ".index") and not os.path.exists(filename + ".lockfile")
+
+def touch(path):
+    with open(path, "a"):
+        os.utime(path)
+
+def process_id():
+    return "{}-{}".format(socket.gethostname(), os.getpid())
+
+def is_process_alive(process):
+    """True if the process with an id from process_id is running, processes on other hosts are assumed to be running."""
+    host, _, pid = process.rpartition('-')
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except (ProcessLookupError, ValueError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def read_writer(entry_dir):
+    try:
+        with open(os.path.join(entry_dir, WRITER)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+class TieredCache:
+
+    def __init__(self, local_dir="/tmp/tensorflow-cache/tiered", canonical_dir=None, max_local_size_gb=None, verbosity=0):
+        self.local_dir = local_dir
+        self.canonical_dir = canonical_dir
+        self.max_local_bytes = int(max_local_size_gb * 1e9) if max_local_size_gb else None
+        self.verbosity = verbosity
+        self.opened_keys = []
+        os.makedirs(self.local_dir, exist_ok=True)
+        if self.canonical_dir:
+            os.makedirs(self.canonical_dir, exist_ok=True)
+        atexit.register(self.close)
+
+    @staticmethod
+    def cache_path(entry_dir):
+        return os.path.join(entry_dir, CACHE_PREFIX)
+
+    @classmethod
+    def is_complete(cls, entry_dir):
+        return is_cache_complete(cls.cache_path(entry_dir))
+
+    @staticmethod
+    def is_being_written(entry_dir):
+        """True if a live process other than this one has claimed entry_dir for writing."""
+        writer = read_writer(entry_dir)
+        return writer is not None and writer != process_id() and is_process_alive(writer)
+
+    @classmethod
+    def is_in_use(cls, entry_dir):
+        """True if a live process other than this one is writing or reading entry_dir."""
+        if cls.is_being_written(entry_dir):
+            return True
+        try:
+            users = os.listdir(os.path.join(entry_dir, USERS))
+        except OSError:
+            return False
+        return any(user != process_id() and is_process_alive(user) for user in users)
+
+    @classmethod
+    def claim_writer(cls, entry_dir):
+        """Atomically claim entry_dir for writing by this process, returns False if another live process has claimed it."""
+        path = os.path.join(entry_dir, WRITER)
+        while True:
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if cls.is_being_written(entry_dir):
+                    return False
+                # The previous writer was interrupted
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(process_id())
+            return True
+
+    @staticmethod
+    def add_user(entry_dir):
+        os.makedirs(os.path.join(entry_dir, USERS), exist_ok=True)
+        touch(os.path.join(entry_dir, USERS, process_id()))
+
+    def local_entries(self):
+        for d in os.scandir(self.local_dir):
+            if d.is_dir() and not d.name.startswith('.'):
+                yield d.path
+
+    def evict(self, required_bytes, keep_keys=()):
+        """Remove least recently used local entries, which no other live process is using, until required_bytes fits within the size budget."""
+        if self.max_local_bytes is None:
+            return
+        entries = []
+        for entry_dir in self.local_entries():
+            if os.path.basename(entry_dir) in keep_keys or self.is_in_use(entry_dir):
+                continue
+            last_used = os.path.join(entry_dir, LAST_USED)
+            mtime = os.path.getmtime(last_used if os.path.exists(last_used) else entry_dir)
+            entries.append((mtime, entry_dir))
+        used_bytes = dir_size(self.local_dir)
+        for _, entry_dir in sorted(entries):
+            if used_bytes + required_bytes <= self.max_local_bytes:
+                break
+            size = dir_size(entry_dir)
+            if self.verbosity:
+                print("Evicting least recently used cache entry '{}' ({:.2f} GB)".format(entry_dir, size * 1e-9))
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            used_bytes -= size
+        if self.verbosity and used_bytes + required_bytes > self.max_local_bytes:
+            print("Warning: local cache '{}' will exceed its size budget of {:.2f} GB".format(self.local_dir, self.max_local_bytes * 1e-9))
+
+    def copy_entry(self, src_entry, dst_root, key):
+        """Copy src_entry without its process markers into dst_root/key through a temporary directory and an atomic rename."""
+        dst_entry = os.path.join(dst_root, key)
+        tmp_entry = os.path.join(dst_root, ".tmp-{}-{}".format(key, os.getpid()))
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        shutil.copytree(src_entry, tmp_entry, ignore=shutil.ignore_patterns(WRITER, USERS))
+        try:
+            os.rename(tmp_entry, dst_entry)
+        except OSError:
+            # Another process completed the same entry first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        return dst_entry
+
+    def open(self, key):
+        """
+        Return a tf.data cache filename for key in the local tier.
+        A complete entry from the canonical tier is promoted to the local tier first, if the local tier does not have it.
+        If neither tier has a complete entry, the returned filename will be written by tf.data during the first iteration.
+        If another process is writing the local entry, this waits until the entry is complete or the other process has exited.
+        """
+        local_entry = os.path.join(self.local_dir, key)
+        if not self.is_complete(local_entry) and self.is_being_written(local_entry):
+            if self.verbosity:
+                print("Cache entry '{}' is being written by process '{}', waiting until it is complete".format(local_entry, read_writer(local_entry)))
+            while not self.is_complete(local_entry) and self.is_being_written(local_entry):
+                time.sleep(WAIT_POLL_SEC)
+        if self.is_complete(local_entry):
+            if self.verbosity:
+                print("Using local cache entry '{}'".format(local_entry))
+        elif self.canonical_dir and self.is_complete(os.path.join(self.canonical_dir, key)):
+            canonical_entry = os.path.join(self.canonical_dir, key)
+            if self.verbosity:
+                print("Promoting cache entry '{}' to local tier '{}'".format(canonical_entry, self.local_dir))
+            self.evict(dir_size(canonical_entry), keep_keys=(key,))
+            shutil.rmtree(local_entry, ignore_errors=True)
+            self.copy_entry(canonical_entry, self.local_dir, key)
+        else:
+            os.makedirs(local_entry, exist_ok=True)
+            if not self.claim_writer(local_entry):
+                # Another process started writing the entry after the check above
+                return self.open(key)
+            if self.verbosity:
+                print("No complete cache entry for '{}', writing new local cache entry '{}'".format(key, local_entry))
+            # Leftovers of an interrupted run
+            for name in os.listdir(local_entry):
+                if name.startswith(CACHE_PREFIX):
+                    os.remove(os.path.join(local_entry, name))
+            self.evict(0, keep_keys=(key,))
+        os.makedirs(local_entry, exist_ok=True)
+        self.add_user(local_entry)
+        touch(os.path.join(local_entry, LAST_USED))
+        self.opened_keys.append(key)
+        return self.cache_path(local_entry)
+
+    def publish(self):
+        """Copy all complete local entries opened by this instance into the canonical tier if it does not have them yet."""
+        if not self.canonical_dir:
+            return
+        for key in self.opened_keys:
+            local_entry = os.path.join(self.local_dir, key)
+            canonical_entry = os.path.join(self.canonical_dir, key)
+            if self.is_complete(local_entry) and not self.is_complete(canonical_entry):
+                if self.verbosity:
+                    print("Publishing local cache entry '{}' to canonical tier '{}'".format(local_entry, self.canonical_dir))
+                shutil.rmtree(canonical_entry, ignore_errors=True)
+                self.copy_entry(local_entry, self.canonical_dir, key)
+
+    def close(self):
+        """Remove the process markers of this process from all local entries opened by this instance, so other processes can evict them."""
+        for key in self.opened_keys:
+            local_entry = os.path.join(self.local_dir, key)
+            try:
+                os.remove(os.path.join(local_entry, USERS, process_id()))
+            except OSError:
+                pass
+            if read_writer(local_entry) == process_id():
+                try:
+                    os.remove(os.path.join(local_entry, WRITER))
+                except OSError:
+                    pass
+        self.opened_keys = []